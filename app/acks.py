@@ -0,0 +1,123 @@
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AckCoalescer(object):
+    """Agrupa os Basic.Ack de um canal em um único `basic_ack(multiple=True)`.
+
+    O ack com `multiple` confirma todas as delivery tags até a informada, então só é seguro
+    enviá-lo até a maior tag de um prefixo contínuo de mensagens já finalizadas. As tags
+    finalizadas fora de ordem ficam guardadas até o prefixo alcançá-las.
+
+    O ack é enviado a cada `batch_size` mensagens finalizadas ou depois de `interval`
+    milissegundos, o que acontecer primeiro.
+
+    """
+
+    def __init__(self, batch_size=1, interval=None):
+        """
+        :param int batch_size: Quantidade de mensagens finalizadas por ack
+        :param int interval: Tempo máximo, em milissegundos, que um ack fica retido.
+            O timer roda no IOLoop da conexão do canal
+
+        """
+        self._batch_size = max(1, batch_size)
+        self._interval = interval
+
+        self._channel = None
+        self._ioloop = None
+        self._timeout = None
+
+        self.reset(None)
+
+    def reset(self, channel):
+        """Associa o coalescer a um novo canal. As delivery tags recomeçam em 1 a cada canal
+        e os acks ainda retidos do canal anterior são descartados, já que o RabbitMQ
+        reentrega essas mensagens.
+
+        """
+        self._cancel_timeout()
+
+        self._channel = channel
+        self._ioloop = channel.connection.ioloop if channel is not None else None
+        self._settled = 0       # Maior tag do prefixo contínuo já finalizado
+        self._last_ack = 0      # Maior tag do prefixo que foi de fato ackeada
+        self._pending = 0       # Acks do prefixo que ainda não foram enviados
+        self._out_of_order = {}
+
+    def __len__(self):
+        """Quantidade de mensagens processadas cujo ack ainda não foi enviado."""
+        return self._pending
+
+    def ack(self, delivery_tag):
+        """Marca a mensagem como processada. O ack é enviado em lote."""
+        self._settle(delivery_tag, True)
+        self._schedule()
+
+    def settle(self, delivery_tag):
+        """Marca como finalizada uma mensagem que já foi recusada (Basic.Reject/Nack), para
+        que o prefixo de acks possa passar por ela. O ack em lote nunca usa a tag de uma
+        mensagem recusada, que o RabbitMQ não conhece mais.
+
+        """
+        self._settle(delivery_tag, False)
+        self._schedule()
+
+    def skip(self, first, last):
+        """Marca como finalizadas as tags de `first` até `last`, inclusive, de entregas que
+        nunca chegaram ao Consumer: o pika recusa (Basic.Reject) as que chegam depois de um
+        Basic.Cancel. Sem isso elas seriam um buraco no prefixo e nenhum ack sairia mais.
+
+        """
+        for delivery_tag in range(first, last + 1):
+            self._settle(delivery_tag, False)
+
+        self._schedule()
+
+    def _schedule(self):
+        # Uma recusa ou um `skip` também pode fechar o prefixo de acks que estavam esperando:
+        if self._pending >= self._batch_size:
+            self.flush()
+        elif self._pending and self._timeout is None and self._interval:
+            self._timeout = self._ioloop.call_later(self._interval / 1000.0, self._on_timeout)
+
+    def _settle(self, delivery_tag, acked):
+        if delivery_tag != self._settled + 1:
+            self._out_of_order[delivery_tag] = acked
+            return
+
+        self._advance(delivery_tag, acked)
+
+        out_of_order = self._out_of_order
+
+        while out_of_order and self._settled + 1 in out_of_order:
+            self._advance(self._settled + 1, out_of_order.pop(self._settled + 1))
+
+    def _advance(self, delivery_tag, acked):
+        self._settled = delivery_tag
+
+        if acked:
+            self._last_ack = delivery_tag
+            self._pending += 1
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.flush()
+
+    def _cancel_timeout(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def flush(self):
+        """Envia um único Basic.Ack cobrindo todas as mensagens processadas até agora."""
+        self._cancel_timeout()
+
+        if not self._pending or self._channel is None or not self._channel.is_open:
+            return
+
+        LOGGER.debug('Acknowledging %i messages up to %i', self._pending, self._last_ack)
+
+        self._channel.basic_ack(self._last_ack, multiple=self._pending > 1)
+        self._pending = 0
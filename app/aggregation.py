@@ -0,0 +1,375 @@
+import logging
+import time
+
+from array import array
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from app.utils import SENSOR_TYPES
+from app.handlers import message_type
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RingTable(object):
+    """Agregados por chave em colunas `array` contíguas, sem dicts de listas: cada chave
+    ocupa uma linha, com um anel de `slots` intervalos de tempo (epoch, count, sum, min,
+    max) e, opcionalmente, um anel com as últimas `samples` leituras (float32) para os
+    percentis.
+
+    Uma linha custa `slots * 32 + samples * 8 + 8` bytes, além da entrada no índice
+    chave -> linha. As linhas de chaves inativas são liberadas e reaproveitadas.
+
+    """
+
+    def __init__(self, slots, samples=0):
+        """
+        :param int slots: Intervalos no anel de cada chave (janela / passo)
+        :param int samples: Leituras guardadas por chave para os percentis (0 = sem percentis)
+
+        """
+        self.slots = slots
+        self.samples = samples
+
+        self._index = {}
+        self._keys = []
+        self._free = []
+
+        self._last_seen = array('I')
+        self._epoch = array('I')
+        self._count = array('I')
+        self._sum = array('d')
+        self._min = array('d')
+        self._max = array('d')
+
+        self._sample_pos = array('I')
+        self._sample_epoch = array('I')
+        self._sample_value = array('f')
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def rows(self):
+        return len(self._keys)
+
+    def _allocate(self, key):
+        slots = self.slots
+        samples = self.samples
+
+        if self._free:
+            row = self._free.pop()
+            self._keys[row] = key
+
+            start = row * slots
+            self._epoch[start:start + slots] = array('I', bytes(4 * slots))
+
+            if samples:
+                start = row * samples
+                self._sample_epoch[start:start + samples] = array('I', bytes(4 * samples))
+                self._sample_pos[row] = 0
+        else:
+            row = len(self._keys)
+            self._keys.append(key)
+            self._last_seen.append(0)
+
+            for column in (self._epoch, self._count):
+                column.frombytes(bytes(4 * slots))
+
+            for column in (self._sum, self._min, self._max):
+                column.frombytes(bytes(8 * slots))
+
+            if samples:
+                self._sample_pos.append(0)
+                self._sample_epoch.frombytes(bytes(4 * samples))
+                self._sample_value.frombytes(bytes(4 * samples))
+
+        self._index[key] = row
+
+        return row
+
+    def update(self, key, value, epoch):
+        row = self._index.get(key)
+
+        if row is None:
+            row = self._allocate(key)
+
+        i = row * self.slots + epoch % self.slots
+
+        if self._epoch[i] != epoch:
+            # O intervalo do anel guardava um epoch antigo; recomeça nele:
+            self._epoch[i] = epoch
+            self._count[i] = 1
+            self._sum[i] = value
+            self._min[i] = value
+            self._max[i] = value
+        else:
+            self._count[i] += 1
+            self._sum[i] += value
+
+            if value < self._min[i]:
+                self._min[i] = value
+            elif value > self._max[i]:
+                self._max[i] = value
+
+        self._last_seen[row] = epoch
+
+        samples = self.samples
+
+        if samples:
+            pos = self._sample_pos[row]
+            j = row * samples + pos
+            self._sample_value[j] = value
+            self._sample_epoch[j] = epoch
+            self._sample_pos[row] = pos + 1 if pos + 1 < samples else 0
+
+    def rollup(self, row, first, last):
+        """Agregado da linha nos epochs [first, last]; None se não houve leituras."""
+        count = 0
+        total = 0.0
+        low = high = None
+        start = row * self.slots
+
+        for i in range(start, start + self.slots):
+            if not first <= self._epoch[i] <= last:
+                continue
+
+            count += self._count[i]
+            total += self._sum[i]
+
+            if low is None or self._min[i] < low:
+                low = self._min[i]
+
+            if high is None or self._max[i] > high:
+                high = self._max[i]
+
+        if not count:
+            return None
+
+        rollup = dict(key=self._keys[row], count=count, mean=total / count, min=low, max=high)
+
+        if self.samples:
+            start = row * self.samples
+            values = sorted(self._sample_value[j] for j in range(start, start + self.samples)
+                            if first <= self._sample_epoch[j] <= last)
+
+            for name, p in (('p50', 50), ('p95', 95), ('p99', 99)):
+                rollup[name] = values[max(0, -(-p * len(values) // 100) - 1)]
+
+        return rollup
+
+    def scan(self, first, last, evict_before):
+        """Gera os agregados das linhas com leituras em [first, last] e libera as linhas sem
+        leituras desde `evict_before`.
+
+        """
+        for row, key in enumerate(self._keys):
+            if key is None:
+                continue
+
+            last_seen = self._last_seen[row]
+
+            if last_seen < evict_before:
+                del self._index[key]
+                self._keys[row] = None
+                self._free.append(row)
+                continue
+
+            if last_seen >= first:
+                rollup = self.rollup(row, first, last)
+
+                if rollup is not None:
+                    yield rollup
+
+    def nbytes(self):
+        """Bytes ocupados pelas colunas (sem o índice de chaves)."""
+        columns = (self._last_seen, self._epoch, self._count, self._sum, self._min, self._max,
+                   self._sample_pos, self._sample_epoch, self._sample_value)
+
+        return sum(column.itemsize * len(column) for column in columns)
+
+
+class WindowAggregator(object):
+    """Agregação em janelas das leituras dos sensores, por tipo e por sensor: count, mean,
+    min, max e percentis (p50, p95, p99).
+
+    As leituras são agregadas no caminho do consumo, pelo horário de chegada, em intervalos
+    de `step` segundos. A cada `step` segundos um timer do IOLoop emite a janela dos últimos
+    `window` segundos: com `step` igual a `window` as janelas são tumbling, com `step` menor
+    são sliding. Os agregados saem pelo `publish`, normalmente o `Server.publish_message`,
+    em mensagens de até `chunk_size` agregados:
+
+        {'type': 'rollup', 'scope': 'sensor', 'start': ..., 'end': ..., 'rollups': [...]}
+
+    Os percentis são calculados sobre as últimas `type_samples`/`sensor_samples` leituras
+    de cada chave que caem dentro da janela.
+
+    """
+
+    def __init__(self, publish, window=60, step=None, sensor_key='sensor_id', sensor_samples=8,
+                 type_samples=4096, idle_windows=2, chunk_size=1000, scan_batch=20000, clock=time.time):
+        """
+        :param callable publish: Recebe cada mensagem de agregados (p.e. `Server.publish_message`)
+        :param float window: Tamanho da janela, em segundos
+        :param float step: Intervalo entre emissões, em segundos (padrão: `window`, tumbling)
+        :param str sensor_key: Campo da mensagem que identifica o sensor, estável entre as
+            leituras dele, como o `sensor_id` dos Clients (None = sem agregados por sensor).
+            Leituras sem o campo entram só nos agregados por tipo
+        :param int sensor_samples: Leituras guardadas por sensor para os percentis
+        :param int type_samples: Leituras guardadas por tipo para os percentis
+        :param int idle_windows: Janelas sem leituras até o sensor ser descartado
+        :param int chunk_size: Agregados por mensagem publicada
+        :param int scan_batch: Agregados de sensores gerados por iteração do IOLoop durante a emissão
+
+        """
+        step = step or window
+        slots = int(round(window / step))
+
+        if slots < 1 or abs(slots * step - window) > 1e-9 * window:
+            raise ValueError('window precisa ser múltiplo de step')
+
+        self._publish = publish
+        self._window = window
+        self._step = step
+        self._sensor_key = sensor_key
+        self._idle_epochs = idle_windows * slots
+        self._chunk_size = chunk_size
+        self._scan_batch = scan_batch
+        self._clock = clock
+        self._origin = clock()
+
+        self._types = RingTable(slots, type_samples)
+        self._sensors = RingTable(slots, sensor_samples) if sensor_key else None
+
+        self._timer = None
+        self._ioloop = None
+        self._emitting = None
+
+        self.updates = 0
+        self.invalid = 0
+        self.emitted = 0
+        self.skipped = 0
+
+    def _epoch(self, now):
+        # Epochs começam em 1: o 0 marca um intervalo do anel ainda não usado.
+        return int((now - self._origin) // self._step) + 1
+
+    def __call__(self, message):
+        """Observador das leituras: `HandlerRegistry.observe(aggregator)`."""
+        value = message.get('message')
+
+        if value.__class__ not in (int, float):
+            self.invalid += 1
+            return
+
+        epoch = self._epoch(self._clock())
+        self._types.update(message_type(message), value, epoch)
+
+        if self._sensors is not None:
+            key = message.get(self._sensor_key)
+
+            if key is not None:
+                self._sensors.update(key, value, epoch)
+
+        self.updates += 1
+
+    def attach(self, handlers, types=None):
+        """Registra o agregador como observador dos tipos informados (padrão: todos os
+        sensores), sem ocupar o lugar dos handlers nem do curinga.
+
+        """
+        handlers.observe(self, types or SENSOR_TYPES)
+
+    def start(self, ioloop=None):
+        """Inicia o timer de emissão no IOLoop, alinhado ao fim de cada intervalo."""
+        self._ioloop = ioloop or IOLoop.current()
+        # O PeriodicCallback usa o IOLoop corrente; é criado já dentro do IOLoop informado.
+        self._ioloop.add_callback(self._start_timer)
+
+    def _start_timer(self):
+        self._origin = self._clock()
+        self._timer = PeriodicCallback(self.emit, self._step * 1000)
+        self._timer.start()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def emit(self):
+        """Emite a janela que terminou no último intervalo completo. A varredura dos sensores
+        é feita em partes, `scan_batch` agregados por iteração do IOLoop, para não travar o consumo.
+
+        """
+        if self._emitting is not None:
+            # A emissão anterior ainda não terminou de varrer os sensores:
+            self.skipped += 1
+            LOGGER.warning('Emissão de agregados atrasada; pulando a janela')
+            return
+
+        last = self._epoch(self._clock()) - 1
+
+        if last < 1:
+            return
+
+        first = max(1, last - self._types.slots + 1)
+        evict_before = last - self._idle_epochs + 1
+        start = self._origin + (first - 1) * self._step
+        end = self._origin + last * self._step
+
+        self._publish_rollups('type', start, end, list(self._types.scan(first, last, evict_before)))
+
+        if self._sensors is not None:
+            self._emitting = (self._sensors.scan(first, last, evict_before), start, end)
+            self._continue_emit()
+
+    def _continue_emit(self):
+        scan, start, end = self._emitting
+        chunk = []
+        rows = 0
+
+        for rollup in scan:
+            chunk.append(rollup)
+
+            if len(chunk) >= self._chunk_size:
+                self._publish_rollups('sensor', start, end, chunk)
+                chunk = []
+
+            rows += 1
+
+            if rows >= self._scan_batch:
+                break
+        else:
+            self._publish_rollups('sensor', start, end, chunk)
+            self._emitting = None
+            return
+
+        self._publish_rollups('sensor', start, end, chunk)
+        (self._ioloop or IOLoop.current()).add_callback(self._continue_emit)
+
+    def flush(self):
+        """Termina na hora a emissão em andamento (p.e. antes de parar o Servidor)."""
+        while self._emitting is not None:
+            self._continue_emit()
+
+    def _publish_rollups(self, scope, start, end, rollups):
+        if not rollups:
+            return
+
+        self._publish({'type': 'rollup', 'scope': scope, 'window': self._window, 'step': self._step,
+                       'start': start, 'end': end, 'rollups': rollups})
+        self.emitted += len(rollups)
+
+    @property
+    def stats(self):
+        sensors = self._sensors
+
+        return dict(
+            updates=self.updates,
+            invalid=self.invalid,
+            emitted=self.emitted,
+            skipped=self.skipped,
+            types=len(self._types),
+            sensors=len(sensors) if sensors is not None else 0,
+            state_bytes=self._types.nbytes() + (sensors.nbytes() if sensors is not None else 0),
+        )
@@ -0,0 +1,242 @@
+import logging
+import random
+import asyncio
+import itertools
+
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from app.utils import EXCHANGE_SENDER_TO_CORE, EXCHANGE_TYPE, ROUTING_KEY, URL
+from app.utils import pika, uuid4, SENSOR_TYPES
+from app.codec import get_codec
+from app.routing import ShardRouting
+
+LOGGER = logging.getLogger(__name__)
+
+
+class VirtualSensor(object):
+    """Um sensor simulado: gera uma leitura do seu tipo a cada `interval` segundos."""
+    __slots__ = ('agent_type', 'sensor_id', 'interval', 'reading', 'next_at', 'timer', 'sent')
+
+    def __init__(self, agent_type, sensor_id, interval, reading):
+        self.agent_type = agent_type
+        self.sensor_id = sensor_id
+        self.interval = interval
+        self.reading = reading
+        self.next_at = 0.0
+        self.timer = None
+        self.sent = 0
+
+    def factory(self, _id):
+        if self.sensor_id is None:
+            return {'_id': _id, 'type': self.agent_type, 'message': self.reading()}
+
+        return {'_id': _id, 'type': self.agent_type, 'sensor_id': self.sensor_id, 'message': self.reading()}
+
+
+class AsyncClient(object):
+    """Cliente publicador baseado em asyncio, que simula milhares de sensores em um único
+    processo. Cada sensor mantém o seu próprio intervalo, como o `Client`, mas todos
+    compartilham uma conexão e um pequeno conjunto de canais.
+
+        client = AsyncClient(channels=4)
+        client.add_sensors('temperatura', 1000)
+        client.add_sensors('humidade', 1000)
+
+        asyncio.run(client.run())
+
+    """
+
+    def __init__(self, url=URL, channels=4, connection_class=AsyncioConnection, codec='json', client_id=None,
+                 shards=None):
+        """
+        :param str url: The AMQP url to connect with
+        :param int channels: Quantidade de canais compartilhados pelos sensores
+        :param type connection_class: Classe da conexão, compatível com o AsyncioConnection
+        :param str codec: Codificação das mensagens (json, struct ou msgpack)
+        :param str client_id: Prefixo do `sensor_id` dos sensores virtuais,
+            `<client_id>-<tipo>-<n>` (padrão: sorteado por processo). O codec struct não tem o
+            campo e não o envia
+        :param int shards: Publica no exchange topic EXCHANGE_SENSORS com a routing key
+            `sensor.<tipo>.<shard>`, como o `Client` (`app.routing.ShardRouting`); o Servidor
+            deve usar o mesmo valor
+
+        """
+        self._url = url
+        self._channel_count = max(1, channels)
+        self._connection_class = connection_class
+        self._codec = get_codec(codec)
+        self._client_id = client_id or uuid4().hex[:12]
+        self._properties = pika.BasicProperties(content_type=self._codec.content_type)
+        self._type_properties = {}
+        self._exchange = EXCHANGE_SENDER_TO_CORE
+        self._exchange_type = EXCHANGE_TYPE
+        self._routing_key = ROUTING_KEY
+        self._routing = None
+
+        if shards:
+            self._routing = ShardRouting(shards)
+            self._exchange = self._routing.exchange
+            self._exchange_type = self._routing.exchange_type
+
+        self._loop = None
+        self._connection = None
+        self._channels = []
+        self._next_channel = None
+        self._closed = None
+        self._closing = False
+
+        self._sensors = []
+        self._sent = 0
+        self._dropped = 0
+
+    def add_sensors(self, agent_type, count=1):
+        """Adiciona `count` sensores virtuais do tipo informado."""
+        agent_type = agent_type.lower()
+
+        if agent_type not in SENSOR_TYPES:
+            raise ValueError("Tipo de Agente desconhecido: {}".format(agent_type))
+
+        interval, reading = SENSOR_TYPES[agent_type]
+
+        # O `type` nas propriedades deixa o Servidor rotear sem decodificar o corpo:
+        self._type_properties[agent_type] = pika.BasicProperties(content_type=self._codec.content_type,
+                                                                 type=agent_type)
+
+        # Cada sensor virtual tem o seu `sensor_id`, estável entre as leituras dele:
+        first = sum(1 for sensor in self._sensors if sensor.agent_type == agent_type)
+        struct = self._codec.name == 'struct'
+
+        self._sensors.extend(
+            VirtualSensor(agent_type, None if struct else '%s-%s-%i' % (self._client_id, agent_type, n), interval,
+                          reading)
+            for n in range(first, first + count))
+
+    def _callback_future(self):
+        """Cria uma future do asyncio e a callback do pika que a resolve."""
+        future = self._loop.create_future()
+
+        def callback(*args):
+            if not future.done():
+                future.set_result(args[0] if args else None)
+
+        return future, callback
+
+    async def connect(self):
+        """Abre a conexão e os canais, declarando o exchange em cada um."""
+        self._loop = asyncio.get_running_loop()
+        self._closed = self._loop.create_future()
+
+        opened, on_open = self._callback_future()
+
+        def on_open_error(connection, error):
+            if not opened.done():
+                opened.set_exception(error if isinstance(error, Exception) else Exception(error))
+
+        LOGGER.info('Abrindo Conexão do Cliente assíncrono com a URL %s', self._url)
+
+        self._connection = self._connection_class(
+            pika.URLParameters(self._url),
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._loop)
+
+        await opened
+
+        for _ in range(self._channel_count):
+            channel_opened, on_channel_open = self._callback_future()
+            self._connection.channel(on_open_callback=on_channel_open)
+            channel = await channel_opened
+
+            declared, on_declareok = self._callback_future()
+            channel.exchange_declare(exchange=self._exchange, exchange_type=self._exchange_type, durable=True,
+                                     callback=on_declareok)
+            await declared
+
+            self._channels.append(channel)
+
+        self._next_channel = itertools.cycle(self._channels)
+
+        LOGGER.info('Cliente assíncrono conectado com %i canais', len(self._channels))
+
+    def _on_connection_closed(self, connection, reason):
+        if self._closing:
+            LOGGER.info('Conexão do Cliente assíncrono fechada')
+        else:
+            LOGGER.warning('Conexão do Cliente assíncrono fechada: %s', reason)
+
+        self._channels = []
+        self._next_channel = None
+
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(reason)
+
+    def start(self):
+        """Agenda a primeira leitura de cada sensor em um ponto aleatório do seu intervalo,
+        para que os sensores do mesmo tipo não publiquem todos juntos.
+
+        """
+        now = self._loop.time()
+
+        for sensor in self._sensors:
+            sensor.next_at = now + random.uniform(0, sensor.interval)
+            sensor.timer = self._loop.call_at(sensor.next_at, self._tick, sensor)
+
+    def _tick(self, sensor):
+        self.push(sensor.factory(str(uuid4())))
+        sensor.sent += 1
+
+        # O próximo horário é calculado a partir do anterior, sem acumular atraso:
+        sensor.next_at += sensor.interval
+        sensor.timer = self._loop.call_at(sensor.next_at, self._tick, sensor)
+
+    def push(self, message):
+        """Publica a mensagem no próximo canal aberto, em round-robin."""
+        channel = next(self._next_channel) if self._next_channel is not None else None
+
+        if channel is None or not channel.is_open:
+            self._dropped += 1
+            return False
+
+        properties = self._type_properties.get(message.get('type'), self._properties)
+
+        channel.basic_publish(exchange=self._exchange, routing_key=self._route(message),
+                              body=self._codec.encode(message), properties=properties)
+        self._sent += 1
+
+        return True
+
+    def _route(self, message):
+        """Routing key da mensagem: a fixa ou, com shards, a do tipo e do `_id` da leitura."""
+        if self._routing is None:
+            return self._routing_key
+
+        return self._routing.routing_key(message.get('type'), message.get('_id', ''))
+
+    async def run(self, duration=None):
+        """Conecta, inicia os sensores e publica até `duration` segundos (ou até a conexão cair)."""
+        await self.connect()
+        self.start()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self._closed), duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await self.close()
+
+    async def close(self):
+        self._closing = True
+
+        for sensor in self._sensors:
+            if sensor.timer is not None:
+                sensor.timer.cancel()
+                sensor.timer = None
+
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+            await self._closed
+
+    @property
+    def stats(self):
+        return dict(sensors=len(self._sensors), sent=self._sent, dropped=self._dropped)
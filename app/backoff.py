@@ -0,0 +1,40 @@
+import random
+
+
+class Backoff(object):
+    """Atrasos de reconexão com backoff exponencial e jitter: a tentativa `n` espera entre
+    metade e o total de `min(maximum, initial * multiplier ** n)` segundos. A primeira
+    tentativa sai em dezenas de milissegundos e, com o jitter, vários processos derrubados
+    juntos não reconectam todos no mesmo instante.
+
+    """
+
+    def __init__(self, initial=0.02, maximum=5.0, multiplier=2.0, jitter=True, random=random.random):
+        """
+        :param float initial: Atraso, em segundos, da primeira tentativa
+        :param float maximum: Maior atraso, em segundos
+        :param float multiplier: Crescimento do atraso a cada tentativa que falha
+        :param bool jitter: Sorteia o atraso entre metade e o total do limite da tentativa
+
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self._random = random
+
+        self.attempts = 0
+
+    def next_delay(self):
+        """O atraso da próxima tentativa, em segundos."""
+        cap = min(self.maximum, self.initial * self.multiplier ** self.attempts)
+        self.attempts += 1
+
+        if not self.jitter:
+            return cap
+
+        return cap / 2.0 * (1.0 + self._random())
+
+    def reset(self):
+        """Chamado quando a conexão abre: a próxima queda recomeça do atraso inicial."""
+        self.attempts = 0
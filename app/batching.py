@@ -0,0 +1,113 @@
+import time
+
+# Valor do `type` (BasicProperties) das mensagens que carregam um envelope de leituras:
+ENVELOPE_TYPE = 'sensor.batch'
+
+
+class Batcher(object):
+    """Acumula leituras no lado do sensor e as entrega como um único envelope quando chega a
+    `max_records` leituras ou quando a mais antiga passa de `max_age` segundos:
+
+        {'count': 3, 'first_at': 1571234567.1, 'last_at': 1571234567.9, 'records': [...]}
+
+    `first_at` e `last_at` são os horários em que a primeira e a última leitura entraram no lote.
+
+    """
+
+    def __init__(self, max_records=100, max_age=None, clock=time.time):
+        """
+        :param int max_records: Quantidade de leituras por envelope
+        :param float max_age: Tempo máximo, em segundos, que uma leitura espera no lote
+            (None = só pelo tamanho)
+        :param callable clock: Relógio dos horários do envelope
+
+        """
+        if max_records < 1:
+            raise ValueError('max_records precisa ser maior que zero')
+
+        self._max_records = max_records
+        self._max_age = max_age
+        self._clock = clock
+
+        self._records = []
+        self._first_at = None
+        self._last_at = None
+
+        self.envelopes = 0
+        self.records = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def deadline(self):
+        """Horário, no `clock`, em que o lote atual expira; None se estiver vazio ou sem `max_age`."""
+        if self._first_at is None or self._max_age is None:
+            return None
+
+        return self._first_at + self._max_age
+
+    def add(self, record):
+        """Adiciona a leitura ao lote; retorna o envelope se o lote fechou, senão None."""
+        now = self._clock()
+
+        if self._first_at is None:
+            self._first_at = now
+
+        self._last_at = now
+        self._records.append(record)
+
+        if len(self._records) >= self._max_records or self.expired(now):
+            return self.flush()
+
+        return None
+
+    def expired(self, now=None):
+        deadline = self.deadline
+
+        if deadline is None:
+            return False
+
+        return (self._clock() if now is None else now) >= deadline
+
+    def flush(self):
+        """Fecha o lote atual e retorna o envelope; None se não houver leituras."""
+        if not self._records:
+            return None
+
+        envelope = {'count': len(self._records), 'first_at': self._first_at, 'last_at': self._last_at,
+                    'records': self._records}
+
+        self._records = []
+        self._first_at = None
+        self._last_at = None
+
+        self.envelopes += 1
+        self.records += envelope['count']
+
+        return envelope
+
+    @property
+    def stats(self):
+        return dict(envelopes=self.envelopes, records=self.records, pending=len(self._records),
+                    mean_size=self.records / self.envelopes if self.envelopes else 0.0)
+
+
+def unpack(envelope):
+    """Leituras de um envelope decodificado.
+
+    :raises ValueError: o envelope não tem a lista `records` ou `count` não confere
+
+    """
+    try:
+        records = envelope['records']
+    except (KeyError, TypeError):
+        raise ValueError('Envelope sem records')
+
+    if not isinstance(records, list):
+        raise ValueError('records do envelope não é uma lista')
+
+    if envelope.get('count', len(records)) != len(records):
+        raise ValueError('Envelope com %s records, esperado %s' % (len(records), envelope.get('count')))
+
+    return records
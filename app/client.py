@@ -1,80 +1,236 @@
-import traceback
-import random
+import logging
 import time
 
-from app.utils import EXCHANGE_SENDER_TO_CORE, ROUTING_KEY, URL
-from app.utils import pika, json, uuid4, LOGGER
+from app.utils import EXCHANGE_SENDER_TO_CORE, EXCHANGE_TYPE, ROUTING_KEY, URL
+from app.utils import pika, uuid4, SENSOR_TYPES
+from app.codec import get_codec
+from app.compression import Compressor
+from app.batching import Batcher, ENVELOPE_TYPE
+from app.spool import Spool, SpoolDrain
+from app.routing import ShardRouting
+
+LOGGER = logging.getLogger(__name__)
 
 
 class Client(object):
-    def __init__(self, url=URL, agent_type='TEMPERATURA', *args, **kwargs):
-        self._type = self.__choose_type(agent_type, *args, **kwargs)
-        self._conn = self.__conn(url, *args, **kwargs)
+    def __init__(self, url=URL, agent_type='TEMPERATURA', connection_class=pika.BlockingConnection, codec='json',
+                 compression=None, compression_threshold=1024, batch_size=1, batch_age=None, spool=None,
+                 spool_options=None, shards=None, sensor_id=None, *args, **kwargs):
+        """
+        :param str spool: Diretório do spool em disco. Com ele `push` só grava a mensagem no
+            spool e uma thread a publica com confirmação, reconectando com backoff; a conexão
+            não precisa estar disponível para o Client funcionar
+        :param dict spool_options: Opções do Spool (segment_size, max_segments, sync)
+        :param int shards: Publica no exchange topic EXCHANGE_SENSORS com a routing key
+            `sensor.<tipo>.<shard>`, escolhendo o shard pelo `_id` da leitura
+            (`app.routing.ShardRouting`); o Servidor deve usar o mesmo valor
+        :param str sensor_id: Identificador do sensor, enviado em todas as leituras no campo
+            `sensor_id` e usado nos agregados por sensor do Servidor (padrão: `<tipo>-<hex>`,
+            sorteado por processo). O codec struct não tem o campo e não o envia
+
+        """
+        self._codec = get_codec(codec)
+        self._type = self.__choose_type(agent_type, sensor_id, *args, **kwargs)
+        self._compressor = None
+        self._batcher = None
+
+        # Com batch_size > 1 as leituras seguem em envelopes, marcados no `type` da mensagem;
+        # sem lotes o `type` é o do sensor, para o Servidor rotear sem decodificar o corpo:
+        message_type = self._agent_type
+
+        if batch_size > 1:
+            if self._codec.name == 'struct':
+                raise ValueError('O codec struct não codifica envelopes; use json ou msgpack')
+
+            self._batcher = Batcher(batch_size, batch_age)
+            message_type = ENVELOPE_TYPE
+
+        self._properties = pika.BasicProperties(content_type=self._codec.content_type, type=message_type)
+
+        if compression is not None:
+            self._compressor = Compressor(compression, compression_threshold)
+            self._compressed_properties = pika.BasicProperties(
+                content_type=self._codec.content_type, content_encoding=self._compressor.content_encoding,
+                type=message_type)
+        self._connection_class = connection_class
+        self._url = url
         self._exchange = EXCHANGE_SENDER_TO_CORE
+        self._exchange_type = EXCHANGE_TYPE
         self._routing_key = ROUTING_KEY
+        self._routing = None
+
+        if shards:
+            self._routing = ShardRouting(shards)
+            self._exchange = self._routing.exchange
+            self._exchange_type = self._routing.exchange_type
+
+        self._spool = None
+        self._drain = None
+
+        if spool is not None:
+            self._conn = self._channel = None
+
+            self._spool = Spool(spool, **(spool_options or {}))
+            self._drain = SpoolDrain(self._spool, self._connect_drain, self._publish_spooled)
+            self._drain.start()
+            return
+
+        self._conn = self.__conn(url, *args, **kwargs)
         self._channel = self._conn.channel()
 
-        self._channel.exchange_declare(exchange=self._exchange, durable=True)
+        self._channel.exchange_declare(exchange=self._exchange, exchange_type=self._exchange_type, durable=True)
 
 
     @classmethod
     def args(cls):
         from argparse import ArgumentParser
 
+        from app.logconfig import add_arguments
+
         parser = ArgumentParser()
         
         parser.add_argument("-t", "--type", default='temperatura', 
-                            help="Tipo do cliente: [temperatura | humidade | luminosidade | dioxido] ")
-        
-        return parser.parse_args()
+                            help="Tipo do cliente: [temperatura | humidade | luminosidade | dioxido | todos] ")
+
+        parser.add_argument("-s", "--sensors", type=int, default=1,
+                            help="Sensores virtuais de cada tipo, simulados em um único processo com asyncio")
+
+        parser.add_argument("-c", "--channels", type=int, default=4,
+                            help="Canais compartilhados pelos sensores virtuais")
+
+        parser.add_argument("--codec", default='json',
+                            help="Codificação das mensagens: [json | struct | msgpack]")
+
+        parser.add_argument("--compression", default=None,
+                            help="Compressão das mensagens grandes: [zlib | lzma]")
+
+        parser.add_argument("--batch-size", type=int, default=1,
+                            help="Leituras por mensagem; acima de 1 as leituras seguem em envelopes")
+
+        parser.add_argument("--batch-age", type=float, default=None,
+                            help="Tempo máximo, em segundos, que uma leitura espera no envelope")
+
+        parser.add_argument("--sensor-id", default=None,
+                            help="Identificador estável do sensor nas leituras; com --sensors, o prefixo "
+                                 "dos sensores virtuais (padrão: sorteado a cada execução)")
+
+        parser.add_argument("--shards", type=int, default=None,
+                            help="Filas por tipo de sensor (sensor.<tipo>.<shard>); o mesmo valor do Servidor")
+
+        parser.add_argument("--spool", default=None,
+                            help="Diretório do spool em disco: as leituras sobrevivem às quedas do broker")
+
+        parser.add_argument("--bench", action='store_true',
+                            help="Benchmark fim a fim contra um broker falso em processo")
+
+        parser.add_argument("--rate", type=float, default=None,
+                            help="Benchmark: mensagens por segundo (padrão: o mais rápido possível)")
+
+        parser.add_argument("--duration", type=float, default=10,
+                            help="Benchmark: duração da publicação, em segundos")
+
+        parser.add_argument("--size", type=int, default=None,
+                            help="Benchmark: tamanho aproximado de cada mensagem, em bytes")
+
+        parser.add_argument("--output", default=None,
+                            help="Benchmark: arquivo JSON com o resultado (padrão: stdout)")
+
+        add_arguments(parser)
+
+        args = parser.parse_args()
+
+        if args.bench and args.codec == 'struct':
+            # O benchmark carimba `sent_at` (e `pad`, com --size) em cada leitura:
+            parser.error('--bench não funciona com --codec struct, que só codifica _id, type e message')
+
+        return args
 
     def __conn(self, url, *args, **kwargs):
-        return pika.BlockingConnection(pika.URLParameters(url=url))
+        return self._connection_class(pika.URLParameters(url=url))
+
+
+    def _connect_drain(self):
+        """Conexão e canal, com confirmação, da thread que publica o spool."""
+        connection = self.__conn(self._url)
+        channel = connection.channel()
+
+        channel.exchange_declare(exchange=self._exchange, exchange_type=self._exchange_type, durable=True)
+        channel.confirm_delivery()
 
+        return channel
+
+    def _publish_spooled(self, channel, body, compressed, routing_key=None):
+        # Com shards a routing key, a mesma do caminho sem spool, é gravada com o corpo. Um
+        # registro sem ela (gravado sem shards) fica com a fixa ou, com shards, com o shard
+        # do corpo inteiro.
+        if routing_key is None:
+            routing_key = self._routing_key if self._routing is None else self._routing.routing_key(self._agent_type, body)
+
+        channel.basic_publish(exchange=self._exchange, routing_key=routing_key, body=body,
+                              properties=self._compressed_properties if compressed else self._properties)
 
     def __disconn(self, *args, **kwags):
+        self.flush()
+
+        if self._drain is not None:
+            # O que não for publicado a tempo continua no spool para a próxima execução.
+            self._drain.stop(timeout=5)
+            self._spool.close()
+            return
+
         self._channel.close()
 
         if self._conn:
             self._conn.close()
 
+    def close(self):
+        self.__disconn()
+
+    @property
+    def stats(self):
+        stats = dict(compression=self._compressor.stats.as_dict() if self._compressor is not None else None,
+                     batching=self._batcher.stats if self._batcher is not None else None, spool=None)
+
+        if self._spool is not None:
+            stats['spool'] = dict(self._spool.stats, **self._drain.stats)
+
+        return stats
+
     
-    def __choose_type(self, agent_type, *args, **kwargs):
+    def __choose_type(self, agent_type, sensor_id=None, *args, **kwargs):
         # Colocando todos os caracteres em minúsculo:
         agent_type = agent_type.lower()
 
-        LOGGER.info("Tipo de Agente: {}".format(agent_type))
+        LOGGER.info('Tipo de Agente: %s', agent_type)
 
-        if agent_type == 'temperatura':
-            self._factory = lambda _id: {'_id': _id, 'type': agent_type, 'message': random.randint(32,35)} 
-            self._interval = 10
-            return
+        if agent_type not in SENSOR_TYPES:
+            raise ValueError("Tipo de Agente desconhecido: {}".format(agent_type))
 
-        if agent_type == 'humidade':
-            self._factory = lambda _id: {'_id': _id, 'type': agent_type, 'message': random.randint(11,15)} 
-            self._interval = 20
-            return
+        interval, reading = SENSOR_TYPES[agent_type]
 
-        if agent_type == 'luminosidade':
-            self._factory = lambda _id: {'_id': _id, 'type': agent_type, 'message': random.randint(0, 10)} 
-            self._interval = 5
-            return
+        self._agent_type = agent_type
+        self._sensor_id = sensor_id or '%s-%s' % (agent_type, uuid4().hex[:12])
 
-        if agent_type == 'dioxido':
-            self._factory = lambda _id: {'_id': _id, 'type': agent_type, 'message': random.randrange(0, 1)} 
-            self._interval = 30
-            return
+        if self._codec.name == 'struct':
+            # O layout fixo do StructCodec só tem _id, type e message:
+            self._factory = lambda _id: {'_id': _id, 'type': agent_type, 'message': reading()}
+        else:
+            sensor_id = self._sensor_id
+            self._factory = lambda _id: {'_id': _id, 'type': agent_type, 'sensor_id': sensor_id,
+                                         'message': reading()}
+
+        self._interval = interval
 
 
     def run(self, *args, **kwargs):
         try:
             
             while True:
-                LOGGER.info("Iniciando o intervalo de frequência: {}".format(self._interval))
+                LOGGER.debug('Iniciando o intervalo de frequência: %s', self._interval)
                 
-                time.sleep(self._interval)
+                self.__sleep(self._interval)
                 
-                LOGGER.info("Terminando o intervalo de frequência")
+                LOGGER.debug('Terminando o intervalo de frequência')
 
                 self.push(
                     self._factory( str(uuid4()) )
@@ -84,19 +240,86 @@ class Client(object):
             self.__disconn()
 
 
+    def __sleep(self, seconds):
+        """Dorme até a próxima leitura, acordando antes para enviar o envelope que expirar."""
+        wake_at = time.time() + seconds
+
+        while self._batcher is not None and self._batcher.deadline is not None \
+                and self._batcher.deadline < wake_at:
+            time.sleep(max(0.0, self._batcher.deadline - time.time()))
+            self.flush()
+
+        time.sleep(max(0.0, wake_at - time.time()))
+
+
     def push(self, message, *args, **kwargs):
-        LOGGER.info("Publicando: {}".format(message))
+        """Publica a leitura; no modo em lote ela entra no envelope atual, que é publicado
+        quando enche ou expira.
+
+        """
+        if self._batcher is None:
+            self._publish(message)
+            return
+
+        envelope = self._batcher.add(message)
+
+        if envelope is not None:
+            self._publish(envelope)
+
+
+    def flush(self):
+        """Publica o envelope em aberto, se houver."""
+        if self._batcher is None:
+            return
+
+        envelope = self._batcher.flush()
+
+        if envelope is not None:
+            self._publish(envelope)
+
+
+    def _route(self, message):
+        """Routing key da mensagem: a fixa ou, com shards, a do `_id` da leitura (de um
+        envelope, o da primeira leitura).
+
+        """
+        if self._routing is None:
+            return self._routing_key
+
+        record = message['records'][0] if self._batcher is not None else message
+
+        return self._routing.routing_key(self._agent_type, record.get('_id', ''))
+
+    def _publish(self, message):
+        LOGGER.debug('Publicando: %s', message)
 
         try:
+            body = self._codec.encode(message)
+            properties = self._properties
+            compressed = False
+
+            if self._compressor is not None:
+                body, content_encoding = self._compressor.compress(body)
+
+                if content_encoding is not None:
+                    properties = self._compressed_properties
+                    compressed = True
+
+            if self._spool is not None:
+                routing_key = self._route(message) if self._routing is not None else None
+
+                if not self._spool.append(body, compressed, routing_key):
+                    LOGGER.warning('Spool cheio; leitura descartada')
+                return
 
             self._channel.basic_publish(
                 exchange=self._exchange, 
-                routing_key=self._routing_key, 
-                body=json.dumps(message)
+                routing_key=self._route(message), 
+                body=body,
+                properties=properties
             )
         
-        except Exception as e:
-            print(repr(e))
-            traceback.print_exc()
-            raise e
+        except Exception:
+            LOGGER.exception('Erro ao publicar a mensagem')
+            raise
        
@@ -0,0 +1,155 @@
+import struct
+
+from app.utils import json
+
+try:
+    import msgpack
+except ImportError:  # msgpack é opcional
+    msgpack = None
+
+
+class JSONCodec(object):
+    """Codec padrão: JSON em UTF-8."""
+    name = 'json'
+    content_type = 'application/json'
+
+    def __init__(self):
+        self._encode = json.JSONEncoder(separators=(',', ':')).encode
+        self._decode = json.loads
+
+    def encode(self, message):
+        return self._encode(message).encode('utf-8')
+
+    def decode(self, body):
+        return self._decode(body)
+
+    def wrap(self, body, _id):
+        """`{"data": <body>, "_id": _id}` montado em volta de um corpo já codificado em JSON,
+        sem decodificá-lo; o `_id` é um UUID e dispensa escape.
+
+        """
+        return b''.join((b'{"data":', body, b',"_id":"', _id.encode('ascii'), b'"}'))
+
+
+class StructCodec(object):
+    """Codec binário de layout fixo para as leituras dos sensores, com 21 bytes por mensagem:
+
+        _id      16 bytes   UUID em binário
+        type      1 byte    código do tipo (SENSOR_TYPE_CODES)
+        message   4 bytes   inteiro com sinal, big-endian
+
+    Só aceita mensagens com exatamente esses três campos; qualquer outra levanta ValueError.
+
+    """
+    name = 'struct'
+    content_type = 'application/x-sensor-struct'
+
+    # A posição de cada tipo é o código dele no fio; novos tipos entram apenas no final.
+    SENSOR_TYPE_CODES = ('temperatura', 'humidade', 'luminosidade', 'dioxido')
+
+    FIELDS = frozenset(('_id', 'type', 'message'))
+
+    def __init__(self):
+        self._struct = struct.Struct('!16sBi')
+        self._codes = dict((name, code) for code, name in enumerate(self.SENSOR_TYPE_CODES))
+
+    def encode(self, message):
+        if message.keys() != self.FIELDS:
+            raise ValueError('StructCodec só codifica os campos %s' % sorted(self.FIELDS))
+
+        try:
+            # Mais barato que UUID(_id).bytes; a validação do formato fica no fromhex e no tamanho.
+            _id = bytes.fromhex(message['_id'].replace('-', ''))
+
+            if len(_id) != 16:
+                raise ValueError('_id não é um UUID: %s' % (message['_id'],))
+
+            return self._struct.pack(_id, self._codes[message['type']], message['message'])
+        except (KeyError, AttributeError, struct.error) as e:
+            raise ValueError('Mensagem não cabe no StructCodec: %r' % (e,))
+
+    def decode(self, body):
+        try:
+            _id, code, value = self._struct.unpack(body)
+            agent_type = self.SENSOR_TYPE_CODES[code]
+        except (struct.error, IndexError) as e:
+            raise ValueError('Corpo inválido para o StructCodec: %r' % (e,))
+
+        _id = _id.hex()
+
+        return {'_id': '%s-%s-%s-%s-%s' % (_id[:8], _id[8:12], _id[12:16], _id[16:20], _id[20:]),
+                'type': agent_type, 'message': value}
+
+
+class MsgpackCodec(object):
+    """Codec MessagePack. Depende do pacote opcional `msgpack`."""
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('O codec msgpack precisa do pacote msgpack: pip install msgpack')
+
+        self._packer = msgpack.Packer(use_bin_type=True)
+
+    def encode(self, message):
+        return self._packer.pack(message)
+
+    def decode(self, body):
+        return msgpack.unpackb(body, raw=False)
+
+    def wrap(self, body, _id):
+        """`{"data": <body>, "_id": _id}` montado em volta de um corpo já codificado em
+        MessagePack, sem decodificá-lo.
+
+        """
+        return b''.join((b'\x82\xa4data', body, b'\xa3_id', self._packer.pack(_id)))
+
+
+CODECS = (JSONCodec, StructCodec, MsgpackCodec)
+
+_by_name = dict((codec.name, codec) for codec in CODECS)
+_by_content_type = dict((codec.content_type, codec) for codec in CODECS)
+_instances = {}
+
+
+def _instance(codec_class):
+    if codec_class not in _instances:
+        _instances[codec_class] = codec_class()
+
+    return _instances[codec_class]
+
+
+def get_codec(name):
+    """Retorna o codec pelo nome (json, struct, msgpack) ou pelo content_type.
+
+    :raises ValueError: codec desconhecido
+    :raises ImportError: codec cuja dependência opcional não está instalada
+
+    """
+    codec_class = _by_name.get(name) or _by_content_type.get(name)
+
+    if codec_class is None:
+        raise ValueError('Codec desconhecido: %s' % (name,))
+
+    return _instance(codec_class)
+
+
+def available_codecs():
+    """Nomes dos codecs que podem ser usados neste ambiente."""
+    return [codec.name for codec in CODECS if codec is not MsgpackCodec or msgpack is not None]
+
+
+def decode(body, content_type=None):
+    """Decodifica o corpo pelo content_type da mensagem; sem content_type assume JSON, o
+    formato usado antes dos codecs existirem.
+
+    :raises ValueError: corpo inválido ou content_type desconhecido
+
+    """
+    codec_class = _by_content_type.get(content_type or JSONCodec.content_type)
+
+    if codec_class is None:
+        raise ValueError('content_type sem codec: %s' % (content_type,))
+
+    return _instance(codec_class).decode(body)
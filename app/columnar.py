@@ -0,0 +1,123 @@
+import time
+
+from array import array
+
+from app.codec import StructCodec
+from app.handlers import message_type, normalize_type
+
+try:
+    import numpy
+except ImportError:  # numpy é opcional
+    numpy = None
+
+# Código numérico de cada tipo de sensor nas colunas, o mesmo do StructCodec:
+TYPE_CODES = dict((name, code) for code, name in enumerate(StructCodec.SENSOR_TYPE_CODES))
+
+
+class ColumnBatch(object):
+    """Lote de leituras em colunas NumPy, entregue ao handler em lote do Consumer:
+
+        types       uint8    código do tipo (TYPE_CODES / StructCodec.SENSOR_TYPE_CODES)
+        values      float64  valor da leitura (`message`)
+        timestamps  float64  horário de chegada da entrega (time.time())
+        ids         list     `_id` de cada leitura
+
+    As colunas são criadas sem cópia a partir dos buffers acumulados pelo `BatchCollector`,
+    que começa buffers novos a cada lote.
+
+    """
+    __slots__ = ('types', 'values', 'timestamps', 'ids')
+
+    TYPE_NAMES = StructCodec.SENSOR_TYPE_CODES
+
+    def __init__(self, types, values, timestamps, ids):
+        self.types = types
+        self.values = values
+        self.timestamps = timestamps
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.values)
+
+    def mask(self, agent_type):
+        """Máscara booleana das leituras do tipo, p.e. `batch.values[batch.mask('temperatura')]`."""
+        return self.types == TYPE_CODES[normalize_type(agent_type)]
+
+
+class BatchCollector(object):
+    """Acumula as leituras de várias entregas em colunas (`array`, convertidas para NumPy
+    sem cópia ao fechar o lote) junto com as delivery tags delas.
+
+    """
+
+    def __init__(self, size=1024):
+        """
+        :param int size: Leituras por lote
+        :raises ImportError: numpy não está instalado
+
+        """
+        if numpy is None:
+            raise ImportError('O handler em lote precisa do pacote numpy: pip install numpy')
+
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        """Descarta o lote em aberto (p.e. quando o canal das entregas fecha)."""
+        self._types = array('B')
+        self._values = array('d')
+        self._timestamps = array('d')
+        self._ids = []
+        self.delivery_tags = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, delivery_tag, records):
+        """Adiciona as leituras de uma entrega. Retorna False, sem adicionar nada, se alguma
+        leitura não for numérica ou for de um tipo sem código; essa entrega segue pelos
+        handlers comuns.
+
+        """
+        codes = TYPE_CODES
+        converted = []
+
+        for record in records:
+            try:
+                code = codes[message_type(record)]
+                value = record['message']
+            except (KeyError, TypeError):
+                return False
+
+            if value.__class__ not in (int, float):
+                return False
+
+            converted.append((code, value, record.get('_id')))
+
+        now = time.time()
+
+        for code, value, _id in converted:
+            self._types.append(code)
+            self._values.append(value)
+            self._timestamps.append(now)
+            self._ids.append(_id)
+
+        self.delivery_tags.append(delivery_tag)
+
+        return True
+
+    @property
+    def full(self):
+        return len(self._values) >= self.size
+
+    def take(self):
+        """Fecha o lote: retorna (ColumnBatch, delivery tags) e começa um novo."""
+        batch = ColumnBatch(numpy.frombuffer(self._types, dtype=numpy.uint8),
+                            numpy.frombuffer(self._values, dtype=numpy.float64),
+                            numpy.frombuffer(self._timestamps, dtype=numpy.float64),
+                            self._ids)
+        delivery_tags = self.delivery_tags
+
+        self.clear()
+
+        return batch, delivery_tags
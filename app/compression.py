@@ -0,0 +1,111 @@
+import time
+import zlib
+import lzma
+
+
+# content_encoding -> (compressão, descompressão)
+METHODS = {
+    'zlib': (lambda body, level: zlib.compress(body, 6 if level is None else level), zlib.decompress),
+    'lzma': (lambda body, level: lzma.compress(body, preset=level), lzma.decompress),
+}
+
+
+class CompressionStats(object):
+    """Contadores de (des)compressão: mensagens, bytes antes e depois e tempo de CPU."""
+    __slots__ = ('messages', 'compressed', 'bytes_in', 'bytes_out', 'cpu_time')
+
+    def __init__(self):
+        self.messages = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def as_dict(self):
+        """`ratio` é o tamanho original dividido pelo comprimido, só das mensagens comprimidas."""
+        return dict(
+            messages=self.messages,
+            compressed=self.compressed,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+            ratio=self.bytes_in / self.bytes_out if self.bytes_out else 0.0,
+            cpu_time=self.cpu_time,
+        )
+
+
+class Compressor(object):
+    """Comprime os corpos maiores que `threshold` bytes. O método usado vai no
+    content_encoding da mensagem; abaixo do limite o corpo segue sem compressão e sem
+    content_encoding.
+
+    """
+
+    def __init__(self, method='zlib', threshold=1024, level=None):
+        """
+        :param str method: zlib ou lzma
+        :param int threshold: Tamanho mínimo, em bytes, para comprimir
+        :param int level: Nível de compressão do método (padrão do método se None)
+
+        """
+        if method not in METHODS:
+            raise ValueError('Compressão desconhecida: %s' % (method,))
+
+        self.content_encoding = method
+        self._compress = METHODS[method][0]
+        self._threshold = threshold
+        self._level = level
+
+        self.stats = CompressionStats()
+
+    def compress(self, body):
+        """Retorna uma tupla (corpo, content_encoding); o content_encoding é None quando o
+        corpo segue sem compressão.
+
+        """
+        stats = self.stats
+        stats.messages += 1
+
+        if len(body) < self._threshold:
+            return body, None
+
+        started = time.thread_time()
+        compressed = self._compress(body, self._level)
+        stats.cpu_time += time.thread_time() - started
+
+        stats.compressed += 1
+        stats.bytes_in += len(body)
+        stats.bytes_out += len(compressed)
+
+        return compressed, self.content_encoding
+
+
+class Decompressor(object):
+    """Descomprime os corpos pelo content_encoding da mensagem."""
+
+    def __init__(self):
+        self.stats = CompressionStats()
+
+    def decompress(self, body, content_encoding=None):
+        """:raises ValueError: content_encoding desconhecido ou corpo corrompido"""
+        stats = self.stats
+        stats.messages += 1
+
+        if not content_encoding:
+            return body
+
+        if content_encoding not in METHODS:
+            raise ValueError('content_encoding desconhecido: %s' % (content_encoding,))
+
+        started = time.thread_time()
+
+        try:
+            decompressed = METHODS[content_encoding][1](body)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError('Corpo %s corrompido: %r' % (content_encoding, e))
+
+        stats.cpu_time += time.thread_time() - started
+        stats.compressed += 1
+        stats.bytes_in += len(decompressed)
+        stats.bytes_out += len(body)
+
+        return decompressed
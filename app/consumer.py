@@ -1,15 +1,123 @@
-from app.utils import LOGGER, pprint, json
+import logging
+import time
+import functools
+
+from tornado import gen
+from tornado.concurrent import is_future
+from pika import exceptions
+
+from app.codec import decode
+from app.message import Message, InvalidMessage
+from app.batching import ENVELOPE_TYPE, unpack
+from app.compression import Decompressor
+from app.acks import AckCoalescer
+from app.handlers import HandlerRegistry
+from app.columnar import BatchCollector
+from app.retry import ERROR_HEADER, ATTEMPTS_HEADER, attempts, with_headers
+
+LOGGER = logging.getLogger(__name__)
 
 class Consumer(object):
-    def __init__(self, server_instance, queue, exchange, exchange_type):
+    def __init__(self, server_instance, queue, exchange, exchange_type,
+                 prefetch_count=0, prefetch_size=0, ack_batch_size=1, ack_interval=100,
+                 handlers=None, debug_sink=None, executor=None, batch_handler=None, batch_size=1024,
+                 batch_interval=50, dedup=None, routing_key=None, retry=None, lazy=False):
+        """
+        :param int prefetch_count: Máximo de mensagens entregues e ainda não ackeadas (0 = sem limite)
+        :param int prefetch_size: Máximo de bytes entregues e ainda não ackeados (0 = sem limite)
+        :param int ack_batch_size: Quantidade de mensagens confirmadas por um único
+            basic_ack(multiple=True)
+        :param int ack_interval: Tempo máximo, em milissegundos, que um ack fica retido
+        :param app.handlers.HandlerRegistry handlers: Handlers das mensagens, por tipo
+        :param callable debug_sink: Chamado com cada mensagem decodificada, p.e.
+            `app.handlers.pprint_sink`. Sem ele nada é escrito no terminal
+        :param concurrent.futures.Executor executor: Quando informado, os handlers rodam
+            nesse ThreadPoolExecutor/ProcessPoolExecutor em vez do IOLoop. Exige
+            prefetch_count, que limita as mensagens em processamento
+        :param callable batch_handler: Handler vetorizado, chamado com um
+            `app.columnar.ColumnBatch` (colunas NumPy) de até `batch_size` leituras. As
+            entregas do lote são ackeadas juntas quando ele retorna. Exige numpy
+        :param int batch_size: Leituras por lote do `batch_handler`. Deve caber no
+            prefetch_count, senão o lote só fecha pelo `batch_interval`
+        :param int batch_interval: Tempo máximo, em milissegundos, que um lote incompleto espera
+        :param dedup: Deduplicador dos `_id`s (`app.dedup.LRUDeduplicator` ou
+            `BloomDeduplicator`). As leituras com `_id` já processado são descartadas sem
+            passar pelos handlers; um `_id` só é lembrado depois do ack da entrega dele
+        :param str routing_key: Routing key da ligação da fila ao exchange (padrão: a
+            ROUTING_KEY do Servidor); com `app.routing.ShardRouting`, a do shard da fila
+        :param app.retry.RetryPolicy retry: Novas tentativas com atraso para as entregas cujo
+            handler falhou, e a fila morta para as que esgotam as tentativas ou não
+            decodificam. Sem ela a entrega que falha volta para a fila na hora
+        :param bool lazy: Os handlers recebem uma `app.message.Message`, que só decodifica o
+            corpo quando um campo é lido, em vez do dict já decodificado. Os envelopes, e
+            todas as leituras se houver dedup, batch_handler ou debug_sink, continuam sendo
+            decodificados na chegada
+
+        """
+        if executor is not None and not prefetch_count:
+            raise ValueError('O uso de executor exige prefetch_count para limitar as mensagens em voo')
+
+        if executor is not None and batch_handler is not None:
+            raise ValueError('O handler em lote roda no IOLoop; não pode ser usado com executor')
+
         self._channel = None
         self._consumer_tag = None
 
+        # Controle de fluxo: pausado o consumo é cancelado (Basic.Cancel) até o `resume`.
+        self._paused = False
+        self._consuming_queue = None
+        self._last_delivered = 0
+
         # Informações passadas na Instanciação:
         self._server = server_instance
         self._queue = queue
         self._exchange = exchange
         self._exchange_type = exchange_type
+        self._routing_key = routing_key if routing_key is not None else server_instance.ROUTING_KEY
+
+        # QoS e acks em lote:
+        self._prefetch_count = prefetch_count
+        self._prefetch_size = prefetch_size
+        self._acks = AckCoalescer(ack_batch_size, ack_interval)
+
+        # Despacho das mensagens:
+        self._handlers = handlers if handlers is not None else HandlerRegistry()
+        self._debug_sink = debug_sink
+        self._decompressor = Decompressor()
+        self._executor = executor
+        self._in_flight = 0
+        self._lazy = lazy
+        self._reads_fields = dedup is not None or batch_handler is not None or debug_sink is not None
+
+        # Handler vetorizado em lote:
+        self._batch_handler = batch_handler
+        self._batch_interval = batch_interval
+        self._batches = BatchCollector(batch_size) if batch_handler is not None else None
+        self._batch_timeout = None
+        self._batch_count = 0
+        self._batch_records = 0
+        self._batch_time = 0.0
+
+        # Deduplicação: `_id`s de cada entrega, lembrados quando ela é ackeada.
+        self._dedup = dedup
+        self._dedup_pending = {}
+        self._duplicates = 0
+
+        # Novas tentativas: propriedades e corpo original de cada entrega em aberto, para
+        # republicá-la se o handler falhar.
+        self._retry = retry
+        self._deliveries = {}
+        self._retried = 0
+        self._recovered = 0
+        self._dead_lettered = 0
+
+        # Contadores:
+        self._consumed = 0
+        self._envelopes = 0
+        self._records = 0
+        self._acked = 0
+        self._rejected = 0
+        self._calls = 0
 
    
     # - 1   
@@ -22,9 +130,13 @@ class Consumer(object):
         :param pika.channel.Channel channel: The channel object
 
         """
-        LOGGER.debug('Canal Consumer Aberto') #{}'.format(channel))
+        LOGGER.debug('Canal Consumer Aberto %s', channel)
         
         self._channel = channel
+        self._consumer_tag = None
+        self._consuming_queue = None
+        self._last_delivered = 0
+        self._acks.reset(channel)
         
         self._add_on_channel_close_callback(channel)
         
@@ -43,7 +155,7 @@ class Consumer(object):
         channel.add_on_close_callback(self._on_channel_closed)
 
     ### - 1.1.1
-    def _on_channel_closed(self, channel, reply_code, reply_text):
+    def _on_channel_closed(self, channel, reason):
         """Chamado pelo pika quando o RabbitMq fecha inesperadamente o canal.
         
         Os canais geralmente são fechados se você tentar fazer algo que
@@ -52,11 +164,20 @@ class Consumer(object):
         para desligar o objeto.
 
         :param pika.channel.Channel: The closed channel
-        :param int reply_code: The numeric reason the channel was closed
-        :param str reply_text: The text reason the channel was closed
+        :param Exception reason: why the channel was closed
 
         """
-        LOGGER.warning('Canal %i foi fechado: (%s) %s', channel, reply_code, reply_text)
+        LOGGER.warning('Canal %i foi fechado: %s', channel, reason)
+
+        # Os acks retidos não podem mais ser enviados; o RabbitMQ vai reentregar as mensagens.
+        self._acks.reset(None)
+        self._discard_batch()
+        self._dedup_pending.clear()
+        self._deliveries.clear()
+
+        if isinstance(reason, exceptions.AMQPConnectionError):
+            # A conexão caiu junto com o canal; o Servidor reconecta e reabre os canais.
+            return
         
         self._server.stop()
 
@@ -69,7 +190,7 @@ class Consumer(object):
         :param str|unicode exchange_name: The name of the exchange to declare
 
         """
-        LOGGER.info('Declarando Exchange do Consumer: (%s - %s)'.format(self._exchange, self._exchange_type))
+        LOGGER.info('Declarando Exchange do Consumer: (%s - %s)', self._exchange, self._exchange_type)
 
         self._channel.exchange_declare(self._exchange, self._exchange_type, durable=True, callback=self._on_exchange_declareok)
    
@@ -112,13 +233,15 @@ class Consumer(object):
         """
         QUEUE = method_frame.method.queue
         
-        #TODO: Trocar Routing Key - Cada consumidor pode ter o seu;
         LOGGER.debug('Linkando (%s) para (%s) com (%s)',
-                    self._exchange, QUEUE, self._server.ROUTING_KEY)
+                    self._exchange, QUEUE, self._routing_key)
         
-        self._channel.queue_bind(QUEUE, self._exchange, self._server.ROUTING_KEY, callback=self._on_bindok)
+        self._channel.queue_bind(QUEUE, self._exchange, self._routing_key, callback=self._on_bindok)
+
+        if self._retry is not None:
+            self._retry.declare(self._channel, QUEUE)
         
-        self._start_consuming(QUEUE)
+        self._set_qos(QUEUE)
 
     
     def _on_bindok(self, unused_frame):
@@ -129,18 +252,65 @@ class Consumer(object):
         :param pika.frame.Method unused_frame: The Queue.BindOk response frame
 
         """
-        LOGGER.info('Queue do Consumer Linkada {}'.format(unused_frame.method) )
+        LOGGER.info('Queue do Consumer Linkada %s', unused_frame.method)
         
 
 
     """
     PARTE REFERENTE AO CONSUMO DE MENSAGENS:
     """
+    def _set_qos(self, QUEUE):
+        """Limita, com o Basic.Qos, quantas mensagens (e bytes) o RabbitMQ entrega ao canal
+        sem ack. Sem isso o broker empurra toda a fila de uma vez. Quando o RabbitMQ
+        confirmar, o consumo é iniciado.
+
+        """
+        if not (self._prefetch_count or self._prefetch_size):
+            self._start_consuming(QUEUE)
+            return
+
+        LOGGER.info('Definindo prefetch do Consumer: %i mensagens / %i bytes',
+                    self._prefetch_count, self._prefetch_size)
+
+        self._channel.basic_qos(prefetch_size=self._prefetch_size, prefetch_count=self._prefetch_count,
+                                callback=functools.partial(self._on_basic_qos_ok, QUEUE))
+
+    def _on_basic_qos_ok(self, QUEUE, unused_frame):
+        LOGGER.info('QoS do Consumer definido')
+
+        self._start_consuming(QUEUE)
+
     def _start_consuming(self, QUEUE):
               
         self._add_on_cancel_callback()
 
-        self._consumer_tag = self._channel.basic_consume(QUEUE, self._on_message)
+        self._consuming_queue = QUEUE
+
+        if not self._paused:
+            self._consumer_tag = self._channel.basic_consume(QUEUE, self._on_message)
+
+    def pause(self):
+        """Para de receber entregas com um Basic.Cancel, mantendo o canal aberto. As entregas
+        já recebidas continuam sendo processadas e ackeadas.
+
+        As que o RabbitMQ enviar antes do Basic.CancelOk são recusadas pelo próprio pika e
+        voltam para a fila; as tags delas são puladas no coalescer de acks quando a próxima
+        entrega chega (ver `_on_message`).
+
+        """
+        self._paused = True
+
+        if self._consumer_tag is not None and self._channel is not None and self._channel.is_open:
+            self._channel.basic_cancel(self._consumer_tag)
+            self._consumer_tag = None
+
+    def resume(self):
+        """Volta a consumir (Basic.Consume) depois de um `pause`."""
+        self._paused = False
+
+        if self._consumer_tag is None and self._consuming_queue is not None \
+                and self._channel is not None and self._channel.is_open:
+            self._consumer_tag = self._channel.basic_consume(self._consuming_queue, self._on_message)
 
 
     def _add_on_cancel_callback(self):
@@ -164,42 +334,527 @@ class Consumer(object):
         As propriedades transmitidas são um instância de BasicProperties com as propriedades da mensagem
         e o corpo é a mensagem que foi enviada.
 
+        Um envelope de leituras (`type` igual a `app.batching.ENVELOPE_TYPE`) é desempacotado e
+        cada leitura passa pelos handlers; o ack continua sendo um por envelope, enviado quando
+        todas as leituras forem tratadas. Se alguma falhar o envelope inteiro volta para a fila,
+        inclusive as leituras já tratadas.
+
         :param pika.channel.Channel unused_channel: The channel object
         :param pika.Spec.Basic.Deliver: basic_deliver method
         :param pika.Spec.BasicProperties: properties
         :param str|unicode body: The message body
          
         """
-        print("== Nova Mensagem ==")
-        pprint.pprint(json.loads(body))
+        delivery_tag = basic_deliver.delivery_tag
+        self._consumed += 1
+
+        if delivery_tag != self._last_delivered + 1:
+            # Tags que nunca chegaram aqui, recusadas pelo pika depois de um `pause`:
+            self._acks.skip(self._last_delivered + 1, delivery_tag - 1)
+
+        self._last_delivered = delivery_tag
+
+        if self._retry is not None:
+            self._deliveries[delivery_tag] = (properties, body)
+
+        try:
+            if self._lazy and properties.type != ENVELOPE_TYPE:
+                # Decodificada só se algum handler ler os campos:
+                message = Message(body, basic_deliver, properties, self._decompressor)
+
+                if self._reads_fields:
+                    # A deduplicação, o lote e o debug_sink leem os campos de toda leitura;
+                    # decodificando aqui, um corpo inválido é descartado antes deles.
+                    message.data
+            else:
+                # A compressão e o codec são escolhidos pelo content_encoding e content_type
+                # definidos por quem publicou:
+                body = self._decompressor.decompress(body, properties.content_encoding)
+                message = decode(body, properties.content_type)
+        except ValueError as error:
+            if properties.reply_to is not None:
+                # Quem chamou recebe o erro em vez de esperar até o prazo da chamada:
+                LOGGER.exception('Requisição %s inválida', properties.correlation_id)
+                self._calls += 1
+                self._respond(delivery_tag, properties, dict(error=_describe(error)))
+                return
+
+            # Uma mensagem que não decodifica nunca vai decodificar; não volta para a fila.
+            LOGGER.exception('Mensagem %s inválida, descartando', delivery_tag)
+            self._discard(delivery_tag, error)
+            return
+
+        if properties.reply_to is not None:
+            # Requisição RPC: o resultado do handler volta para quem chamou.
+            self._call(unused_channel, delivery_tag, properties, message)
+            return
+
+        if properties.type == ENVELOPE_TYPE:
+            try:
+                records = unpack(message)
+            except ValueError as error:
+                LOGGER.exception('Envelope %s inválido, descartando', delivery_tag)
+                self._discard(delivery_tag, error)
+                return
+
+            self._envelopes += 1
+        else:
+            records = (message,)
+
+        self._records += len(records)
+
+        if self._dedup is not None:
+            records = self._deduplicate(delivery_tag, records)
+
+            if not records:
+                # Todas as leituras da entrega já foram processadas:
+                self._acknowledge_message(delivery_tag)
+                return
+
+        if self._debug_sink is not None:
+            for record in records:
+                self._debug_sink(record)
+
+        if self._handlers.observers:
+            self._notify(delivery_tag, records)
+
+        if self._batches is not None and self._batches.add(delivery_tag, records):
+            if self._batches.full:
+                self._run_batch()
+            elif self._batch_timeout is None:
+                self._batch_timeout = self._server.connection.ioloop.call_later(
+                    self._batch_interval / 1000.0, self._on_batch_timeout)
+            return
+
+        if self._executor is not None:
+            self._submit(unused_channel, delivery_tag, records)
+            return
+
+        try:
+            pending = self._dispatch(records)
+        except Exception as error:
+            LOGGER.exception('Erro no handler da mensagem %s', delivery_tag)
+            self._fail(delivery_tag, error)
+            return
+
+        if pending is None:
+            # NOTE Ackeando a mensagem:
+            self._acknowledge_message(delivery_tag)
+            return
+
+        # Handlers assíncronos: o ack só é enviado quando todos terminarem.
+        self._server.connection.ioloop.add_future(
+            pending, functools.partial(self._on_handled, unused_channel, delivery_tag))
+
+    def _call(self, channel, delivery_tag, properties, message):
+        """Requisição RPC: chama o handler do tipo da mensagem, sempre no IOLoop, e publica o
+        resultado (`{'result': ...}`) ou o erro (`{'error': ...}`) na fila `reply_to`, com o
+        `correlation_id` da requisição. A entrega só é ackeada quando o RabbitMQ confirma a
+        resposta; sem a confirmação ela volta para a fila e o handler é chamado de novo. Um erro
+        do handler vai na resposta, sem novas tentativas, e quem chamou decide o que fazer.
 
-        # NOTE Recusa da mensagem:        
-        #LOGGER.info("RECUSANDO A MENSAGEM %s", basic_deliver.delivery_tag)
-        #self._non_acknowledge_message(basic_deliver.delivery_tag)
-        
-        # NOTE Ackeando a mensagem:
-        self._acknowledge_message(basic_deliver.delivery_tag)
+        """
+        self._calls += 1
+
+        try:
+            result = self._handlers.call(message)
+        except Exception as error:
+            LOGGER.exception('Erro na requisição %s', properties.correlation_id)
+            self._respond(delivery_tag, properties, dict(error=_describe(error)))
+            return
+
+        if is_future(result):
+            self._server.connection.ioloop.add_future(
+                result, functools.partial(self._on_called, channel, delivery_tag, properties))
+            return
+
+        self._respond(delivery_tag, properties, dict(result=result))
+
+    def _on_called(self, channel, delivery_tag, properties, future):
+        """Chamado no IOLoop quando o handler assíncrono de uma requisição RPC termina."""
+        if channel is not self._channel or not channel.is_open:
+            # O canal da entrega foi fechado; o RabbitMQ vai reentregar a requisição.
+            return
+
+        if future.exception() is not None:
+            LOGGER.error('Erro na requisição %s', properties.correlation_id, exc_info=future.exception())
+            self._respond(delivery_tag, properties, dict(error=_describe(future.exception())))
+        else:
+            self._respond(delivery_tag, properties, dict(result=future.result()))
+
+    def _respond(self, delivery_tag, properties, payload):
+        """Publica a resposta e ackeia a requisição quando ela for confirmada. Um resultado
+        que o codec não codifica (p.e. um `set` em JSON) vira uma resposta de erro; se nem
+        ela codificar, a requisição é tratada como no `_discard`, para não travar os acks.
+
+        """
+        try:
+            future = self._server.reply(properties.reply_to, properties.correlation_id, payload)
+        except Exception as error:
+            LOGGER.exception('Resposta da requisição %s não codifica', properties.correlation_id)
+
+            try:
+                future = self._server.reply(properties.reply_to, properties.correlation_id,
+                                            dict(error=_describe(error)))
+            except Exception:
+                self._discard(delivery_tag, error)
+                return
+
+        self._settle_when_confirmed(delivery_tag, future, self._acknowledge_message)
+
+    def _notify(self, delivery_tag, records):
+        """Passa as leituras aos observadores do registro (p.e. a agregação em janelas). Um
+        observador que falha não muda o destino da entrega, que segue para os handlers.
+
+        """
+        notify = self._handlers.notify
+
+        for record in records:
+            try:
+                notify(record)
+            except Exception:
+                LOGGER.exception('Erro no observador da mensagem %s', delivery_tag)
+
+    def _dispatch(self, records):
+        """Chama os handlers de cada leitura. Retorna None se todas foram tratadas, ou uma
+        Future que termina quando os handlers assíncronos de todas terminarem.
+
+        """
+        if len(records) == 1:
+            return self._handlers.dispatch(records[0])
+
+        pending = []
+
+        for record in records:
+            future = self._handlers.dispatch(record)
+
+            if future is not None:
+                pending.append(future)
+
+        if not pending:
+            return None
+
+        return gen.multi(pending) if len(pending) > 1 else pending[0]
+
+    def _deduplicate(self, delivery_tag, records):
+        """Remove as leituras com `_id` já processado e guarda os `_id`s das restantes, para
+        lembrá-los no ack da entrega. Só `_id`s `str`, `bytes` ou `int` são deduplicados; as
+        leituras com outro `_id` (p.e. uma lista no JSON) passam direto.
+
+        """
+        dedup = self._dedup
+        fresh = []
+        ids = []
+
+        for record in records:
+            _id = record.get('_id') if isinstance(record, (dict, Message)) else None
+
+            if isinstance(_id, (str, bytes, int)):
+                if _id in dedup:
+                    self._duplicates += 1
+                    continue
+
+                ids.append(_id)
+
+            fresh.append(record)
+
+        if ids:
+            self._dedup_pending[delivery_tag] = ids
+
+        return fresh
+
+    def _remember(self, delivery_tag):
+        ids = self._dedup_pending.pop(delivery_tag, None)
+
+        if ids is not None:
+            add = self._dedup.add
+
+            for _id in ids:
+                add(_id)
+
+    def _on_batch_timeout(self):
+        self._batch_timeout = None
+        self._run_batch()
+
+    def _cancel_batch_timeout(self):
+        if self._batch_timeout is not None:
+            self._server.connection.ioloop.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+
+    def _discard_batch(self):
+        """Descarta o lote em aberto; o RabbitMQ reentrega as mensagens do canal fechado."""
+        if self._batches is not None:
+            self._cancel_batch_timeout()
+            self._batches.clear()
+
+    def _run_batch(self):
+        """Roda o handler vetorizado no lote em aberto e confirma todas as entregas dele com
+        um único Basic.Ack (ou as devolve para a fila se o handler falhar).
+
+        """
+        self._cancel_batch_timeout()
+
+        if not self._batches.delivery_tags:
+            return
+
+        batch, delivery_tags = self._batches.take()
+        started = time.perf_counter()
+
+        try:
+            self._batch_handler(batch)
+        except Exception as error:
+            LOGGER.exception('Erro no handler em lote (%i mensagens)', len(delivery_tags))
+
+            for delivery_tag in delivery_tags:
+                self._fail(delivery_tag, error)
+            return
+        finally:
+            self._batch_time += time.perf_counter() - started
+            self._batch_count += 1
+            self._batch_records += len(batch)
+
+        for delivery_tag in delivery_tags:
+            self._acks.ack(delivery_tag)
+
+            if self._dedup_pending:
+                self._remember(delivery_tag)
+
+            if self._deliveries:
+                self._forget(delivery_tag)
+
+        self._acked += len(delivery_tags)
+        self._acks.flush()
+
+    def _on_handled(self, channel, delivery_tag, future):
+        """Chamado no IOLoop quando os handlers assíncronos de uma mensagem terminam."""
+        if channel is not self._channel or not channel.is_open:
+            # O canal da entrega foi fechado; o RabbitMQ vai reentregar a mensagem.
+            return
+
+        if future.exception() is not None:
+            LOGGER.error('Erro no handler da mensagem %s', delivery_tag, exc_info=future.exception())
+            self._fail(delivery_tag, future.exception())
+        else:
+            self._acknowledge_message(delivery_tag)
+
+    def _submit(self, channel, delivery_tag, records):
+        """Roda os handlers das leituras da mensagem no executor. Cada future, ao terminar na thread do
+        worker, agenda `_on_executed` no IOLoop com `add_callback_threadsafe`; o ack só é
+        enviado pelo IOLoop, depois de todos os handlers da mensagem terminarem.
+
+        O prefetch do canal limita quantas mensagens ficam em processamento ao mesmo tempo.
+
+        """
+        submitted = []
+
+        for record in records:
+            submitted.extend(self._handlers.submit(self._executor, record) or ())
+
+        if not submitted:
+            self._acknowledge_message(delivery_tag)
+            return
+
+        self._in_flight += 1
+
+        # [handlers restantes, erro de algum deles]
+        state = [len(submitted), None]
+        threadsafe = channel.connection.add_callback_threadsafe
+
+        for handler, future in submitted:
+            future.add_done_callback(
+                lambda future, handler=handler: threadsafe(
+                    functools.partial(self._on_executed, channel, delivery_tag, handler, future, state)))
+
+    def _on_executed(self, channel, delivery_tag, handler, future, state):
+        """Chamado no IOLoop quando um handler submetido ao executor termina."""
+        self._handlers.record(handler, future)
+
+        if future.exception() is not None:
+            LOGGER.error('Erro no handler da mensagem %s', delivery_tag, exc_info=future.exception())
+            state[1] = future.exception()
+
+        state[0] -= 1
+
+        if state[0]:
+            return
+
+        self._in_flight -= 1
+
+        if channel is not self._channel or not channel.is_open:
+            # O canal da entrega foi fechado; o RabbitMQ vai reentregar a mensagem.
+            return
+
+        if state[1] is not None:
+            self._fail(delivery_tag, state[1])
+        else:
+            self._acknowledge_message(delivery_tag)
+
+    @property
+    def in_flight(self):
+        """Mensagens em processamento no executor."""
+        return self._in_flight
+
+    @property
+    def handlers(self):
+        return self._handlers
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @property
+    def stats(self):
+        return dict(
+            consumed=self._consumed,
+            envelopes=self._envelopes,
+            records=self._records,
+            acked=self._acked,
+            rejected=self._rejected,
+            calls=self._calls,
+            retried=self._retried,
+            recovered=self._recovered,
+            dead_lettered=self._dead_lettered,
+            in_flight=self._in_flight,
+            decompression=self._decompressor.stats.as_dict(),
+            dedup=dict(self._dedup.stats.as_dict(), duplicates=self._duplicates) if self._dedup is not None else None,
+            batches=dict(
+                count=self._batch_count,
+                records=self._batch_records,
+                time=self._batch_time,
+                mean_size=self._batch_records / self._batch_count if self._batch_count else 0.0,
+            ),
+        )
              
 
     def _acknowledge_message(self, delivery_tag):
-        LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        LOGGER.debug('Acknowledging message %s', delivery_tag)
+        self._acked += 1
+        self._acks.ack(delivery_tag)
+
+        if self._dedup_pending:
+            self._remember(delivery_tag)
 
+        if self._deliveries:
+            self._forget(delivery_tag)
 
-    def _non_acknowledge_message(self, delivery_tag):
+    def _forget(self, delivery_tag):
+        """A entrega foi ackeada; conta as que só deram certo em uma nova tentativa."""
+        delivery = self._deliveries.pop(delivery_tag, None)
+
+        if delivery is not None and delivery[0].headers and attempts(delivery[0]):
+            self._recovered += 1
+
+
+    def _non_acknowledge_message(self, delivery_tag, requeue=True):
         LOGGER.info('Nonacknowledging message %s', delivery_tag)
-        self._channel.basic_reject(delivery_tag=delivery_tag, requeue=True)
+        self._rejected += 1
+        self._channel.basic_reject(delivery_tag=delivery_tag, requeue=requeue)
+        self._acks.settle(delivery_tag)
+
+        # A mensagem volta para a fila (ou é descartada) sem ter sido processada:
+        self._dedup_pending.pop(delivery_tag, None)
+        self._deliveries.pop(delivery_tag, None)
+
+    def _fail(self, delivery_tag, error):
+        """O handler da entrega falhou. Com a política de novas tentativas ela é republicada
+        na fila de atraso da próxima tentativa, ou na fila morta depois da última; sem ela,
+        volta para a fila. Uma `app.message.InvalidMessage` (corpo que não decodifica, lido só
+        pelo handler com `lazy`) nunca vai dar certo e é tratada como no `_discard`.
+
+        """
+        if isinstance(error, InvalidMessage):
+            self._discard(delivery_tag, error)
+            return
+
+        if self._retry is None:
+            self._non_acknowledge_message(delivery_tag)
+            return
+
+        attempt = attempts(self._deliveries[delivery_tag][0]) + 1
+        routing_key = self._retry.route(self._queue, attempt)
+
+        if attempt >= self._retry.max_attempts:
+            LOGGER.warning('Mensagem %s falhou %i vezes; enviando para %s', delivery_tag, attempt, routing_key)
+            self._dead_lettered += 1
+        else:
+            LOGGER.debug('Mensagem %s falhou (tentativa %i); enviando para %s', delivery_tag, attempt, routing_key)
+            self._retried += 1
+
+        self._republish(delivery_tag, routing_key, {ATTEMPTS_HEADER: attempt, ERROR_HEADER: _describe(error)})
+
+    def _discard(self, delivery_tag, error):
+        """A entrega não decodifica: vai direto para a fila morta, se houver, ou é descartada."""
+        if self._retry is None:
+            self._non_acknowledge_message(delivery_tag, requeue=False)
+            return
+
+        self._dead_lettered += 1
+        self._republish(delivery_tag, self._retry.dead_letter_queue(self._queue), {ERROR_HEADER: _describe(error)})
+
+    def _republish(self, delivery_tag, routing_key, headers):
+        """Publica o corpo original da entrega, com os `headers`, na fila `routing_key` pelo
+        pool de publicação (exchange padrão, com confirmação) e só ackeia a entrega depois que
+        o RabbitMQ confirmar a publicação. Sem canal de publicação pronto a republicação
+        espera no pool; se ela for recusada a entrega volta para a fila. Se o canal do Consumer
+        cair antes do ack ela é reentregue, e pode ser processada duas vezes (a deduplicação
+        cobre esse caso).
+
+        """
+        properties, body = self._deliveries.pop(delivery_tag)
+
+        # A mensagem não foi processada; o `_id` não é lembrado:
+        self._dedup_pending.pop(delivery_tag, None)
+
+        future = self._server.republish(routing_key, body, with_headers(properties, headers))
+
+        # Não processada: o ack não conta nos `acked` do Consumer.
+        self._settle_when_confirmed(delivery_tag, future, self._acks.ack)
+
+    def _settle_when_confirmed(self, delivery_tag, future, acknowledge):
+        """Ackeia a entrega com `acknowledge(delivery_tag)` quando a `future` da publicação que
+        a substitui (republicação ou resposta RPC) terminar com a confirmação; sem ela, devolve
+        a entrega para a fila.
+
+        """
+        channel = self._channel
+
+        self._server.connection.ioloop.add_future(
+            future, functools.partial(self._on_confirmed, channel, delivery_tag, acknowledge))
+
+    def _on_confirmed(self, channel, delivery_tag, acknowledge, future):
+        if channel is not self._channel or not channel.is_open:
+            # O canal da entrega foi fechado; o RabbitMQ vai reentregar a mensagem.
+            return
+
+        if future.result():
+            acknowledge(delivery_tag)
+        else:
+            LOGGER.warning('Publicação da entrega %s não confirmada; devolvendo para a fila', delivery_tag)
+            self._non_acknowledge_message(delivery_tag)
 
 
     def close_channel(self):
         LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ to close Consumer Channel')
+
+        if self._batches is not None:
+            self._run_batch()
+
+        self._acks.flush()
+
+        if self._consumer_tag is None:
+            # Pausado pelo controle de fluxo: não há consumo para cancelar.
+            self._on_cancelok(None)
+            return
         
         self._channel.basic_cancel(self._consumer_tag, callback=self._on_cancelok)
 
 
-    def _on_cancelok(self):
+    def _on_cancelok(self, unused_frame):
         LOGGER.info('RabbitMQ acknowledged the cancellation of the consumer')
         LOGGER.info('Closing the channel')
+
+        # Envia os acks retidos antes de fechar o canal:
+        self._acks.flush()
         self._channel.close()        
 
 
@@ -207,3 +862,7 @@ class Consumer(object):
     def channel(self):
         return self._channel
 
+
+def _describe(error, limit=256):
+    """Texto curto do erro, para o header `x-error`."""
+    return ('%s: %s' % (type(error).__name__, error))[:limit]
@@ -0,0 +1,184 @@
+import math
+import time
+
+from collections import OrderedDict
+
+
+class DedupStats(object):
+    __slots__ = ('hits', 'misses', 'added')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+
+        return dict(hits=self.hits, misses=self.misses, added=self.added,
+                    hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+class LRUDeduplicator(object):
+    """Lembra os últimos `capacity` `_id`s processados, por até `ttl` segundos. Exato (sem
+    falsos positivos), mas cada `_id` custa uma entrada de dicionário com a string.
+
+    """
+    name = 'lru'
+
+    def __init__(self, capacity=1000000, ttl=3600, clock=time.monotonic):
+        """
+        :param int capacity: Máximo de `_id`s guardados; os mais antigos saem primeiro
+        :param float ttl: Tempo, em segundos, que um `_id` é lembrado (None = sem expiração)
+
+        """
+        self._capacity = capacity
+        self._ttl = ttl
+        self._clock = clock
+        self._seen = OrderedDict()
+
+        self.stats = DedupStats()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __contains__(self, key):
+        """Se o `_id` já foi processado. Conta um acerto ou uma falha."""
+        added_at = self._seen.get(key)
+
+        if added_at is not None and (self._ttl is None or self._clock() - added_at < self._ttl):
+            self.stats.hits += 1
+            return True
+
+        self.stats.misses += 1
+        return False
+
+    def add(self, key):
+        seen = self._seen
+        now = self._clock()
+
+        seen[key] = now
+        seen.move_to_end(key)
+        self.stats.added += 1
+
+        while len(seen) > self._capacity:
+            seen.popitem(last=False)
+
+        # Os expirados estão no início, na ordem em que foram adicionados:
+        if self._ttl is not None:
+            expired_before = now - self._ttl
+
+            while seen:
+                key, added_at = next(iter(seen.items()))
+
+                if added_at >= expired_before:
+                    break
+
+                del seen[key]
+
+
+class BloomDeduplicator(object):
+    """Filtro de Bloom rotativo: duas gerações de tamanho fixo, a atual e a anterior. Quando
+    a atual recebe `capacity` `_id`s ela passa a ser a anterior e a mais antiga é descartada,
+    então pelo menos os últimos `capacity` `_id`s são lembrados.
+
+    A memória é fixa (`nbytes`) e não depende do tamanho dos `_id`s. Em troca há falsos
+    positivos: uma mensagem nova pode ser tomada como duplicada com probabilidade de até
+    `error_rate`.
+
+    """
+    name = 'bloom'
+
+    def __init__(self, capacity=1000000, error_rate=0.001, max_bytes=None):
+        """
+        :param int capacity: `_id`s por geração
+        :param float error_rate: Taxa de falsos positivos aceitável (somando as duas gerações)
+        :param int max_bytes: Limite de memória das duas gerações; se informado, reduz a
+            `capacity` para caber nele com a `error_rate` pedida
+
+        """
+        # Cada geração fica com metade da taxa, já que um `_id` é procurado nas duas:
+        rate = error_rate / 2.0
+        bits_per_key = -math.log(rate) / math.log(2) ** 2
+
+        if max_bytes is not None:
+            capacity = min(capacity, int(max_bytes * 8 / 2 / bits_per_key))
+
+        if capacity < 1:
+            raise ValueError('max_bytes pequeno demais para a error_rate pedida')
+
+        self._capacity = capacity
+        self._bits = max(8, int(math.ceil(capacity * bits_per_key)))
+        self._hashes = max(1, int(round(self._bits / float(capacity) * math.log(2))))
+
+        self._current = bytearray((self._bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0
+
+        self.rotations = 0
+        self.stats = DedupStats()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return len(self._current) + len(self._previous)
+
+    def _positions(self, key):
+        # Double hashing (Kirsch-Mitzenmacher) com as duas metades do hash de 64 bits do
+        # Python (SipHash, já guardado na string). O filtro só vive neste processo, então
+        # a semente aleatória do hash por processo não importa.
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        bits = self._bits
+
+        return [(h1 + i * h2) % bits for i in range(self._hashes)]
+
+    def __contains__(self, key):
+        """Se o `_id` (provavelmente) já foi processado. Conta um acerto ou uma falha."""
+        positions = self._positions(key)
+
+        for generation in (self._current, self._previous):
+            for position in positions:
+                if not generation[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                self.stats.hits += 1
+                return True
+
+        self.stats.misses += 1
+        return False
+
+    def add(self, key):
+        if self._count >= self._capacity:
+            self._previous = self._current
+            self._current = bytearray(len(self._previous))
+            self._count = 0
+            self.rotations += 1
+
+        current = self._current
+
+        for position in self._positions(key):
+            current[position >> 3] |= 1 << (position & 7)
+
+        self._count += 1
+        self.stats.added += 1
+
+
+DEDUPLICATORS = (LRUDeduplicator, BloomDeduplicator)
+
+_by_name = dict((dedup.name, dedup) for dedup in DEDUPLICATORS)
+
+
+def get_deduplicator(name, **options):
+    """Cria o deduplicador pelo nome (lru ou bloom).
+
+    :raises ValueError: deduplicador desconhecido
+
+    """
+    if name not in _by_name:
+        raise ValueError('Deduplicador desconhecido: %s' % (name,))
+
+    return _by_name[name](**options)
@@ -0,0 +1,976 @@
+import logging
+import random
+import threading
+
+from collections import deque
+from itertools import count
+
+from tornado.ioloop import IOLoop
+
+from app.utils import pika
+from pika import spec, frame, exceptions
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FakeQueue(object):
+    """Fila em memória do broker falso. Guarda as mensagens prontas para entrega e
+    os consumidores registrados nela.
+
+    """
+    __slots__ = ('name', 'messages', 'consumers', 'scheduled', 'credit', 'refilled_at', 'ttl', 'dead_letter',
+                 'expires', 'expiring')
+
+    def __init__(self, name, ttl=None, dead_letter=None):
+        self.name = name
+        self.messages = deque()
+        self.consumers = deque()
+        self.scheduled = False
+
+        # `x-message-ttl` (s) e `x-dead-letter-*` (exchange, routing key). Como o TTL é o mesmo
+        # para a fila toda, as mensagens vencem na ordem: `expires` tem o vencimento de cada uma.
+        self.ttl = ttl
+        self.dead_letter = dead_letter
+        self.expires = deque()
+        self.expiring = False
+
+        # Entregas disponíveis com `queue_rate` (balde de fichas):
+        self.credit = 0.0
+        self.refilled_at = 0.0
+
+
+def topic_matches(pattern, words):
+    """A routing key (já separada em palavras) casa com o padrão do binding de um exchange
+    topic: '*' casa uma palavra e '#' zero ou mais.
+
+    """
+    if not pattern:
+        return not words
+
+    if pattern[0] == '#':
+        return any(topic_matches(pattern[1:], words[i:]) for i in range(len(words) + 1))
+
+    return bool(words) and pattern[0] in ('*', words[0]) and topic_matches(pattern[1:], words[1:])
+
+
+class DelayLine(object):
+    """Entrega itens a `handler`, em lotes e na ordem em que chegaram, em uma iteração
+    posterior do IOLoop e no mínimo `latency` segundos depois de cada um chegar. Com latência
+    zero é só um add_callback por lote.
+
+    """
+    __slots__ = ('_ioloop', '_handler', '_latency', '_items', '_scheduled')
+
+    def __init__(self, ioloop, handler, latency=0.0):
+        self._ioloop = ioloop
+        self._handler = handler
+        self._latency = latency
+        self._items = deque()
+        self._scheduled = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def push(self, item, at=None):
+        """
+        :param float at: Momento (IOLoop.time) a partir do qual o item pode ser entregue,
+            antes de somar a latência; None = agora
+
+        """
+        if at is not None:
+            due = at + self._latency
+        else:
+            due = self._ioloop.time() + self._latency if self._latency else 0.0
+
+        self._items.append((due, item))
+
+        if not self._scheduled:
+            self._schedule(due)
+
+    def _schedule(self, due):
+        self._scheduled = True
+
+        if due:
+            self._ioloop.call_at(due, self._run)
+        else:
+            self._ioloop.add_callback(self._run)
+
+    def _run(self):
+        items = self._items
+        self._scheduled = False
+
+        if not items:
+            return
+
+        if not items[-1][0]:
+            batch = [item for _, item in items]
+            items.clear()
+        else:
+            now = self._ioloop.time()
+            batch = []
+
+            while items and items[0][0] <= now:
+                batch.append(items.popleft()[1])
+
+            if items:
+                self._schedule(items[0][0])
+
+        if batch:
+            self._handler(batch)
+
+    def clear(self):
+        self._items.clear()
+
+
+class FakeBroker(object):
+    """Broker em processo que imita o comportamento do RabbitMQ necessário para rodar o
+    Servidor, o Consumer, o Publisher e o Client sem uma instância real do RabbitMQ:
+    exchanges direct e topic, filas, bindings, prefetch (Basic.Qos), ack/nack/reject com
+    reentrega, confirmações de publicação e filas com TTL e dead-letter exchange.
+
+    Todo o trabalho é agendado no IOLoop do Tornado, de forma que as callbacks chegam
+    de forma assíncrona, como chegariam pela rede. Para testar os caminhos de erro, o
+    broker pode atrasar as respostas (`latency`), recusar uma fração das publicações com
+    Basic.Nack (`nack_rate`), derrubar as conexões abertas (`drop_connections`) e recusar
+    novas conexões (`refuse_connections`) e bloquear as publicações com Connection.Blocked
+    (`block_connections`).
+
+        broker = FakeBroker(latency=0.002, nack_rate=0.01, seed=1)
+        server = Server(url, connection_class=functools.partial(FakeConnection, broker=broker))
+
+    """
+    _default = None
+
+    def __init__(self, ioloop=None, multiple_confirms=False, latency=0.0, nack_rate=0.0, seed=None,
+                 channel_rate=None, queue_rate=None):
+        """
+        :param tornado.ioloop.IOLoop ioloop: IOLoop onde as callbacks são agendadas
+        :param bool multiple_confirms: Confirma as publicações acumuladas com um único
+            Basic.Ack(multiple=True), como o RabbitMQ faz sob carga
+        :param float latency: Atraso, em segundos, das respostas, entregas e confirmações
+        :param float nack_rate: Fração das publicações recusadas com Basic.Nack (e não roteadas)
+        :param int seed: Semente do sorteio dos nacks, para execuções reproduzíveis
+        :param float channel_rate: Publicações por segundo que cada canal processa, como o
+            processo por canal do RabbitMQ; as confirmações saem nesse ritmo (None = sem limite)
+        :param float queue_rate: Entregas por segundo de cada fila, como o processo único por
+            fila do RabbitMQ (None = sem limite)
+
+        """
+        self._ioloop = ioloop
+        self.multiple_confirms = multiple_confirms
+        self.latency = latency
+        self.nack_rate = nack_rate
+        self.channel_rate = channel_rate
+        self.queue_rate = queue_rate
+        self.refuse_connections = False
+        self.stats = dict(published=0, delivered=0, acked=0, nacked=0, ack_frames=0, max_unacked=0,
+                          confirm_nacked=0, connections=0, dropped_connections=0, expired=0)
+
+        self._random = random.Random(seed)
+        self._connections = []
+        self._exchanges = {}
+        self._queues = {}
+        self._bindings = {}
+        self._topic_routes = {}
+        self._generated_names = count(1)
+
+    @classmethod
+    def default(cls):
+        """Broker compartilhado pelas conexões que não informam um broker próprio."""
+        if cls._default is None:
+            cls._default = cls()
+
+        return cls._default
+
+    @property
+    def ioloop(self):
+        if self._ioloop is None:
+            self._ioloop = IOLoop.current()
+
+        return self._ioloop
+
+    def later(self, callback, *args):
+        """Agenda a callback no IOLoop, depois de `latency` segundos."""
+        if self.latency:
+            self.ioloop.call_later(self.latency, callback, *args)
+        else:
+            self.ioloop.add_callback(callback, *args)
+
+    def should_nack(self):
+        return bool(self.nack_rate) and self._random.random() < self.nack_rate
+
+    def register(self, connection):
+        """Chamado pelas conexões falsas ao abrir.
+
+        :raises pika.exceptions.AMQPConnectionError: o broker está recusando conexões
+
+        """
+        if self.refuse_connections:
+            raise exceptions.AMQPConnectionError('FakeBroker recusando conexões')
+
+        self.stats['connections'] += 1
+        self._connections.append(connection)
+
+    def unregister(self, connection):
+        try:
+            self._connections.remove(connection)
+        except ValueError:
+            pass
+
+    def drop_connections(self, reply_code=320, reply_text='CONNECTION_FORCED - fake broker drop'):
+        """Derruba todas as conexões abertas, como um restart do RabbitMQ: os canais e as
+        conexões recebem as callbacks de fechamento com ConnectionClosedByBroker e as
+        mensagens sem ack voltam para as filas.
+
+        """
+        connections, self._connections = self._connections, []
+
+        for connection in connections:
+            connection.drop(reply_code, reply_text)
+
+        self.stats['dropped_connections'] += len(connections)
+
+        return len(connections)
+
+    def block_connections(self, reason='low on memory'):
+        """Bloqueia as conexões abertas, como o alarme de memória ou disco do RabbitMQ: elas
+        recebem o Connection.Blocked e as publicações ficam no buffer de saída até o
+        `unblock_connections`.
+
+        """
+        for connection in self._connections:
+            connection.block(reason)
+
+    def unblock_connections(self):
+        for connection in list(self._connections):
+            connection.unblock()
+
+    def exchange_declare(self, exchange, exchange_type='direct'):
+        self._exchanges.setdefault(exchange, exchange_type)
+
+    def queue_declare(self, queue, arguments=None):
+        """Declara a fila; sem nome, com um nome gerado pelo broker (`amq.gen-N`). Dos `arguments` do RabbitMQ, entende o `x-message-ttl` e o
+        `x-dead-letter-exchange`/`x-dead-letter-routing-key`: as mensagens que vencem vão para
+        o dead-letter exchange (com a routing key original, se a da fila não for informada).
+
+        """
+        if not queue:
+            queue = 'amq.gen-%i' % next(self._generated_names)
+
+        if queue not in self._queues:
+            arguments = arguments or {}
+            ttl = arguments.get('x-message-ttl')
+            dead_letter = None
+
+            if 'x-dead-letter-exchange' in arguments:
+                dead_letter = (arguments['x-dead-letter-exchange'], arguments.get('x-dead-letter-routing-key'))
+
+            self._queues[queue] = FakeQueue(queue, ttl / 1000.0 if ttl is not None else None, dead_letter)
+
+        return self._queues[queue]
+
+    def queue_bind(self, queue, exchange, routing_key):
+        self._bindings.setdefault(exchange, {}).setdefault(routing_key, set()).add(queue)
+        self._topic_routes.clear()
+
+    def queue(self, name):
+        return self._queues[name]
+
+    def publish(self, exchange, routing_key, body, properties):
+        """Roteia a mensagem para as filas ligadas ao exchange com a routing key (direct)
+        ou com um padrão que case com ela (topic).
+
+        """
+        if exchange == '':
+            queues = (routing_key,) if routing_key in self._queues else ()
+        elif self._exchanges.get(exchange) == 'topic':
+            queues = self._route_topic(exchange, routing_key)
+        else:
+            queues = self._bindings.get(exchange, {}).get(routing_key, ())
+
+        self.stats['published'] += 1
+
+        if properties is None:
+            properties = pika.BasicProperties()
+
+        for name in queues:
+            queue = self._queues[name]
+            queue.messages.append((body, properties, exchange, routing_key, False))
+
+            if queue.ttl is not None:
+                queue.expires.append(self.ioloop.time() + queue.ttl)
+                self._schedule_expiry(queue)
+
+            self._schedule(queue)
+
+        return len(queues)
+
+    def _schedule_expiry(self, queue):
+        if queue.expiring or not queue.expires:
+            return
+
+        queue.expiring = True
+        self.ioloop.call_at(queue.expires[0], self._expire, queue)
+
+    def _expire(self, queue):
+        """Tira da fila as mensagens vencidas e as publica no dead-letter exchange."""
+        queue.expiring = False
+        now = self.ioloop.time()
+
+        while queue.expires and queue.expires[0] <= now:
+            queue.expires.popleft()
+            body, properties, exchange, routing_key, _ = queue.messages.popleft()
+            self.stats['expired'] += 1
+
+            if queue.dead_letter is not None:
+                dead_letter_exchange, dead_letter_key = queue.dead_letter
+                self.publish(dead_letter_exchange, dead_letter_key or routing_key, body, properties)
+
+        self._schedule_expiry(queue)
+
+    def _route_topic(self, exchange, routing_key):
+        # As rotas de cada routing key são guardadas até o próximo binding:
+        route = (exchange, routing_key)
+        queues = self._topic_routes.get(route)
+
+        if queues is None:
+            words = routing_key.split('.')
+            queues = set()
+
+            for pattern, bound in self._bindings.get(exchange, {}).items():
+                if topic_matches(pattern.split('.'), words):
+                    queues.update(bound)
+
+            queues = self._topic_routes[route] = tuple(queues)
+
+        return queues
+
+    def consume(self, queue, consumer):
+        queue = self._queues[queue]
+        queue.consumers.append(consumer)
+        self._schedule(queue)
+
+    def cancel(self, queue, consumer):
+        queue = self._queues[queue]
+
+        try:
+            queue.consumers.remove(consumer)
+        except ValueError:
+            pass
+
+    def requeue(self, queue, message):
+        queue = self._queues[queue]
+        body, properties, exchange, routing_key, _ = message
+        queue.messages.appendleft((body, properties, exchange, routing_key, True))
+
+        if queue.ttl is not None:
+            # Simplificação: a mensagem devolvida vence como se tivesse acabado de chegar.
+            queue.expires.appendleft(self.ioloop.time() + queue.ttl)
+
+        self._schedule(queue)
+
+    def _schedule(self, queue):
+        if queue.scheduled or not queue.consumers:
+            return
+
+        queue.scheduled = True
+        self.ioloop.add_callback(self._dispatch, queue)
+
+    def _dispatch(self, queue, limit=4096):
+        """Entrega as mensagens da fila aos consumidores, em round-robin, respeitando o
+        prefetch de cada canal. Entrega no máximo `limit` mensagens por iteração do IOLoop,
+        como se fosse o que cabe no buffer do socket, para que as outras callbacks (acks,
+        confirms, timers) não fiquem esperando.
+
+        """
+        messages = queue.messages
+        consumers = queue.consumers
+        blocked = 0
+
+        if self.queue_rate:
+            paced = self._refill(queue) < limit
+            limit = min(limit, int(queue.credit))
+            budget = limit
+        else:
+            paced = False
+
+        while messages and limit and blocked < len(consumers):
+            consumer = consumers[0]
+            consumers.rotate(-1)
+
+            if not consumer.channel.has_capacity():
+                blocked += 1
+                continue
+
+            blocked = 0
+            limit -= 1
+            consumer.channel._deliver(consumer, messages.popleft())
+
+            if queue.ttl is not None:
+                queue.expires.popleft()
+
+        queue.scheduled = False
+
+        if self.queue_rate:
+            queue.credit -= budget - limit
+
+        if not limit and messages:
+            if paced:
+                # Sem fichas: a próxima entrega só quando a fila tiver capacidade de novo.
+                queue.scheduled = True
+                self.ioloop.call_later((1.0 - queue.credit % 1.0) / self.queue_rate, self._dispatch, queue)
+            else:
+                self._schedule(queue)
+
+    def _refill(self, queue):
+        """Repõe as fichas da fila pelo tempo passado, até 5 ms de entregas acumuladas."""
+        now = self.ioloop.time()
+        burst = max(1.0, self.queue_rate * 0.005)
+
+        queue.credit = min(burst, queue.credit + (now - queue.refilled_at) * self.queue_rate)
+        queue.refilled_at = now
+
+        return queue.credit
+
+
+class FakeTransport(object):
+    """Buffer de saída da conexão falsa: enquanto o broker a bloqueia (Connection.Blocked),
+    as publicações ficam aqui, como ficariam no buffer do socket de uma conexão real.
+
+    """
+    __slots__ = ('held', 'size')
+
+    def __init__(self):
+        self.held = deque()
+        self.size = 0
+
+    def get_write_buffer_size(self):
+        return self.size
+
+
+class FakeConsumer(object):
+    __slots__ = ('channel', 'queue', 'consumer_tag', 'callback', 'auto_ack')
+
+    def __init__(self, channel, queue, consumer_tag, callback, auto_ack=False):
+        self.channel = channel
+        self.queue = queue
+        self.consumer_tag = consumer_tag
+        self.callback = callback
+        self.auto_ack = auto_ack
+
+
+class FakeChannel(object):
+    """Canal compatível com a API assíncrona do `pika.channel.Channel` usada no projeto."""
+
+    _consumer_tags = count(1)
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+
+        self._broker = connection.broker
+        self._ioloop = connection.ioloop
+        self._open = True
+        self._on_close_callbacks = []
+        self._on_cancel_callbacks = []
+
+        self._consumers = {}
+        self._inbound = DelayLine(self._ioloop, self._process_inbound, self._broker.latency)
+        self._unacked = {}
+        self._unacked_bytes = 0
+        self._delivery_tag = 0
+        self._prefetch_count = 0
+        self._prefetch_size = 0
+
+        self._confirm_callback = None
+        self._publish_tag = 0
+        self._busy_until = 0.0
+        self._confirms = DelayLine(self._ioloop, self._send_confirms, self._broker.latency)
+
+    def __int__(self):
+        return self.channel_number
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def is_closed(self):
+        return not self._open
+
+    def _reply(self, callback, method):
+        if callback is not None:
+            self._broker.later(callback, frame.Method(self.channel_number, method))
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._on_cancel_callbacks.append(callback)
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, arguments=None, callback=None):
+        self._broker.exchange_declare(exchange, exchange_type)
+        self._reply(callback, spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue, passive=False, durable=False, exclusive=False,
+                      auto_delete=False, arguments=None, callback=None):
+        queue = self._broker.queue_declare(queue, arguments)
+        self._reply(callback, spec.Queue.DeclareOk(queue.name, len(queue.messages), len(queue.consumers)))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None, callback=None):
+        self._broker.queue_bind(queue, exchange, routing_key or queue)
+        self._reply(callback, spec.Queue.BindOk())
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self._confirm_callback = ack_nack_callback
+        self._reply(callback, spec.Confirm.SelectOk())
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if not self._open:
+            raise exceptions.ChannelWrongStateError('Channel is closed.')
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        if self.connection.blocked:
+            self.connection.hold(self, (exchange, routing_key, body, properties))
+            return
+
+        if self._confirm_callback is None:
+            self._broker.publish(exchange, routing_key, body, properties or pika.BasicProperties())
+            return
+
+        self._publish_tag += 1
+        at = None
+
+        # As publicações do canal são processadas uma de cada vez, a `channel_rate` por segundo:
+        if self._broker.channel_rate:
+            at = self._busy_until = max(self._ioloop.time(), self._busy_until) + 1.0 / self._broker.channel_rate
+
+        # Uma publicação recusada com Basic.Nack não chega às filas:
+        if self._broker.should_nack():
+            self._broker.stats['confirm_nacked'] += 1
+            self._confirms.push((self._publish_tag, False), at)
+            return
+
+        self._broker.publish(exchange, routing_key, body, properties or pika.BasicProperties())
+        self._confirms.push((self._publish_tag, True), at)
+
+    def _send_confirms(self, confirms):
+        if not self._open:
+            return
+
+        callback = self._confirm_callback
+        number = self.channel_number
+
+        if not self._broker.multiple_confirms:
+            for tag, acked in confirms:
+                method = spec.Basic.Ack(tag) if acked else spec.Basic.Nack(tag)
+                callback(frame.Method(number, method))
+            return
+
+        # Cada sequência de acks (ou de nacks) vira um único frame com multiple=True:
+        for index, (tag, acked) in enumerate(confirms):
+            if index + 1 < len(confirms) and confirms[index + 1][1] == acked:
+                continue
+
+            method = spec.Basic.Ack(tag, multiple=True) if acked else spec.Basic.Nack(tag, multiple=True)
+            callback(frame.Method(number, method))
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False, callback=None):
+        self._prefetch_size = prefetch_size
+        self._prefetch_count = prefetch_count
+        self._reply(callback, spec.Basic.QosOk())
+
+    def has_capacity(self):
+        """Se o prefetch do canal ainda permite entregar mais uma mensagem."""
+        if self._prefetch_count and len(self._unacked) >= self._prefetch_count:
+            return False
+
+        if self._prefetch_size and self._unacked_bytes >= self._prefetch_size:
+            return False
+
+        return True
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, exclusive=False,
+                      consumer_tag=None, arguments=None, callback=None):
+        consumer_tag = consumer_tag or 'ctag%i.%i' % (self.channel_number, next(self._consumer_tags))
+        consumer = FakeConsumer(self, queue, consumer_tag, on_message_callback, auto_ack)
+        self._consumers[consumer_tag] = consumer
+        self._broker.consume(queue, consumer)
+        self._reply(callback, spec.Basic.ConsumeOk(consumer_tag))
+
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag='', callback=None):
+        consumer = self._consumers.pop(consumer_tag, None)
+
+        if consumer is not None:
+            self._broker.cancel(consumer.queue, consumer)
+
+        self._reply(callback, spec.Basic.CancelOk(consumer_tag))
+
+    def _deliver(self, consumer, message):
+        body, properties, exchange, routing_key, redelivered = message
+        self._delivery_tag += 1
+        stats = self._broker.stats
+        stats['delivered'] += 1
+
+        # Com auto_ack a entrega já sai confirmada e não conta no prefetch:
+        if not consumer.auto_ack:
+            self._unacked[self._delivery_tag] = (consumer.queue, message)
+            self._unacked_bytes += len(body)
+
+        if len(self._unacked) > stats['max_unacked']:
+            stats['max_unacked'] = len(self._unacked)
+
+        # A entrega chega ao cliente em uma próxima iteração do IOLoop, como pela rede:
+        method = spec.Basic.Deliver(consumer.consumer_tag, self._delivery_tag, redelivered, exchange, routing_key)
+        self._inbound.push((consumer, method, properties, body))
+
+    def _process_inbound(self, deliveries):
+        for consumer, method, properties, body in deliveries:
+            if not self._open:
+                return
+
+            if self._consumers.get(consumer.consumer_tag) is not consumer:
+                # Como no pika: a entrega que chega depois do Basic.Cancel do consumidor é
+                # recusada pelo canal (e volta para a fila) sem passar pela callback.
+                if not consumer.auto_ack:
+                    self.basic_reject(method.delivery_tag)
+                continue
+
+            consumer.callback(self, method, properties, body)
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            # O dicionário está na ordem das delivery tags:
+            tags = []
+
+            for tag in self._unacked:
+                if delivery_tag and tag > delivery_tag:
+                    break
+
+                tags.append(tag)
+        else:
+            tags = [delivery_tag]
+
+        settled = [self._unacked.pop(tag) for tag in tags if tag in self._unacked]
+
+        for _, message in settled:
+            self._unacked_bytes -= len(message[0])
+
+        # Liberou espaço no prefetch, as filas consumidas por este canal voltam a entregar:
+        if settled and (self._prefetch_count or self._prefetch_size):
+            for consumer in self._consumers.values():
+                self._broker._schedule(self._broker.queue(consumer.queue))
+
+        return settled
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        stats = self._broker.stats
+        stats['ack_frames'] += 1
+        stats['acked'] += len(self._settle(delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        settled = self._settle(delivery_tag, multiple)
+        self._broker.stats['nacked'] += len(settled)
+
+        # Devolvidas na ordem original, já que a fila as recoloca no início:
+        for queue, message in reversed(settled):
+            if requeue:
+                self._broker.requeue(queue, message)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.basic_nack(delivery_tag, False, requeue)
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        self._terminate(exceptions.ChannelClosedByClient(reply_code, reply_text))
+
+    def _terminate(self, reason):
+        if not self._open:
+            return
+
+        self._open = False
+
+        for consumer in self._consumers.values():
+            self._broker.cancel(consumer.queue, consumer)
+
+        # As mensagens não confirmadas voltam para a fila, como no RabbitMQ:
+        for tag in sorted(self._unacked, reverse=True):
+            queue, message = self._unacked[tag]
+            self._broker.requeue(queue, message)
+
+        self._consumers.clear()
+        self._inbound.clear()
+        self._confirms.clear()
+        self._unacked.clear()
+        self._unacked_bytes = 0
+
+        self.connection._channels.pop(self.channel_number, None)
+
+        for callback in self._on_close_callbacks:
+            self._ioloop.add_callback(callback, self, reason)
+
+
+class FakeConnection(object):
+    """Conexão com a mesma assinatura do `TornadoConnection`, ligada ao `FakeBroker`.
+
+    Pode ser passada para o `Server` no lugar da conexão real:
+
+        Server(amqp_url, connection_class=FakeConnection)
+
+    """
+
+    def __init__(self, parameters=None, on_open_callback=None, on_open_error_callback=None,
+                 on_close_callback=None, custom_ioloop=None, broker=None):
+        # Um loop do asyncio (como o passado ao AsyncioConnection) é usado pelo IOLoop do Tornado:
+        if custom_ioloop is not None and not isinstance(custom_ioloop, IOLoop):
+            custom_ioloop = IOLoop.current()
+
+        self.broker = broker or FakeBroker.default()
+        self.ioloop = custom_ioloop or self.broker.ioloop
+        self.params = parameters
+
+        self._channels = {}
+        self._channel_number = count(1)
+        self._on_close_callbacks = []
+        self._blocked_callbacks = []
+        self._unblocked_callbacks = []
+        self._transport = FakeTransport()
+        self._open = False
+        self.blocked = False
+
+        if on_close_callback is not None:
+            self._on_close_callbacks.append(on_close_callback)
+
+        try:
+            self.broker.register(self)
+        except exceptions.AMQPConnectionError as error:
+            # Como no pika, a falha na abertura chega pela on_open_error_callback:
+            if on_open_error_callback is not None:
+                self.broker.later(on_open_error_callback, self, error)
+            else:
+                LOGGER.error('Falha ao abrir conexão falsa: %s', error)
+            return
+
+        self._open = True
+
+        if on_open_callback is not None:
+            self.broker.later(on_open_callback, self)
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def is_closed(self):
+        return not self._open
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_callback_threadsafe(self, callback):
+        self.ioloop.add_callback(callback)
+
+    def add_on_connection_blocked_callback(self, callback):
+        self._blocked_callbacks.append(callback)
+
+    def add_on_connection_unblocked_callback(self, callback):
+        self._unblocked_callbacks.append(callback)
+
+    def block(self, reason):
+        if self.blocked or not self._open:
+            return
+
+        self.blocked = True
+        method = frame.Method(0, spec.Connection.Blocked(reason))
+
+        for callback in self._blocked_callbacks:
+            self.broker.later(callback, self, method)
+
+    def hold(self, channel, publish):
+        """Guarda a publicação no buffer de saída enquanto a conexão está bloqueada."""
+        self._transport.held.append((channel, publish))
+        self._transport.size += len(publish[2])
+
+    def unblock(self):
+        """Desbloqueia a conexão; as publicações guardadas seguem na ordem."""
+        if not self.blocked:
+            return
+
+        self.blocked = False
+
+        held, self._transport.held = self._transport.held, deque()
+        self._transport.size = 0
+
+        for channel, publish in held:
+            if channel.is_open:
+                channel.basic_publish(*publish)
+
+        method = frame.Method(0, spec.Connection.Unblocked())
+
+        for callback in self._unblocked_callbacks:
+            self.broker.later(callback, self, method)
+
+    def channel(self, channel_number=None, on_open_callback=None):
+        channel = FakeChannel(self, channel_number or next(self._channel_number))
+        self._channels[channel.channel_number] = channel
+
+        if on_open_callback is not None:
+            self.broker.later(on_open_callback, channel)
+
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        LOGGER.debug('Fechando conexão falsa: (%s) %s', reply_code, reply_text)
+
+        self._terminate(exceptions.ConnectionClosedByClient(reply_code, reply_text), reply_code, reply_text)
+
+    def drop(self, reply_code=320, reply_text='CONNECTION_FORCED'):
+        """Fecha a conexão pelo lado do broker."""
+        LOGGER.debug('Conexão falsa derrubada: (%s) %s', reply_code, reply_text)
+
+        self._terminate(exceptions.ConnectionClosedByBroker(reply_code, reply_text), reply_code, reply_text)
+
+    def _terminate(self, reason, reply_code, reply_text):
+        if not self._open:
+            return
+
+        self.broker.unregister(self)
+
+        # O que estava no buffer de saída se perde com o socket:
+        self._transport.held.clear()
+        self._transport.size = 0
+        self.blocked = False
+
+        # Os canais de uma conexão fechada pelo cliente são fechados pelo cliente; numa
+        # queda, o pika repassa aos canais o mesmo erro da conexão.
+        for channel in list(self._channels.values()):
+            if isinstance(reason, exceptions.ConnectionClosedByClient):
+                channel.close(reply_code, reply_text)
+            else:
+                channel._terminate(reason)
+
+        self._open = False
+
+        for callback in self._on_close_callbacks:
+            self.ioloop.add_callback(callback, self, reason)
+
+
+class FakeBlockingChannel(object):
+    """Canal compatível com o `BlockingChannel` do pika, usado pelo `Client`. As chamadas
+    podem vir de outra thread: a publicação é entregue ao broker pelo IOLoop dele.
+
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._broker = connection.broker
+        self._open = True
+        self._confirming = False
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def is_closed(self):
+        return not self._open
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, arguments=None):
+        self._broker.ioloop.add_callback(self._broker.exchange_declare, exchange, exchange_type)
+
+    def confirm_delivery(self):
+        """Como no BlockingChannel: cada basic_publish espera a confirmação do broker e
+        levanta NackError se a mensagem for recusada.
+
+        """
+        self._confirming = True
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if self.connection.closed_reason is not None:
+            raise self.connection.closed_reason
+
+        if not self._open:
+            raise exceptions.ChannelWrongStateError('Channel is closed.')
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        properties = properties or pika.BasicProperties()
+
+        if not self._confirming:
+            self._broker.ioloop.add_callback(self._broker.publish, exchange, routing_key, body, properties)
+            return
+
+        confirmed = threading.Event()
+        result = []
+
+        def publish():
+            acked = not self._broker.should_nack()
+
+            if acked:
+                self._broker.publish(exchange, routing_key, body, properties)
+            else:
+                self._broker.stats['confirm_nacked'] += 1
+
+            result.append(acked)
+            confirmed.set()
+
+        self._broker.ioloop.add_callback(publish)
+        confirmed.wait()
+
+        if not result[0]:
+            raise exceptions.NackError([])
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        self._open = False
+
+
+class FakeBlockingConnection(object):
+    """Conexão com a mesma assinatura do `pika.BlockingConnection`, ligada ao `FakeBroker`.
+
+        Client(url, connection_class=FakeBlockingConnection)
+
+    """
+
+    def __init__(self, parameters=None, broker=None):
+        """
+        :raises pika.exceptions.AMQPConnectionError: o broker está recusando conexões
+
+        """
+        self.broker = broker or FakeBroker.default()
+        self.params = parameters
+        self.closed_reason = None
+        self._open = False
+
+        self.broker.register(self)
+        self._open = True
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def is_closed(self):
+        return not self._open
+
+    def channel(self, channel_number=None):
+        if not self._open:
+            raise exceptions.ConnectionWrongStateError('Connection is closed.')
+
+        return FakeBlockingChannel(self)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if self._open:
+            self.broker.unregister(self)
+
+        self._open = False
+
+    def drop(self, reply_code=320, reply_text='CONNECTION_FORCED'):
+        """Fecha a conexão pelo lado do broker; a próxima publicação levanta o erro."""
+        self.closed_reason = exceptions.ConnectionClosedByBroker(reply_code, reply_text)
+        self._open = False
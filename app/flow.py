@@ -0,0 +1,183 @@
+import time
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def write_buffer_size(connection):
+    """Bytes no buffer de saída da conexão (o que o pika ainda não conseguiu escrever no
+    socket); 0 se a conexão não tiver transporte (p.e. entre reconexões).
+
+    Lê o atributo privado `_transport` das conexões assíncronas do pika (testado com o
+    pika 1.1): se uma versão nova do pika não o tiver, o tamanho fica em 0 e o controle de
+    fluxo passa a contar só as mensagens aguardando confirmação.
+
+    """
+    transport = getattr(connection, '_transport', None)
+
+    try:
+        return transport.get_write_buffer_size() if transport is not None else 0
+    except AttributeError:
+        return 0
+
+
+class FlowControl(object):
+    """Controle de fluxo entre o consumo e a publicação do Servidor. Se o lado da publicação
+    satura, o consumo é pausado até ele esvaziar:
+
+    - `max_outstanding` mensagens publicadas aguardando confirmação;
+    - `max_buffer_bytes` bytes nos buffers de saída das conexões de publicação;
+    - um Connection.Blocked do RabbitMQ (alarme de memória ou disco) em alguma delas.
+
+    A checagem roda depois de cada publicação e, com o consumo em andamento, custa só a
+    leitura dos contadores. Pausado, um timer de `check_interval` segundos retoma o consumo
+    quando as confirmações pendentes e o buffer caem abaixo de `resume_ratio` dos limites e
+    nenhuma conexão está bloqueada. A histerese evita pausar e retomar a cada mensagem.
+
+    O que já foi entregue continua sendo processado e publicado: o excesso sobre os limites
+    fica limitado ao prefetch dos Consumers.
+
+    """
+
+    def __init__(self, outstanding, buffered, pause, resume, max_outstanding=10000,
+                 max_buffer_bytes=16 * 2 ** 20, pause_on_blocked=True, resume_ratio=0.5, check_interval=0.01,
+                 clock=time.monotonic):
+        """
+        :param callable outstanding: Mensagens aguardando confirmação
+        :param callable buffered: Bytes nos buffers de saída
+        :param callable pause: Pausa o consumo
+        :param callable resume: Retoma o consumo
+        :param int max_outstanding: Confirmações pendentes que pausam o consumo (None = sem limite)
+        :param int max_buffer_bytes: Bytes no buffer de saída que pausam o consumo (None = sem limite)
+        :param bool pause_on_blocked: Pausa o consumo enquanto alguma conexão de publicação
+            estiver bloqueada (Connection.Blocked)
+        :param float resume_ratio: Fração dos limites abaixo da qual o consumo é retomado
+        :param float check_interval: Intervalo, em segundos, das checagens enquanto pausado
+
+        """
+        self._outstanding = outstanding
+        self._buffered = buffered
+        self._pause = pause
+        self._resume = resume
+
+        self._max_outstanding = max_outstanding
+        self._max_buffer_bytes = max_buffer_bytes
+        self._pause_on_blocked = pause_on_blocked
+        self._resume_outstanding = max_outstanding * resume_ratio if max_outstanding else None
+        self._resume_buffer_bytes = max_buffer_bytes * resume_ratio if max_buffer_bytes else None
+        self._check_interval = check_interval
+        self._clock = clock
+
+        self._ioloop = None
+        self._timeout = None
+        self._blocked = set()
+
+        self.paused = False
+        self._paused_at = None
+        self._pauses = 0
+        self._paused_time = 0.0
+        self._blocks = 0
+        self._reasons = {}
+
+    def watch(self, connection):
+        """Acompanha o Connection.Blocked/Unblocked de uma conexão de publicação."""
+        self._ioloop = connection.ioloop
+
+        if self._pause_on_blocked and hasattr(connection, 'add_on_connection_blocked_callback'):
+            connection.add_on_connection_blocked_callback(self._on_blocked)
+            connection.add_on_connection_unblocked_callback(self._on_unblocked)
+
+    def _on_blocked(self, connection, method_frame):
+        LOGGER.warning('Conexão bloqueada pelo RabbitMQ: %s', method_frame.method.reason)
+
+        self._blocks += 1
+        self._blocked.add(connection)
+        self.check()
+
+    def _on_unblocked(self, connection, method_frame):
+        LOGGER.info('Conexão desbloqueada pelo RabbitMQ')
+
+        self._blocked.discard(connection)
+
+    def check(self):
+        """Pausa o consumo se a publicação saturou; chamado depois de cada publicação."""
+        if self.paused:
+            return
+
+        reason = self._saturation()
+
+        if reason is not None:
+            self._enter_pause(reason)
+
+    def _saturation(self):
+        if self._blocked:
+            return 'blocked'
+
+        if self._max_outstanding and self._outstanding() >= self._max_outstanding:
+            return 'outstanding'
+
+        if self._max_buffer_bytes and self._buffered() >= self._max_buffer_bytes:
+            return 'buffer'
+
+        return None
+
+    def _drained(self):
+        if self._blocked:
+            # Uma conexão que caiu bloqueada não bloqueia mais:
+            self._blocked = set(blocked for blocked in self._blocked if blocked.is_open)
+
+            if self._blocked:
+                return False
+
+        if self._resume_outstanding is not None and self._outstanding() > self._resume_outstanding:
+            return False
+
+        if self._resume_buffer_bytes is not None and self._buffered() > self._resume_buffer_bytes:
+            return False
+
+        return True
+
+    def _enter_pause(self, reason):
+        LOGGER.info('Publicação saturada (%s); pausando o consumo', reason)
+
+        self.paused = True
+        self._paused_at = self._clock()
+        self._pauses += 1
+        self._reasons[reason] = self._reasons.get(reason, 0) + 1
+
+        self._pause()
+        self._schedule()
+
+    def _schedule(self):
+        if self._ioloop is not None:
+            self._timeout = self._ioloop.call_later(self._check_interval, self._poll)
+
+    def _poll(self):
+        self._timeout = None
+
+        if not self._drained():
+            self._schedule()
+            return
+
+        LOGGER.info('Publicação esvaziada; retomando o consumo')
+
+        self._paused_time += self._clock() - self._paused_at
+        self._paused_at = None
+        self.paused = False
+
+        self._resume()
+
+    def stop(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    @property
+    def stats(self):
+        paused_time = self._paused_time
+
+        if self._paused_at is not None:
+            paused_time += self._clock() - self._paused_at
+
+        return dict(paused=self.paused, pauses=self._pauses, paused_time=paused_time, reasons=dict(self._reasons),
+                    blocked=bool(self._blocked), blocks=self._blocks)
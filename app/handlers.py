@@ -0,0 +1,307 @@
+import time
+import asyncio
+import inspect
+
+from tornado import gen
+
+from app.utils import pprint
+from app.message import Message
+
+
+class HandlerStats(object):
+    """Contadores de tempo de um handler registrado."""
+    __slots__ = ('name', 'calls', 'errors', 'total', 'max', 'histogram')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = None
+
+    def record(self, elapsed, failed=False):
+        self.calls += 1
+        self.total += elapsed
+
+        if self.histogram is not None:
+            self.histogram.observe(elapsed)
+
+        if failed:
+            self.errors += 1
+
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self):
+        return dict(
+            calls=self.calls,
+            errors=self.errors,
+            total=self.total,
+            mean=self.total / self.calls if self.calls else 0.0,
+            max=self.max,
+        )
+
+
+class Handler(object):
+    __slots__ = ('func', 'is_async', 'stats')
+
+    def __init__(self, message_type, func):
+        self.func = func
+        self.is_async = inspect.iscoroutinefunction(func)
+        self.stats = HandlerStats('%s:%s' % (message_type, getattr(func, '__qualname__', repr(func))))
+
+
+class HandlerRegistry(object):
+    """Registro de handlers de mensagens, indexado pelo campo `type` da mensagem
+    (temperatura, humidade, luminosidade, dioxido...).
+
+    Handlers podem ser funções comuns ou `async def`. Um handler registrado para `'*'`
+    recebe as mensagens de tipos sem handler próprio. Observadores (`observe`) ficam fora
+    dessa tabela: recebem todas as leituras dos seus tipos, além dos handlers.
+
+        registry = HandlerRegistry()
+
+        @registry.handler('temperatura')
+        async def on_temperatura(message):
+            ...
+
+    """
+    WILDCARD = '*'
+
+    def __init__(self):
+        self._handlers = {}
+        self._observers = []
+        self._latency = None
+        self.unhandled = 0
+
+    def register(self, message_type, func):
+        """Registra `func` para as mensagens do tipo `message_type`.
+
+        :param str message_type: The message `type` field, or '*' for any type
+        :param callable func: callable(message), sync or `async def`
+
+        """
+        handler = Handler(message_type, func)
+        self._handlers.setdefault(normalize_type(message_type), []).append(handler)
+
+        if self._latency is not None:
+            handler.stats.histogram = self._latency.labels(handler.stats.name)
+
+        return func
+
+    def observe(self, func, types=None):
+        """Registra `func` como observador das leituras dos tipos `types` (padrão: todos).
+        O Consumer chama os observadores no IOLoop com cada leitura, antes dos handlers e em
+        todos os caminhos (executor e lote vetorizado inclusive); o retorno é ignorado e eles
+        não tiram as leituras do curinga, p.e. o `app.aggregation.WindowAggregator`.
+
+        :param callable func: callable(message), síncrono
+        :param types: Tipos observados, ou None para todos
+
+        """
+        types = frozenset(normalize_type(agent_type) for agent_type in types) if types is not None else None
+        self._observers.append((types, func))
+
+        return func
+
+    @property
+    def observers(self):
+        return bool(self._observers)
+
+    def notify(self, message):
+        """Chama os observadores do tipo da mensagem. Exceções deles são propagadas."""
+        agent_type = message_type(message)
+
+        for types, func in self._observers:
+            if types is None or agent_type in types:
+                func(message)
+
+    def instrument(self, histogram):
+        """Registra também o tempo de cada chamada no histograma (`app.metrics.Histogram`
+        com o rótulo `handler`), para os handlers já registrados e os próximos.
+
+        """
+        self._latency = histogram
+
+        for handlers in self._handlers.values():
+            for handler in handlers:
+                handler.stats.histogram = histogram.labels(handler.stats.name)
+
+    def handler(self, message_type):
+        """Versão decorator do `register`."""
+        return lambda func: self.register(message_type, func)
+
+    def __contains__(self, message_type):
+        return normalize_type(message_type) in self._handlers
+
+    def _lookup(self, message):
+        agent_type = message_type(message)
+        handlers = self._handlers.get(agent_type) or self._handlers.get(self.WILDCARD)
+
+        if not handlers:
+            self.unhandled += 1
+
+        return handlers
+
+    def dispatch(self, message):
+        """Chama os handlers do tipo da mensagem.
+
+        Os handlers síncronos rodam imediatamente. Se algum handler for assíncrono, retorna
+        uma Future que termina quando todos eles terminarem; caso contrário retorna None.
+        Exceções dos handlers síncronos são propagadas.
+
+        """
+        handlers = self._lookup(message)
+
+        if not handlers:
+            return None
+
+        asynchronous = None
+        clock = time.perf_counter
+
+        for handler in handlers:
+            if handler.is_async:
+                # As corrotinas só são criadas depois que os síncronos rodarem sem erro:
+                if asynchronous is None:
+                    asynchronous = []
+
+                asynchronous.append(handler)
+                continue
+
+            started = clock()
+
+            try:
+                handler.func(message)
+            except Exception:
+                handler.stats.record(clock() - started, failed=True)
+                raise
+
+            handler.stats.record(clock() - started)
+
+        if asynchronous is None:
+            return None
+
+        pending = [self._run_async(handler, message) for handler in asynchronous]
+
+        return gen.multi(pending) if len(pending) > 1 else gen.convert_yielded(pending[0])
+
+    async def _run_async(self, handler, message):
+        clock = time.perf_counter
+        started = clock()
+
+        try:
+            result = await handler.func(message)
+        except Exception:
+            handler.stats.record(clock() - started, failed=True)
+            raise
+
+        handler.stats.record(clock() - started)
+
+        return result
+
+    def call(self, message):
+        """Chama o primeiro handler do tipo da mensagem e retorna o resultado, para as
+        requisições RPC: o valor, se o handler for síncrono, ou uma Future com ele.
+
+        :raises LookupError: não há handler para o tipo da mensagem
+
+        """
+        handlers = self._lookup(message)
+
+        if not handlers:
+            raise LookupError('Sem handler para o tipo %s' % (message_type(message),))
+
+        handler = handlers[0]
+
+        if handler.is_async:
+            return gen.convert_yielded(self._run_async(handler, message))
+
+        clock = time.perf_counter
+        started = clock()
+
+        try:
+            result = handler.func(message)
+        except Exception:
+            handler.stats.record(clock() - started, failed=True)
+            raise
+
+        handler.stats.record(clock() - started)
+
+        return result
+
+    def submit(self, executor, message):
+        """Submete os handlers do tipo da mensagem a um `concurrent.futures.Executor`
+        (ThreadPoolExecutor ou ProcessPoolExecutor), fora do IOLoop. Handlers `async def`
+        rodam em um event loop próprio dentro do worker.
+
+        Com ProcessPoolExecutor os handlers precisam ser picklable, ou seja, funções
+        definidas no nível do módulo.
+
+        Retorna uma lista de tuplas (handler, future) ou None se não há handler para o tipo.
+        Os tempos devem ser registrados com `record` quando cada future terminar.
+
+        """
+        handlers = self._lookup(message)
+
+        if not handlers:
+            return None
+
+        return [(handler, executor.submit(_timed_call, handler.func, message)) for handler in handlers]
+
+    @staticmethod
+    def record(handler, future):
+        """Registra nos contadores do handler o resultado de uma future de `submit`."""
+        if future.exception() is not None:
+            handler.stats.record(0.0, failed=True)
+        else:
+            handler.stats.record(future.result())
+
+    def stats(self):
+        """Contadores de cada handler: chamadas, erros e tempos (total, médio e máximo) em
+        segundos.
+
+        """
+        stats = dict((handler.stats.name, handler.stats.as_dict())
+                     for handlers in self._handlers.values() for handler in handlers)
+        stats['unhandled'] = self.unhandled
+
+        return stats
+
+
+def normalize_type(agent_type):
+    """O tipo como os handlers são registrados: em minúsculo, como no `Client`."""
+    return agent_type.lower() if isinstance(agent_type, str) else agent_type
+
+
+def message_type(message):
+    """O tipo normalizado da leitura (dict ou `Message`), ou None. É por ele que os handlers,
+    a agregação e o lote vetorizado comparam os tipos.
+
+    """
+    if isinstance(message, dict):
+        agent_type = message.get('type')
+    elif isinstance(message, Message):
+        # A `Message` preguiçosa tenta achar o tipo sem decodificar o corpo:
+        agent_type = message.type
+    else:
+        return None
+
+    return normalize_type(agent_type)
+
+
+def _timed_call(func, message):
+    """Executa o handler em um worker do executor e retorna o tempo gasto, em segundos."""
+    started = time.perf_counter()
+    result = func(message)
+
+    if inspect.iscoroutine(result):
+        asyncio.run(result)
+
+    return time.perf_counter() - started
+
+
+def pprint_sink(message):
+    """Sink de debug que imprime cada mensagem recebida no terminal."""
+    print("== Nova Mensagem ==")
+    pprint.pprint(message)
@@ -0,0 +1,172 @@
+import os
+import sys
+import copy
+import atexit
+import logging
+
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
+
+from app.utils import json, LOG_FORMAT
+
+DATE_FORMAT = "%d-%m-%Y %H:%M:%S"
+
+_listener = None
+_handler = None
+
+
+class _QueueHandler(QueueHandler):
+    """Como o QueueHandler, mas mantém a exceção fora da mensagem (`exc_text`), para que o
+    JsonFormatter a grave em um campo próprio.
+
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Um objeto JSON por linha: horário (epoch), nível, logger, mensagem e origem. Os
+    campos passados em `extra={'fields': {...}}` entram no objeto.
+
+        LOGGER.warning('Canal fechado', extra={'fields': {'channel': 1, 'reply_code': 406}})
+
+    """
+
+    def format(self, record):
+        entry = dict(
+            time=record.created,
+            level=record.levelname,
+            logger=record.name,
+            message=record.getMessage(),
+            source='%s:%i' % (record.filename, record.lineno),
+            process=record.process,
+        )
+
+        fields = getattr(record, 'fields', None)
+
+        if fields:
+            entry.update(fields)
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+def parse_levels(levels):
+    """'app.consumer=DEBUG,pika=WARNING' -> {'app.consumer': 'DEBUG', 'pika': 'WARNING'}"""
+    parsed = {}
+
+    for item in (levels or '').split(','):
+        if not item.strip():
+            continue
+
+        name, _, level = item.partition('=')
+
+        if not level:
+            raise ValueError('Nível de log por módulo deve ser modulo=NIVEL: %s' % (item,))
+
+        parsed[name.strip()] = level.strip().upper()
+
+    return parsed
+
+
+def add_arguments(parser):
+    """Opções de log da linha de comando; as omitidas ficam com o valor do ambiente."""
+    parser.add_argument("--log-level", default=None,
+                        help="Nível de log: [DEBUG | INFO | WARNING | ERROR] (padrão: LOG_LEVEL ou INFO)")
+
+    parser.add_argument("--log-levels", default=None,
+                        help="Níveis por módulo, p.e. app.consumer=DEBUG,pika=WARNING (padrão: LOG_LEVELS)")
+
+    parser.add_argument("--log-json", action='store_true', default=None,
+                        help="Logs em linhas JSON (padrão: LOG_JSON)")
+
+
+def configure_logging(level=None, levels=None, json_lines=None, path=None):
+    """Configura o logging do processo. Os parâmetros omitidos vêm do ambiente: LOG_LEVEL
+    (padrão INFO), LOG_LEVELS (níveis por módulo, p.e. 'app.consumer=DEBUG,pika=WARNING'),
+    LOG_JSON (1 para linhas JSON) e LOG_FILE (padrão: stderr).
+
+    Quem loga só monta a mensagem e coloca o registro em uma fila (QueueHandler); o formato
+    final (texto ou JSON) e a escrita acontecem na thread do QueueListener, e um terminal ou
+    disco lento não segura o IOLoop. Os níveis são checados antes de montar a mensagem, então
+    as chamadas abaixo do nível, com os argumentos passados ao LOGGER e não formatados na
+    hora, custam só a checagem.
+
+    :rtype: logging.handlers.QueueListener
+
+    """
+    global _listener, _handler
+
+    level = (level or os.getenv('LOG_LEVEL') or 'INFO').upper()
+    levels = parse_levels(levels if levels is not None else os.getenv('LOG_LEVELS'))
+    json_lines = json_lines if json_lines is not None else os.getenv('LOG_JSON', '') not in ('', '0')
+    path = path or os.getenv('LOG_FILE')
+
+    shutdown_logging()
+
+    target = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonFormatter() if json_lines else logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+
+    queue = SimpleQueue()
+    root = logging.getLogger()
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    _handler = _QueueHandler(queue)
+    _handler.setFormatter(logging.Formatter())
+
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+    for name, module_level in levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = QueueListener(queue, target, respect_handler_level=True)
+    _listener.start()
+
+    return _listener
+
+
+def shutdown_logging():
+    """Escreve o que ainda está na fila e para a thread de escrita."""
+    global _listener
+
+    listener, _listener = _listener, None
+
+    if listener is not None:
+        listener.stop()
+
+        for handler in listener.handlers:
+            handler.close()
+
+
+def _restart_in_child():
+    # Depois do fork (p.e. os workers do Supervisor) a thread de escrita não existe no filho, e
+    # o que estava na fila ainda vai ser escrito pelo pai: o filho recomeça com uma fila vazia.
+    # O QueueListener herdado do pai guarda a thread dele, que não existe aqui; um listener
+    # novo não depende de o `start` aceitar um listener que parece estar rodando.
+    global _listener
+
+    if _listener is not None:
+        _listener = QueueListener(SimpleQueue(), *_listener.handlers, respect_handler_level=True)
+        _handler.queue = _listener.queue
+        _listener.start()
+
+
+atexit.register(shutdown_logging)
+os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,141 @@
+from app.codec import JSONCodec, decode
+from app.batching import ENVELOPE_TYPE
+from app.compression import Decompressor
+from app.routing import ROUTING_PREFIX
+
+
+class InvalidMessage(ValueError):
+    """O corpo de uma `Message` não descomprime ou não decodifica. Levantada no primeiro acesso
+    a um campo, que pode ser dentro de um handler; o Consumer descarta a entrega (ou a manda
+    para a fila morta) em vez de devolvê-la para a fila, como faz no caminho sem `lazy`.
+
+    """
+
+
+class Message(object):
+    """Visão preguiçosa de uma entrega, usada pelo Consumer com `lazy=True` no lugar do dict
+    decodificado: guarda o corpo recebido (bytes, sem cópia) com o `basic_deliver` e as
+    `properties`, e só descomprime e decodifica no primeiro acesso a um campo.
+
+    Para os handlers ela se comporta como o dict da leitura (`message['message']`,
+    `message.get('_id')`). O `type` sai das propriedades ou da routing key
+    `sensor.<tipo>.<shard>` quando quem publicou o informou, então rotear ou filtrar pelo tipo
+    não decodifica o corpo. Repassada ao `Server.publish_message`, o Publisher coloca o corpo
+    original no envelope da publicação sem decodificá-lo e codificá-lo de novo, se o codec
+    for o mesmo (ver `app.codec.JSONCodec.wrap`).
+
+        @server.handlers.handler('temperatura')
+        def relay(message):
+            server.publish_message(message)
+
+    Um corpo inválido só levanta `InvalidMessage` (um ValueError) quando algum campo é lido.
+
+    """
+    __slots__ = ('body', 'basic_deliver', 'properties', '_decompressor', '_payload', '_data')
+
+    def __init__(self, body, basic_deliver, properties, decompressor=None):
+        """
+        :param bytes body: Corpo da entrega, como chegou (comprimido, se for o caso)
+        :param pika.spec.Basic.Deliver basic_deliver: basic_deliver method
+        :param pika.spec.BasicProperties properties: properties
+        :param app.compression.Decompressor decompressor: Usado, e contado, se o corpo
+            estiver comprimido
+
+        """
+        self.body = body
+        self.basic_deliver = basic_deliver
+        self.properties = properties
+
+        self._decompressor = decompressor
+        self._payload = None
+        self._data = None
+
+    @property
+    def content_type(self):
+        # Sem content_type a mensagem é JSON, o formato de antes dos codecs:
+        return self.properties.content_type or JSONCodec.content_type
+
+    @property
+    def payload(self):
+        """O corpo descomprimido, ainda codificado."""
+        if self._payload is None:
+            content_encoding = self.properties.content_encoding
+
+            if not content_encoding:
+                self._payload = self.body
+            else:
+                if self._decompressor is None:
+                    self._decompressor = Decompressor()
+
+                self._payload = self._decompressor.decompress(self.body, content_encoding)
+
+        return self._payload
+
+    @property
+    def data(self):
+        """A leitura decodificada (dict), decodificada no primeiro acesso.
+
+        :raises InvalidMessage: corpo inválido
+
+        """
+        if self._data is None:
+            try:
+                self._data = decode(self.payload, self.properties.content_type)
+            except ValueError as error:
+                raise InvalidMessage('Mensagem %s inválida: %s' % (self.basic_deliver.delivery_tag, error)) from error
+
+        return self._data
+
+    @property
+    def decoded(self):
+        return self._data is not None
+
+    @property
+    def type(self):
+        """O tipo da leitura, sem decodificar o corpo se ele estiver nas propriedades ou na
+        routing key dos shards.
+
+        """
+        message_type = self.properties.type
+
+        if message_type is not None and message_type != ENVELOPE_TYPE:
+            return message_type
+
+        words = self.basic_deliver.routing_key.split('.')
+
+        if len(words) == 3 and words[0] == ROUTING_PREFIX:
+            return words[1]
+
+        data = self.data
+
+        return data.get('type') if isinstance(data, dict) else None
+
+    # Um corpo que decodifica para algo que não é um dict (p.e. uma lista) não tem campos:
+    # os acessos se comportam como em um dict vazio, como o `type`.
+
+    def __getitem__(self, key):
+        data = self.data
+
+        if not isinstance(data, dict):
+            raise KeyError(key)
+
+        return data[key]
+
+    def __contains__(self, key):
+        data = self.data
+
+        return isinstance(data, dict) and key in data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def get(self, key, default=None):
+        data = self.data
+
+        return data.get(key, default) if isinstance(data, dict) else default
+
+    def keys(self):
+        return self.data.keys()
+
+    def __repr__(self):
+        return 'Message(%r)' % (self.data if self._data is not None else self.body,)
@@ -0,0 +1,163 @@
+import os
+import time
+import struct
+
+from collections import deque
+
+# Cabeçalho de cada registro no arquivo: tamanho do corpo e se ele está comprimido.
+_RECORD = struct.Struct('>IB')
+
+
+class OutageBuffer(object):
+    """Guarda, na ordem, as mensagens publicadas enquanto nenhum canal de publicação está
+    pronto, para serem publicadas de novo quando os canais voltarem.
+
+    Até `max_bytes` de corpos ficam em memória. Passando disso, se `spill_path` for
+    informado, as mensagens seguintes vão para esse arquivo (até `spill_bytes`) e são lidas
+    de volta depois das que estão em memória; sem arquivo, ou com ele cheio, a mensagem é
+    recusada. Só os corpos já codificados vão para o disco; as futures ficam em memória.
+
+    """
+
+    def __init__(self, max_bytes=8 * 2 ** 20, spill_path=None, spill_bytes=256 * 2 ** 20, clock=time.monotonic):
+        """
+        :param int max_bytes: Bytes de corpos guardados em memória
+        :param str spill_path: Arquivo para onde vão as mensagens que não cabem na memória
+        :param int spill_bytes: Bytes guardados no arquivo
+
+        """
+        self._max_bytes = max_bytes
+        self._spill_path = spill_path
+        self._spill_bytes = spill_bytes
+        self._clock = clock
+
+        self._memory = deque()
+        self._memory_bytes = 0
+
+        self._spill = None
+        self._spilled = deque() # Futures dos registros no arquivo, na ordem
+        self._write_at = 0
+        self._read_at = 0
+
+        self._high_water_bytes = 0
+        self._dropped = 0
+        self._replayed = 0
+
+        # Reenvio atual: início e mensagens reenviadas; a taxa do último reenvio completo:
+        self._replay_started = None
+        self._replay_count = 0
+        self._replay_rate = 0.0
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    @property
+    def nbytes(self):
+        return self._memory_bytes + self._write_at - self._read_at
+
+    def push(self, body, compressed, future):
+        """Guarda a mensagem. Retorna False se ela não coube (e a future não é guardada).
+
+        :param bytes body: Corpo já codificado (e comprimido, se for o caso)
+        :param bool compressed: Se o corpo está comprimido
+        :param concurrent.futures.Future future: Resolvida quando a mensagem for reenviada e confirmada
+
+        """
+        size = len(body)
+
+        # Depois que algo foi para o arquivo, as próximas também vão, para manter a ordem:
+        if not self._spilled and self._memory_bytes + size <= self._max_bytes:
+            self._memory.append((body, compressed, future))
+            self._memory_bytes += size
+        elif self._spill_path is not None and self._write_at - self._read_at + _RECORD.size + size <= self._spill_bytes:
+            self._write(body, compressed)
+            self._spilled.append(future)
+        else:
+            self._dropped += 1
+            return False
+
+        if self.nbytes > self._high_water_bytes:
+            self._high_water_bytes = self.nbytes
+
+        return True
+
+    def pop(self):
+        """A mensagem mais antiga: (corpo, comprimido, future)."""
+        if self._replay_started is None:
+            self._replay_started = self._clock()
+            self._replay_count = 0
+
+        if self._memory:
+            body, compressed, future = self._memory.popleft()
+            self._memory_bytes -= len(body)
+        else:
+            body, compressed = self._read()
+            future = self._spilled.popleft()
+
+        self._replayed += 1
+        self._replay_count += 1
+
+        if not len(self):
+            elapsed = self._clock() - self._replay_started
+            self._replay_rate = self._replay_count / elapsed if elapsed > 0 else float(self._replay_count)
+            self._replay_started = None
+
+        return body, compressed, future
+
+    def _write(self, body, compressed):
+        if self._spill is None:
+            self._spill = open(self._spill_path, 'w+b')
+
+        self._spill.seek(self._write_at)
+        self._spill.write(_RECORD.pack(len(body), compressed))
+        self._spill.write(body)
+        self._write_at += _RECORD.size + len(body)
+
+    def _read(self):
+        spill = self._spill
+        spill.flush()
+        spill.seek(self._read_at)
+
+        size, compressed = _RECORD.unpack(spill.read(_RECORD.size))
+        body = spill.read(size)
+        self._read_at += _RECORD.size + size
+
+        # Arquivo esvaziado: recomeça do início em vez de crescer para sempre.
+        if self._read_at == self._write_at:
+            spill.seek(0)
+            spill.truncate()
+            self._read_at = self._write_at = 0
+
+        return body, bool(compressed)
+
+    def clear(self):
+        """Descarta as mensagens guardadas, resolvendo as futures com False, e apaga o arquivo."""
+        futures = [future for _, _, future in self._memory]
+        futures.extend(self._spilled)
+
+        self._memory.clear()
+        self._spilled.clear()
+        self._memory_bytes = 0
+        self._read_at = self._write_at = 0
+        self._replay_started = None
+
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            os.remove(self._spill_path)
+
+        for future in futures:
+            if not future.done():
+                future.set_result(False)
+
+    @property
+    def stats(self):
+        return dict(
+            buffered=len(self),
+            buffered_bytes=self.nbytes,
+            spilled_bytes=self._write_at - self._read_at,
+            high_water_bytes=self._high_water_bytes,
+            dropped=self._dropped,
+            replayed=self._replayed,
+            replay_rate=self._replay_rate,
+        )
@@ -0,0 +1,366 @@
+import logging
+import functools
+import itertools
+
+from collections import deque
+from concurrent.futures import Future
+
+from app.utils import pika
+from app.backoff import Backoff
+from app.flow import write_buffer_size
+from app.outage import OutageBuffer
+from app.publisher import Publisher
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PublisherPool(object):
+    """Pool de N conexões x M canais de publicação, cada canal com o seu `Publisher`
+    (confirmações e lotes próprios). A primeira conexão é a do Servidor; as outras são
+    abertas pelo pool com a mesma classe de conexão e URL.
+
+    Cada mensagem vai para um canal pronto, escolhido em round-robin (`round_robin`) ou
+    pelo que tem menos mensagens aguardando confirmação (`least_outstanding`). Um canal
+    fechado por erro é substituído por outro na mesma conexão, sem derrubar a conexão; uma
+    conexão extra que cai é reaberta, com o mesmo backoff do Servidor.
+
+    Enquanto nenhum canal está pronto (p.e. durante uma queda do RabbitMQ) as mensagens vão
+    para um `OutageBuffer` e são reenviadas na ordem, `REPLAY_CHUNK` por iteração do IOLoop,
+    assim que um canal fica pronto. As republicações do Consumer e as respostas RPC esperam
+    em memória pelo primeiro canal pronto: cada uma segura uma entrega ainda não ackeada,
+    então o prefetch do Consumer já limita quantas esperam.
+
+        Server(publisher_options=dict(connections=2, channels=4, selection='least_outstanding'))
+
+    """
+    SELECTIONS = ('round_robin', 'least_outstanding')
+    REPLAY_CHUNK = 500
+
+    def __init__(self, server_instance, queue, exchange, exchange_type, connections=1, channels=1,
+                 selection='round_robin', buffer_bytes=8 * 2 ** 20, spill_path=None, spill_bytes=256 * 2 ** 20,
+                 **publisher_options):
+        """
+        :param int connections: Conexões usadas para publicar (a primeira é a do Servidor)
+        :param int channels: Canais de publicação por conexão
+        :param str selection: round_robin ou least_outstanding
+        :param int buffer_bytes: Bytes guardados em memória durante uma queda (0 = sem buffer:
+            as mensagens sem canal pronto são recusadas)
+        :param str spill_path: Arquivo para as mensagens da queda que não cabem na memória
+        :param int spill_bytes: Bytes guardados no arquivo
+        :param publisher_options: Opções repassadas a cada Publisher (p.e. batch_size)
+
+        """
+        if selection not in self.SELECTIONS:
+            raise ValueError('Seleção de canal desconhecida: %s' % (selection,))
+
+        self._server = server_instance
+        self._connection_count = max(1, connections)
+        self._channels_per_connection = max(1, channels)
+        self._least_outstanding = selection == 'least_outstanding'
+
+        self._publishers = [
+            Publisher(server_instance, queue, exchange, exchange_type,
+                      on_channel_closed=self._on_channel_closed, on_ready=self._on_publisher_ready,
+                      **publisher_options)
+            for _ in range(self._connection_count * self._channels_per_connection)]
+
+        self._outage = None
+
+        if buffer_bytes or spill_path is not None:
+            self._outage = OutageBuffer(buffer_bytes, spill_path, spill_bytes)
+
+        self._replay_scheduled = False
+        self._deferred = deque()
+
+        self._connections = [None] * self._connection_count
+        self._backoff = [Backoff(**server_instance._reconnect_options) for _ in range(self._connection_count)]
+        self._next = itertools.cycle(self._publishers)
+        self._closing = False
+        self._started = False
+
+        self._replaced = 0
+        self._unavailable = 0
+
+    def _slot(self, index):
+        """Publishers da conexão `index`."""
+        start = index * self._channels_per_connection
+        return self._publishers[start:start + self._channels_per_connection]
+
+    def open(self, connection):
+        """Abre os canais na conexão do Servidor (a primeira do pool) e, na primeira vez, as
+        conexões extras.
+
+        """
+        self._closing = False
+        self._attach(0, connection)
+
+        if not self._started:
+            self._started = True
+
+            for index in range(1, self._connection_count):
+                self._connect(index)
+
+    def _connect(self, index):
+        if self._closing:
+            return
+
+        LOGGER.info('Abrindo Conexão %i do pool de publicação', index)
+
+        self._connections[index] = self._server._connection_class(
+            pika.URLParameters(self._server._url),
+            on_open_callback=functools.partial(self._attach, index),
+            on_open_error_callback=functools.partial(self._on_connection_lost, index),
+            on_close_callback=functools.partial(self._on_connection_lost, index))
+
+    def _attach(self, index, connection):
+        self._connections[index] = connection
+        self._backoff[index].reset()
+        self._server.flow.watch(connection)
+
+        for publisher in self._slot(index):
+            connection.channel(on_open_callback=publisher.on_channel_open)
+
+    def _on_connection_lost(self, index, connection, reason):
+        if self._closing:
+            return
+
+        delay = self._backoff[index].next_delay()
+
+        LOGGER.warning('Conexão %i do pool de publicação perdida; reabrindo em %.3f s: %s',
+                       index, delay, reason)
+
+        self._server.connection.ioloop.call_later(delay, self._connect, index)
+
+    def _on_channel_closed(self, publisher, channel, reason):
+        """Substitui um canal fechado por erro de canal, na mesma conexão."""
+        connection = channel.connection
+
+        if self._closing or not connection.is_open:
+            return
+
+        LOGGER.warning('Substituindo canal %i do pool de publicação: %s', channel, reason)
+
+        self._replaced += 1
+        connection.channel(on_open_callback=publisher.on_channel_open)
+
+    def _select(self):
+        """O próximo Publisher pronto, ou None se nenhum canal está pronto."""
+        if self._least_outstanding:
+            best = None
+
+            for publisher in self._publishers:
+                if publisher.ready and (best is None or publisher.outstanding < best.outstanding):
+                    best = publisher
+
+            return best
+
+        for _ in range(len(self._publishers)):
+            publisher = next(self._next)
+
+            if publisher.ready:
+                return publisher
+
+        return None
+
+    def start_publishing(self, message):
+        """Publica a mensagem por um dos canais do pool; mesma interface do
+        `Publisher.start_publishing`. Sem canal pronto, ou com mensagens da queda ainda por
+        reenviar, a mensagem entra no fim do buffer da queda.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        outage = self._outage
+        publisher = None if outage is not None and len(outage) else self._select()
+
+        if publisher is not None:
+            return publisher.start_publishing(message)
+
+        future = Future()
+
+        if outage is None or self._closing or not outage.push(*self._publishers[0].encode(message), future=future):
+            self._unavailable += 1
+            future.set_result(False)
+            return future # Nenhum canal pronto e sem espaço no buffer
+
+        if not self._replay_scheduled and self._select() is not None:
+            self._schedule_replay()
+
+        return future
+
+    def reply(self, reply_to, correlation_id, payload):
+        """Publica a resposta de uma requisição RPC por um dos canais do pool; mesma interface
+        do `Publisher.reply`. Sem canal pronto a resposta é codificada na hora (um resultado
+        que não codifica levanta a exceção para o Consumer) e espera o primeiro canal pronto,
+        em vez de a requisição voltar para a fila e ser reentregue sem parar.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        publisher = self._select()
+
+        if publisher is not None:
+            return publisher.reply(reply_to, correlation_id, payload)
+
+        body, properties = self._publishers[0].encode_reply(correlation_id, payload)
+
+        return self._defer(reply_to, body, properties)
+
+    def republish(self, queue, body, properties):
+        """Republica um corpo já codificado na fila `queue` por um dos canais do pool; mesma
+        interface do `Publisher.republish`. Sem canal pronto a republicação espera o primeiro
+        canal pronto, em vez de quem republica devolver a entrega para a fila e o RabbitMQ
+        reentregá-la sem parar.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        publisher = self._select()
+
+        if publisher is not None:
+            return publisher.republish(queue, body, properties)
+
+        return self._defer(queue, body, properties)
+
+    def _defer(self, queue, body, properties):
+        """Guarda a publicação na fila `queue` até um canal ficar pronto. Com o pool fechando
+        a future termina com False.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        future = Future()
+
+        if self._closing:
+            self._unavailable += 1
+            future.set_result(False)
+            return future
+
+        self._deferred.append((queue, body, properties, future))
+
+        return future
+
+    def _send_deferred(self):
+        """Publica as republicações e respostas que esperavam um canal pronto."""
+        deferred = self._deferred
+
+        while deferred and not self._closing:
+            publisher = self._select()
+
+            if publisher is None:
+                return
+
+            queue, body, properties, future = deferred.popleft()
+            published = publisher.republish(queue, body, properties)
+            published.add_done_callback(functools.partial(_forward, future))
+
+    def _on_publisher_ready(self, publisher):
+        if self._deferred:
+            self._send_deferred()
+
+        if self._outage is not None and len(self._outage):
+            self._schedule_replay()
+
+    def _schedule_replay(self):
+        if not self._replay_scheduled:
+            self._replay_scheduled = True
+            self._server.connection.ioloop.add_callback(self._replay)
+
+    def _replay(self):
+        """Reenvia até REPLAY_CHUNK mensagens do buffer da queda e agenda o resto para a
+        próxima iteração do IOLoop. Para se não houver canal pronto; o próximo canal que
+        ficar pronto retoma.
+
+        """
+        self._replay_scheduled = False
+        outage = self._outage
+
+        for _ in range(self.REPLAY_CHUNK):
+            if self._closing or not len(outage):
+                return
+
+            publisher = self._select()
+
+            if publisher is None:
+                return
+
+            publisher.enqueue(*outage.pop())
+
+        if len(outage):
+            self._schedule_replay()
+
+    @property
+    def channel(self):
+        """O primeiro canal de publicação aberto, ou None."""
+        for publisher in self._publishers:
+            if publisher.channel is not None and publisher.channel.is_open:
+                return publisher.channel
+
+        return None
+
+    def close_channel(self):
+        """Fecha todos os canais de publicação e as conexões extras."""
+        self._closing = True
+
+        for publisher in self._publishers:
+            if publisher.channel is not None and publisher.channel.is_open:
+                publisher.close_channel()
+
+        for connection in self._connections[1:]:
+            if connection is not None and connection.is_open:
+                connection.close()
+
+        deferred, self._deferred = self._deferred, deque()
+
+        for _, _, _, future in deferred:
+            future.set_result(False)
+
+        if self._outage is not None:
+            self._outage.clear()
+
+    @property
+    def outstanding(self):
+        """Mensagens nos buffers ou aguardando confirmação, em todos os canais."""
+        return sum(publisher.outstanding for publisher in self._publishers)
+
+    @property
+    def write_buffer_size(self):
+        """Bytes nos buffers de saída das conexões de publicação."""
+        return sum(write_buffer_size(connection) for connection in self._connections
+                   if connection is not None and connection.is_open)
+
+    @property
+    def confirm_stats(self):
+        stats = [publisher.confirm_stats for publisher in self._publishers]
+
+        return dict(
+            outstanding=sum(item['outstanding'] for item in stats),
+            oldest_age=max(item['oldest_age'] for item in stats),
+            high_water_mark=sum(item['high_water_mark'] for item in stats),
+        )
+
+    @property
+    def stats(self):
+        """Totais do pool e os contadores de cada canal (`channels`)."""
+        channels = [publisher.stats for publisher in self._publishers]
+
+        stats = dict(
+            published=sum(item['published'] for item in channels),
+            acked=sum(item['acked'] for item in channels),
+            nacked=sum(item['nacked'] for item in channels),
+            replaced_channels=self._replaced,
+            unavailable=self._unavailable,
+            deferred=len(self._deferred),
+            channels=channels,
+        )
+        stats.update(self.confirm_stats)
+
+        if self._outage is not None:
+            stats['outage'] = self._outage.stats
+
+        return stats
+
+
+def _forward(future, published):
+    """Passa o resultado da publicação feita por um canal para a future devolvida antes dela."""
+    future.set_result(published.result())
@@ -1,19 +1,82 @@
-from app.utils import uuid4, json, LOGGER
+import logging
+import time
+
+from concurrent.futures import Future
+
+from pika import exceptions
+
+from app.utils import pika, uuid4
+from app.confirms import ConfirmTracker
+from app.codec import get_codec
+from app.message import Message
+from app.compression import Compressor
+
+LOGGER = logging.getLogger(__name__)
 
 
 class Publisher(object):
-    def __init__(self, server_instance, queue, exchange, exchange_type):
+    def __init__(self, server_instance, queue, exchange, exchange_type, batch_size=1, batch_interval=10,
+                 codec='json', compression=None, compression_threshold=1024, on_channel_closed=None,
+                 on_ready=None, metrics=None):
+        """
+        :param int batch_size: Quantidade de mensagens acumuladas antes de publicar o lote.
+            Com 1 as mensagens são publicadas assim que chegam
+        :param int batch_interval: Tempo máximo, em milissegundos, que uma mensagem espera
+            no buffer antes do lote ser publicado
+        :param str codec: Codec das mensagens (json ou msgpack), sinalizado no content_type
+        :param str compression: Compressão (zlib ou lzma) dos corpos maiores que
+            `compression_threshold` bytes, sinalizada no content_encoding
+        :param callable on_channel_closed: Chamado com (publisher, channel, reason) quando o
+            canal fecha por um erro de canal, p.e. pelo `PublisherPool` para abrir outro.
+            Sem ele a conexão inteira é fechada
+        :param callable on_ready: Chamado com (publisher) quando o canal fica pronto para
+            publicar, depois do Confirm.SelectOk
+        :param app.metrics.Registry metrics: Registro onde a latência das confirmações é medida
+
+        """
         self._channel = None
         self._server = server_instance
         self._queue = queue
         self._exchange = exchange
         self._exchange_type = exchange_type
+        self._on_closed = on_channel_closed
+        self._on_ready = on_ready
 
 
-        self._deliveries = []
+        self._deliveries = ConfirmTracker()
         self._acked = 0
         self._nacked = 0
         self._message_number = 0
+
+        # Publicação em lote:
+        self._batch_size = max(1, batch_size)
+        self._batch_interval = batch_interval
+        self._buffer = []
+        self._flush_timeout = None
+
+        # Confirmações de entrega - delivery tag do canal atual:
+        self._confirming = False
+        self._delivery_tag = 0
+
+        # Montados uma única vez e reaproveitados em todas as publicações:
+        self._codec = get_codec(codec)
+        self._properties = pika.BasicProperties(app_id='example-publisher', content_type=self._codec.content_type)
+        self._encode = self._codec.encode
+        self._wrap = getattr(self._codec, 'wrap', None)
+
+        self._confirm_latency = None
+
+        if metrics is not None:
+            self._confirm_latency = metrics.histogram(
+                'publish_confirm_latency_seconds', 'Tempo entre a publicação e o Basic.Ack/Nack do RabbitMQ')
+
+        self._compressor = None
+
+        if compression is not None:
+            self._compressor = Compressor(compression, compression_threshold)
+            self._compressed_properties = pika.BasicProperties(
+                app_id='example-publisher', content_type=self._codec.content_type,
+                content_encoding=self._compressor.content_encoding)
     
 
     @property
@@ -30,9 +93,11 @@ class Publisher(object):
         :param pika.channel.Channel channel: The channel object
 
         """
-        LOGGER.debug('Canal Publisher Aberto {}'.format(channel))
+        LOGGER.debug('Canal Publisher Aberto %s', channel)
         
         self._channel = channel
+        self._confirming = False
+        self._delivery_tag = 0
         
         self._add_on_channel_close_callback(channel)
         
@@ -50,7 +115,7 @@ class Publisher(object):
 
 
     ### - 1.1.1
-    def _on_channel_closed(self, channel, reply_code, reply_text):
+    def _on_channel_closed(self, channel, reason):
         """Chamado pelo pika quando o RabbitMq fecha inesperadamente o canal.
         
         Os canais geralmente são fechados se você tentar fazer algo que
@@ -59,18 +124,26 @@ class Publisher(object):
         para desligar o objeto.
 
         :param pika.channel.Channel: The closed channel
-        :param int reply_code: The numeric reason the channel was closed
-        :param str reply_text: The text reason the channel was closed
+        :param Exception reason: why the channel was closed
 
         """
-        LOGGER.warning('Channel %i foi fechado: (%s) %s',
-                       channel, reply_code, reply_text)
+        LOGGER.warning('Channel %i foi fechado: %s', channel, reason)
+
+        self._confirming = False
+        self._fail_pending()
+
+        if isinstance(reason, exceptions.AMQPConnectionError):
+            # A conexão caiu junto com o canal; o Servidor reconecta e reabre os canais.
+            return
         
-        #TODO: Enviar pro Bot de monitoramento a motivação do erro:
-        message = "Reply Code %s - %s", (reply_code, reply_text)
-        self._monitoring.send(application="Servidor/Publisher", message=message)
+        #TODO: Enviar pro Bot de monitoramento a motivação do erro
+
+        if self._on_closed is not None:
+            self._on_closed(self, channel, reason)
+            return
         
-        self._server.connection.close()
+        if self._server.connection.is_open:
+            self._server.connection.close()
 
 
     ## - 1.2
@@ -144,12 +217,14 @@ class Publisher(object):
         
         LOGGER.info('Queue Publisher Bound')
 
+        self._enable_delivery_confirmations()
+
 
     def close_channel(self):
         LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ to close Publish Channel')
         self._channel.basic_cancel("", callback=self._on_cancelok)
 
-    def _on_cancelok(self):
+    def _on_cancelok(self, unused_frame):
         LOGGER.info('RabbitMQ acknowledged the cancellation of the consumer')
         LOGGER.info('Closing the channel')
         self._channel.close()        
@@ -159,39 +234,185 @@ class Publisher(object):
     PARTE REFERENTE AO PUBLISHER DE MENSAGEM:
     """
     def start_publishing(self, message):
-        """This method will enable delivery confirmations and schedule the
-        first message to be sent to RabbitMQ
+        """Coloca a mensagem no buffer de publicação. O buffer é descarregado para o RabbitMQ
+        quando atinge `batch_size` mensagens ou quando `batch_interval` milissegundos se passam,
+        o que acontecer primeiro.
+
+        Retorna um `concurrent.futures.Future` que é resolvido com True quando o RabbitMQ
+        confirma (Basic.Ack) a mensagem, ou com False quando ela é recusada (Basic.Nack) ou
+        não pôde ser publicada.
+
+        :rtype: concurrent.futures.Future
 
         """
-        LOGGER.info('Issuing consumer related RPC commands')
-        
-        self._enable_delivery_confirmations()
+        future = Future()
 
         if self._channel is None or not self._channel.is_open:
-            return # Sem canal aberto
+            future.set_result(False)
+            return future # Sem canal aberto
 
-        #hdrs = {u'مفتاح': u' قيمة', u'键': u'值', u'キー': u'値'}
-        #message = u'مفتاح قيمة 键 值 キー 値'
+        body, compressed = self.encode(message)
 
-        #Formatando de forma adequada a mensagem:
-        message = dict(data=message, _id=str(uuid4()))
+        return self.enqueue(body, compressed, future)
 
-        LOGGER.info("Mensagem para dispachar: %s" % (message,))
+    def encode(self, message):
+        """Formata e codifica a mensagem. Retorna o corpo e se ele foi comprimido. Uma
+        `app.message.Message` no mesmo codec do Publisher é repassada sem ser decodificada.
 
-        properties = pika.BasicProperties(app_id='example-publisher', content_type='application/json') #, headers=hdrs
-        
-        self._channel.basic_publish(self._server.EXCHANGE_CORE_TO_SENDER, self._server.ROUTING_KEY,
-                                            json.dumps(message),
-                                            properties)
-        self._message_number += 1
-        self._deliveries.append(self._message_number)
-        
-        LOGGER.info('Mensagem Publicada # %i', self._message_number)
+        :rtype: (bytes, bool)
+
+        """
+        _id = str(uuid4())
+
+        if isinstance(message, Message) and self._wrap is not None \
+                and message.content_type == self._codec.content_type:
+            # Repasse: o corpo recebido entra no envelope como está, sem decodificar e
+            # codificar de novo.
+            body = self._wrap(message.payload, _id)
+        else:
+            if isinstance(message, Message):
+                message = message.data
+
+            #Formatando de forma adequada a mensagem:
+            message = dict(data=message, _id=_id)
+
+            LOGGER.debug('Mensagem para dispachar: %s', message)
+
+            body = self._encode(message)
+
+        if self._compressor is not None:
+            body, content_encoding = self._compressor.compress(body)
+            return body, content_encoding is not None
+
+        return body, False
+
+    def enqueue(self, body, compressed, future):
+        """Coloca no buffer de publicação uma mensagem já codificada por `encode`, p.e. uma
+        guardada durante uma queda e reenviada pelo `PublisherPool`.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        properties = self._compressed_properties if compressed else self._properties
+
+        return self._append(body, properties, future)
+
+    def reply(self, reply_to, correlation_id, payload):
+        """Publica a resposta de uma requisição RPC na fila `reply_to`, pelo exchange padrão,
+        com o `correlation_id` da requisição. A resposta passa pelo mesmo buffer e pelas mesmas
+        confirmações das outras mensagens.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        future = Future()
+
+        if self._channel is None or not self._channel.is_open:
+            future.set_result(False)
+            return future # Sem canal aberto
+
+        body, properties = self.encode_reply(correlation_id, payload)
+
+        return self._append(body, properties, future, reply_to)
+
+    def encode_reply(self, correlation_id, payload):
+        """Corpo e propriedades da resposta de uma requisição RPC, como o `reply` publica;
+        p.e. para o `PublisherPool` guardar a resposta, já codificada, até um canal ficar pronto.
+
+        :rtype: tuple(bytes, pika.BasicProperties)
+
+        """
+        body = self._encode(payload)
+        content_encoding = None
+
+        if self._compressor is not None:
+            body, content_encoding = self._compressor.compress(body)
+
+        properties = pika.BasicProperties(app_id='example-publisher', content_type=self._codec.content_type,
+                                          content_encoding=content_encoding, correlation_id=correlation_id)
+
+        return body, properties
+
+    def republish(self, queue, body, properties):
+        """Publica um corpo já codificado, com as suas propriedades, na fila `queue` pelo
+        exchange padrão, com confirmação: p.e. a entrega que o Consumer manda para uma fila de
+        atraso ou para a fila morta, ackeada só depois da confirmação.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        future = Future()
+
+        if self._channel is None or not self._channel.is_open:
+            future.set_result(False)
+            return future # Sem canal aberto
+
+        return self._append(body, properties, future, queue)
+
+    def _append(self, body, properties, future, queue=None):
+        self._buffer.append((body, properties, future, queue))
+
+        if len(self._buffer) >= self._batch_size:
+            self._flush()
+        elif self._flush_timeout is None:
+            self._flush_timeout = self._server.connection.ioloop.call_later(
+                self._batch_interval / 1000.0, self._on_flush_timeout)
+
+        return future
+
+    def _on_flush_timeout(self):
+        self._flush_timeout = None
+        self._flush()
+
+    def _flush(self):
+        """Publica todas as mensagens do buffer. Enquanto o Confirm.Select não for confirmado
+        pelo RabbitMQ as mensagens continuam no buffer, pois as delivery tags só passam a ser
+        contadas a partir dele.
+
+        """
+        if self._flush_timeout is not None:
+            self._server.connection.ioloop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+
+        if not self._buffer or not self._confirming:
+            return
+
+        if not self._channel.is_open:
+            self._fail_pending()
+            return
+
+        buffer, self._buffer = self._buffer, []
+        exchange, routing_key = self._server.EXCHANGE_CORE_TO_SENDER, self._server.ROUTING_KEY
+
+        for body, properties, future, queue in buffer:
+            if queue is None:
+                self._channel.basic_publish(exchange, routing_key, body, properties)
+            else:
+                # Resposta RPC ou republicação: direto para a fila, pelo exchange padrão.
+                self._channel.basic_publish('', queue, body, properties)
+
+            self._delivery_tag += 1
+            self._deliveries.add(self._delivery_tag, future)
+
+        self._message_number += len(buffer)
+
+        LOGGER.debug('Lote de %i mensagens publicado (total # %i)', len(buffer), self._message_number)
+
+    def _fail_pending(self):
+        """Resolve com False as futures das mensagens que ficaram sem confirmação."""
+        buffer, self._buffer = self._buffer, []
+
+        for _, _, future, _ in buffer:
+            future.set_result(False)
+
+        for _, future in self._deliveries.clear():
+            if future is not None:
+                future.set_result(False)
 
     def _enable_delivery_confirmations(self):
         """Send the Confirm.Select RPC method to RabbitMQ to enable delivery
         confirmations on the channel. The only way to turn this off is to close
-        the channel and create a new one.
+        the channel and create a new one, so it is issued once per channel.
 
         When the message is confirmed from RabbitMQ, the
         on_delivery_confirmation method will be invoked passing in a Basic.Ack
@@ -200,7 +421,22 @@ class Publisher(object):
 
         """
         LOGGER.info('Issuing Confirm.Select RPC command')
-        self._channel.confirm_delivery(self._on_delivery_confirmation)
+        self._channel.confirm_delivery(self._on_delivery_confirmation, callback=self._on_confirm_selectok)
+
+    def _on_confirm_selectok(self, unused_frame):
+        """Invocado pelo pika quando o RabbitMQ responde o Confirm.Select. A partir daqui
+        as mensagens já podem ser publicadas.
+
+        :param pika.frame.Method unused_frame: Confirm.SelectOk response frame
+
+        """
+        LOGGER.info('Confirmações de entrega habilitadas')
+
+        self._confirming = True
+        self._flush()
+
+        if self._on_ready is not None:
+            self._on_ready(self)
     
     def _on_delivery_confirmation(self, method_frame):
         """Chamado pelo pika quando o RabbitMQ responde a um comando de Basic.Publish RPC,
@@ -220,21 +456,64 @@ class Publisher(object):
         """
         
         confirmation_type = method_frame.method.NAME.split('.')[1].lower()
-        LOGGER.info('Recebido %s para delivery tag: %i',
+        LOGGER.debug('Recebido %s para delivery tag: %i (multiple=%s)',
                     confirmation_type,
-                    method_frame.method.delivery_tag)
-        
-        if confirmation_type == 'ack':
-            self._acked += 1
-        elif confirmation_type == 'nack':
-            self._nacked += 1
-        
-        self._deliveries.remove(method_frame.method.delivery_tag)
+                    method_frame.method.delivery_tag,
+                    method_frame.method.multiple)
+
+        # Com multiple=True o RabbitMQ confirma todas as tags até a informada de uma só vez:
+        confirmed = self._deliveries.confirm(method_frame.method.delivery_tag, method_frame.method.multiple)
+        acked = confirmation_type == 'ack'
+
+        if acked:
+            self._acked += len(confirmed)
+        else:
+            self._nacked += len(confirmed)
+
+        if self._confirm_latency is not None:
+            # Mesmo relógio do ConfirmTracker:
+            now = time.monotonic()
+            observe = self._confirm_latency.observe
+
+            for published_at, _ in confirmed:
+                observe(now - published_at)
+
+        for _, future in confirmed:
+            if future is not None:
+                future.set_result(acked)
         
-        LOGGER.info('Published %i messages, %i have yet to be confirmed, '
+        LOGGER.debug('Published %i messages, %i have yet to be confirmed, '
                     '%i were acked and %i were nacked',
                     self._message_number, len(self._deliveries),
                     self._acked, self._nacked)
 
+    @property
+    def ready(self):
+        """Se o canal está aberto e com as confirmações de entrega habilitadas."""
+        return self._confirming and self._channel is not None and self._channel.is_open
+
+    @property
+    def outstanding(self):
+        """Mensagens no buffer ou aguardando confirmação do RabbitMQ."""
+        return len(self._buffer) + len(self._deliveries)
+
+    @property
+    def confirm_stats(self):
+        """Estatísticas das confirmações pendentes: quantidade, idade da mais antiga (s) e
+        o maior número de pendentes já observado.
+
+        """
+        return self._deliveries.stats()
+
+    @property
+    def stats(self):
+        stats = dict(published=self._message_number, acked=self._acked, nacked=self._nacked)
+        stats.update(self._deliveries.stats())
+
+        if self._compressor is not None:
+            stats['compression'] = self._compressor.stats.as_dict()
+
+        return stats
+
 
 
@@ -0,0 +1,92 @@
+import copy
+
+ATTEMPTS_HEADER = 'x-attempts'
+ERROR_HEADER = 'x-error'
+
+
+class RetryPolicy(object):
+    """Novas tentativas com atraso para as entregas cujo handler falhou, no lugar do
+    Basic.Reject(requeue=True), que devolve a mensagem ao início da fila e a entrega de novo
+    na hora: uma mensagem que sempre falha ficaria em loop, ocupando o Consumer e a frente
+    da fila.
+
+    A entrega que falha é republicada em uma fila de atraso e ackeada. Cada fila de atraso
+    tem o TTL de um degrau do backoff (`x-message-ttl`) e, como dead-letter exchange, o
+    exchange padrão com a fila de origem como routing key: quando o TTL vence, o RabbitMQ
+    devolve a mensagem à fila do Consumer. Como todas as mensagens de uma fila de atraso
+    têm o mesmo TTL, elas vencem na ordem em que chegaram. O número da tentativa vai no
+    header `x-attempts`; depois de `max_attempts` tentativas a mensagem vai para a fila
+    `<fila>.dead`, junto com as que não decodificam, com o erro no header `x-error`.
+
+        policy = RetryPolicy(initial=1.0, multiplier=4.0, tiers=4)
+        policy.delays                                   # (1.0, 4.0, 16.0, 64.0)
+        policy.route('task_queue_sender_to_core', 1)    # 'task_queue_sender_to_core.retry.1000'
+
+    """
+
+    def __init__(self, initial=1.0, multiplier=4.0, tiers=4, max_attempts=None, delays=None):
+        """
+        :param float initial: Atraso, em segundos, da primeira nova tentativa
+        :param float multiplier: Crescimento do atraso a cada degrau
+        :param int tiers: Quantidade de degraus (filas de atraso) por fila
+        :param int max_attempts: Tentativas antes de a mensagem ir para a fila morta
+            (padrão: uma a mais que os degraus; as excedentes usam o último degrau)
+        :param delays: Atrasos, em segundos, de cada degrau, no lugar dos calculados
+
+        """
+        if delays is None:
+            delays = [initial * multiplier ** tier for tier in range(tiers)]
+
+        if not delays:
+            raise ValueError('A política de novas tentativas precisa de pelo menos um atraso')
+
+        self.delays = tuple(float(delay) for delay in delays)
+        self.max_attempts = max_attempts if max_attempts is not None else len(self.delays) + 1
+
+        if self.max_attempts < 1:
+            raise ValueError('max_attempts precisa ser maior que zero')
+
+    def delay_queue(self, queue, tier):
+        return '%s.retry.%i' % (queue, self.delays[tier] * 1000)
+
+    def dead_letter_queue(self, queue):
+        return '%s.dead' % queue
+
+    def declare(self, channel, queue):
+        """Declara a fila morta e as filas de atraso de `queue` (sem esperar as respostas; o
+        consumo só começa depois delas, no mesmo canal).
+
+        """
+        channel.queue_declare(self.dead_letter_queue(queue), durable=True)
+
+        for tier, delay in enumerate(self.delays):
+            arguments = {
+                'x-message-ttl': int(delay * 1000),
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue,
+            }
+
+            channel.queue_declare(self.delay_queue(queue, tier), durable=True, arguments=arguments)
+
+    def route(self, queue, attempts):
+        """Fila para onde vai a mensagem de `queue` que falhou na tentativa `attempts`."""
+        if attempts >= self.max_attempts:
+            return self.dead_letter_queue(queue)
+
+        return self.delay_queue(queue, min(attempts, len(self.delays)) - 1)
+
+
+def attempts(properties):
+    """Tentativas já feitas com a mensagem (0 na primeira entrega)."""
+    headers = properties.headers
+
+    return headers.get(ATTEMPTS_HEADER, 0) if headers else 0
+
+
+def with_headers(properties, headers):
+    """Cópia das propriedades com os `headers` acrescentados."""
+    properties = copy.copy(properties)
+    properties.headers = dict(properties.headers or {})
+    properties.headers.update(headers)
+
+    return properties
@@ -0,0 +1,70 @@
+import zlib
+
+from app.utils import QUEUE_FROM_FRONT, EXCHANGE_SENSORS, EXCHANGE_TOPIC_TYPE
+
+ROUTING_PREFIX = 'sensor'
+
+
+class ShardRouting(object):
+    """Roteamento das leituras por tipo e shard, no lugar da routing key única: cada leitura
+    é publicada no exchange topic EXCHANGE_SENSORS com a routing key `sensor.<tipo>.<shard>`,
+    e cada (tipo, shard) tem a sua fila, ligada só à sua routing key:
+
+        routing = ShardRouting(shards=4)
+        routing.routing_key('temperatura', _id)    # 'sensor.temperatura.2'
+        routing.queue('temperatura', 2)            # 'task_queue_sender_to_core.temperatura.2'
+
+    O shard é o crc32 do `_id` módulo a quantidade de shards: estável entre processos (ao
+    contrário do `hash` do Python), então uma leitura reenviada cai na mesma fila. No
+    RabbitMQ cada fila é servida por um único processo; com N filas por tipo a vazão de um
+    tipo deixa de ser limitada pela vazão de uma fila. Com o exchange topic, outras filas
+    podem assinar padrões como `sensor.temperatura.*` ou `sensor.#` sem mudar os Clients.
+
+    Clients e Servidor precisam usar a mesma quantidade de shards.
+
+    """
+    exchange_type = EXCHANGE_TOPIC_TYPE
+
+    def __init__(self, shards=1, exchange=EXCHANGE_SENSORS, queue_prefix=QUEUE_FROM_FRONT):
+        """
+        :param int shards: Filas por tipo de sensor
+        :param str exchange: Exchange topic das leituras
+        :param str queue_prefix: Prefixo dos nomes das filas
+
+        """
+        if shards < 1:
+            raise ValueError('shards precisa ser maior que zero')
+
+        self.shards = shards
+        self.exchange = exchange
+        self.queue_prefix = queue_prefix
+
+        # Routing keys por tipo, montadas uma vez: o caminho quente é só o crc32 e um índice.
+        self._keys = {}
+
+    def shard(self, _id):
+        """Shard do `_id` (str ou bytes; o Client com spool passa o corpo da mensagem)."""
+        if not isinstance(_id, (bytes, bytearray, memoryview)):
+            _id = str(_id).encode()
+
+        return zlib.crc32(_id) % self.shards
+
+    def routing_key(self, agent_type, _id):
+        """Routing key da leitura `_id` de um sensor do tipo `agent_type`."""
+        keys = self._keys.get(agent_type)
+
+        if keys is None:
+            keys = self._keys[agent_type] = [self.shard_key(agent_type, shard) for shard in range(self.shards)]
+
+        return keys[self.shard(_id)]
+
+    def shard_key(self, agent_type, shard):
+        return '%s.%s.%i' % (ROUTING_PREFIX, agent_type, shard)
+
+    def queue(self, agent_type, shard):
+        return '%s.%s.%i' % (self.queue_prefix, agent_type, shard)
+
+    def bindings(self, agent_types):
+        """(fila, routing key) de cada shard de cada tipo."""
+        return [(self.queue(agent_type, shard), self.shard_key(agent_type, shard))
+                for agent_type in agent_types for shard in range(self.shards)]
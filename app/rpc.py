@@ -0,0 +1,244 @@
+import heapq
+import asyncio
+import logging
+import itertools
+
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from app.utils import URL, pika, uuid4
+from app.codec import decode
+from app.compression import Decompressor
+from app.aioclient import AsyncClient
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RemoteError(RuntimeError):
+    """O handler do Servidor falhou; a mensagem é o erro devolvido na resposta."""
+
+
+class PendingCalls(object):
+    """Tabela das chamadas RPC em andamento: correlation_id -> future, com os prazos em um
+    único heap em vez de um timer por chamada. Uma chamada respondida sai da tabela na hora
+    e o prazo dela fica no heap até vencer (ou até a próxima compactação), quando é ignorado.
+
+    Com o mesmo timeout em todas as chamadas os prazos chegam em ordem e o `heappush` não
+    sobe no heap: cada chamada custa um push e um pop, sem timer próprio.
+
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._deadlines = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def add(self, correlation_id, future, deadline):
+        self._calls[correlation_id] = future
+        heapq.heappush(self._deadlines, (deadline, correlation_id))
+
+        # Os prazos das chamadas já respondidas são descartados quando passam da metade do heap:
+        if len(self._deadlines) > 2 * len(self._calls) + 1024:
+            calls = self._calls
+            self._deadlines = [item for item in self._deadlines if item[1] in calls]
+            heapq.heapify(self._deadlines)
+
+    def pop(self, correlation_id):
+        """A future da chamada, tirada da tabela, ou None se ela já venceu ou não existe."""
+        return self._calls.pop(correlation_id, None)
+
+    @property
+    def next_deadline(self):
+        return self._deadlines[0][0] if self._deadlines else None
+
+    def expire(self, now):
+        """Tira da tabela e retorna as futures das chamadas com prazo até `now`."""
+        deadlines = self._deadlines
+        calls = self._calls
+        expired = []
+
+        while deadlines and deadlines[0][0] <= now:
+            future = calls.pop(heapq.heappop(deadlines)[1], None)
+
+            if future is not None:
+                expired.append(future)
+
+        return expired
+
+    def clear(self):
+        """Tira todas as chamadas da tabela e retorna as futures delas."""
+        futures = list(self._calls.values())
+
+        self._calls.clear()
+        del self._deadlines[:]
+
+        return futures
+
+
+class RpcClient(AsyncClient):
+    """Cliente RPC sobre o `AsyncClient`: `call` publica a mensagem com `reply_to` e
+    `correlation_id` e retorna uma future do asyncio com o resultado do handler do tipo da
+    mensagem no Servidor, que responde pelo pool de publicação.
+
+    As respostas chegam em uma fila exclusiva com nome gerado pelo RabbitMQ, consumida com
+    auto_ack no primeiro canal. As chamadas em andamento ficam em uma `PendingCalls` e os
+    prazos são verificados por um único timer do loop, com resolução de `resolution`
+    segundos, então milhares de chamadas simultâneas não criam milhares de timers.
+
+        client = RpcClient(timeout=2.0)
+        await client.connect()
+
+        result = await client.call({'_id': str(uuid4()), 'type': 'temperatura', 'message': 33})
+
+    """
+
+    def __init__(self, url=URL, channels=1, connection_class=AsyncioConnection, codec='json', timeout=5.0,
+                 resolution=0.01, shards=None):
+        """
+        :param float timeout: Prazo padrão das chamadas, em segundos
+        :param float resolution: Atraso máximo, em segundos, entre o prazo de uma chamada e o
+            TimeoutError; os prazos próximos vencem no mesmo disparo do timer
+        :param int shards: Publica as requisições nas filas por tipo e shard, como o
+            `AsyncClient`; o mesmo valor do Servidor
+
+        """
+        super(RpcClient, self).__init__(url, channels, connection_class, codec, shards=shards)
+
+        self._timeout = timeout
+        self._resolution = resolution
+        self._decompressor = Decompressor()
+
+        self._pending = PendingCalls()
+        self._reply_queue = None
+        self._prefix = uuid4().hex[:12]
+        self._ids = itertools.count(1)
+
+        self._timer = None
+        self._timer_at = None
+
+        self._calls = 0
+        self._replies = 0
+        self._errors = 0
+        self._timeouts = 0
+        self._late = 0
+
+    async def connect(self):
+        """Abre a conexão e os canais e começa a consumir a fila de respostas."""
+        await super(RpcClient, self).connect()
+
+        channel = self._channels[0]
+
+        declared, on_declareok = self._callback_future()
+        channel.queue_declare('', exclusive=True, auto_delete=True, callback=on_declareok)
+        self._reply_queue = (await declared).method.queue
+
+        consumed, on_consumeok = self._callback_future()
+        channel.basic_consume(self._reply_queue, self._on_reply, auto_ack=True, callback=on_consumeok)
+        await consumed
+
+        LOGGER.info('Cliente RPC respondido em %s', self._reply_queue)
+
+    def call(self, message, timeout=None):
+        """Publica a requisição e retorna uma future com o resultado. A future termina com
+        `RemoteError` se o handler falhar no Servidor, `asyncio.TimeoutError` se a resposta
+        não chegar em `timeout` segundos e `ConnectionError` se a conexão cair antes.
+
+        :rtype: asyncio.Future
+
+        """
+        future = self._loop.create_future()
+        channel = next(self._next_channel) if self._next_channel is not None else None
+
+        if channel is None or not channel.is_open or self._reply_queue is None:
+            future.set_exception(ConnectionError('Cliente RPC sem conexão'))
+            return future
+
+        correlation_id = '%s.%i' % (self._prefix, next(self._ids))
+        properties = pika.BasicProperties(content_type=self._codec.content_type, type=message.get('type'),
+                                          reply_to=self._reply_queue, correlation_id=correlation_id)
+
+        channel.basic_publish(exchange=self._exchange, routing_key=self._route(message),
+                              body=self._codec.encode(message), properties=properties)
+
+        self._calls += 1
+        self._pending.add(correlation_id, future, self._loop.time() + (timeout or self._timeout))
+        self._arm()
+
+        return future
+
+    def _on_reply(self, channel, basic_deliver, properties, body):
+        future = self._pending.pop(properties.correlation_id)
+
+        if future is None:
+            # Respondida depois do prazo (ou de outra execução do cliente):
+            self._late += 1
+            return
+
+        self._replies += 1
+
+        if future.done():
+            # Cancelada por quem chamou, p.e. por um asyncio.wait_for.
+            return
+
+        try:
+            body = self._decompressor.decompress(body, properties.content_encoding)
+            reply = decode(body, properties.content_type)
+        except ValueError as error:
+            future.set_exception(error)
+            return
+
+        if 'error' in reply:
+            self._errors += 1
+            future.set_exception(RemoteError(reply['error']))
+        else:
+            future.set_result(reply.get('result'))
+
+    def _arm(self):
+        """Agenda o timer para o prazo mais próximo, se ele for antes do já agendado."""
+        deadline = self._pending.next_deadline
+
+        if deadline is None:
+            return
+
+        if self._timer is not None:
+            if self._timer_at <= deadline + self._resolution:
+                return
+
+            self._timer.cancel()
+
+        self._timer_at = deadline + self._resolution
+        self._timer = self._loop.call_at(self._timer_at, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+
+        for future in self._pending.expire(self._loop.time()):
+            self._timeouts += 1
+
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError('Chamada RPC sem resposta no prazo'))
+
+        self._arm()
+
+    def _on_connection_closed(self, connection, reason):
+        super(RpcClient, self)._on_connection_closed(connection, reason)
+
+        self._reply_queue = None
+
+        # A fila de respostas é exclusiva e morre com a conexão; as respostas não chegam mais.
+        for future in self._pending.clear():
+            if not future.done():
+                future.set_exception(ConnectionError('Conexão do Cliente RPC fechada: %s' % (reason,)))
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        await super(RpcClient, self).close()
+
+    @property
+    def stats(self):
+        return dict(calls=self._calls, replies=self._replies, errors=self._errors, timeouts=self._timeouts,
+                    late=self._late, pending=len(self._pending))
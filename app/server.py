@@ -1,7 +1,19 @@
+import logging
+import time
+
 from app.utils import *
 
-from app.publisher import Publisher
+from app.flow import FlowControl
+from app.retry import RetryPolicy
+from app.backoff import Backoff
+from app.pool import PublisherPool
 from app.consumer import Consumer
+from app.routing import ShardRouting
+from app.handlers import HandlerRegistry
+from app.aggregation import WindowAggregator
+from app.metrics import Registry, LoopLagMonitor, metrics_application
+
+LOGGER = logging.getLogger(__name__)
 
 
 class Server(object):
@@ -16,38 +28,207 @@ class Server(object):
     EXCHANGE_TYPE = EXCHANGE_TYPE
     ROUTING_KEY = ROUTING_KEY
 
+    # Prazo, em segundos, para o RabbitMQ confirmar o fechamento da conexão no `stop`:
+    CLOSE_TIMEOUT = 5.0
 
-    def __init__(self, amqp_url=URL):
+
+    def __init__(self, amqp_url=URL, connection_class=TornadoConnection, consumer_options=None,
+                 publisher_options=None, aggregation_options=None, reconnect_options=None, metrics_port=None,
+                 shards=None, flow_options=None, retry_options=None):
         """
         Create a new instance of the Server, passing in the AMQP URL used to connect to RabbitMQ.
 
         `param` str amqp_url: The AMQP url to connect with
+        `param` type connection_class: Classe da conexão, compatível com o TornadoConnection
+        `param` dict consumer_options: Opções repassadas ao Consumer (p.e. prefetch_count)
+        `param` dict publisher_options: Opções do pool de publicação (connections, channels,
+            selection) e de cada Publisher (p.e. batch_size)
+        `param` dict aggregation_options: Liga a agregação em janelas das leituras, publicada
+            no EXCHANGE_CORE_TO_SENDER; opções do WindowAggregator (p.e. window, step)
+        `param` dict reconnect_options: Backoff das reconexões (initial, maximum, multiplier, jitter)
+        `param` int metrics_port: Porta do endpoint HTTP /metrics (formato Prometheus), servido
+            no mesmo IOLoop; sem ela as métricas ficam só em `server.metrics`
+        `param` int shards: Liga o roteamento por tipo e shard (`app.routing.ShardRouting`):
+            declara N filas por tipo de sensor no EXCHANGE_SENSORS e consome cada uma em um
+            canal próprio, com os mesmos handlers. Os Clients devem usar o mesmo valor
+        `param` dict flow_options: Limites do controle de fluxo (`app.flow.FlowControl`):
+            max_outstanding, max_buffer_bytes, resume_ratio, check_interval
+        `param` dict retry_options: Liga as novas tentativas com atraso e a fila morta das
+            entregas cujo handler falhou (`app.retry.RetryPolicy`: initial, multiplier, tiers,
+            max_attempts ou delays); sem elas a entrega volta para a fila na hora
         """
         self._connection = None
         self._url = amqp_url
+        self._connection_class = connection_class
+
+        self._reconnect_options = reconnect_options or {}
+        self._backoff = Backoff(**self._reconnect_options)
+
+        # Quedas da conexão: início da atual e duração das já encerradas (s)
+        self._down_since = None
+        self._outages = 0
+        self._outage_time = 0.0
+        self._last_outage = 0.0
+        self._longest_outage = 0.0
 
         self._consumer_tag = None
 
-        self._consumer = Consumer(
-            server_instance = self,
-            queue = self.QUEUE_FROM_FRONT,
-            exchange = self.EXCHANGE_SENDER_TO_CORE,
-            exchange_type = self.EXCHANGE_TYPE
-            )
+        self.metrics = Registry()
+        self.metrics_port = metrics_port
+        self._metrics_server = None
+        self._loop_lag = LoopLagMonitor(self.metrics)
+
+        # Os Consumers dos shards compartilham o registro de handlers:
+        consumer_options = dict(consumer_options or {})
+        consumer_options.setdefault('handlers', HandlerRegistry())
+        self._handlers = consumer_options['handlers']
+
+        if retry_options is not None:
+            consumer_options.setdefault('retry', RetryPolicy(**retry_options))
+
+        self._routing = ShardRouting(shards) if shards else None
+
+        if self._routing is None:
+            bindings = [(self.QUEUE_FROM_FRONT, self.ROUTING_KEY)]
+            exchange, exchange_type = self.EXCHANGE_SENDER_TO_CORE, self.EXCHANGE_TYPE
+        else:
+            bindings = self._routing.bindings(SENSOR_TYPES)
+            exchange, exchange_type = self._routing.exchange, self._routing.exchange_type
+
+        self._consumers = [
+            Consumer(
+                server_instance = self,
+                queue = queue,
+                exchange = exchange,
+                exchange_type = exchange_type,
+                routing_key = routing_key,
+                **consumer_options
+                )
+            for queue, routing_key in bindings]
         
-        self._publisher = Publisher(
+        # Pausa o consumo quando a publicação satura:
+        self.flow = FlowControl(lambda: self._publisher.outstanding, lambda: self._publisher.write_buffer_size,
+                                self._pause_consuming, self._resume_consuming, **(flow_options or {}))
+
+        self._publisher = PublisherPool(
             server_instance = self,
             queue = self.QUEUE_TO_FRONT,
             exchange = self.EXCHANGE_CORE_TO_SENDER,
-            exchange_type = self.EXCHANGE_TYPE
+            exchange_type = self.EXCHANGE_TYPE,
+            metrics = self.metrics,
+            **(publisher_options or {})
             )
 
+        self._aggregator = None
+
+        if aggregation_options is not None:
+            self._aggregator = WindowAggregator(self.publish_message, **aggregation_options)
+            self._aggregator.attach(self._handlers)
+
         self._closing = False
+        self._close_timeout = None
+
+        self._register_metrics()
+
+    def _register_metrics(self):
+        """Métricas do Servidor. Os contadores que já existem nos `stats` são lidos só na
+        coleta; no caminho quente ficam apenas os histogramas de latência (handlers,
+        confirmações e IOLoop).
+
+        """
+        metrics = self.metrics
+        publisher = self._publisher
+
+        def consumers(attribute):
+            return lambda: sum(getattr(consumer, attribute) for consumer in self._consumers)
+
+        self._handlers.instrument(
+            metrics.histogram('handler_latency_seconds', 'Tempo de execução dos handlers', labelnames=('handler',)))
+
+        metrics.counter('messages_consumed', 'Entregas recebidas do RabbitMQ', function=consumers('_consumed'))
+        metrics.counter('records_consumed', 'Leituras recebidas (as de envelopes contam uma a uma)',
+                        function=consumers('_records'))
+        metrics.counter('consumer_acks', 'Entregas confirmadas com Basic.Ack', function=consumers('_acked'))
+        metrics.counter('consumer_rejects', 'Entregas recusadas com Basic.Reject', function=consumers('_rejected'))
+        metrics.counter('consumer_retries', 'Entregas republicadas em uma fila de atraso',
+                        function=consumers('_retried'))
+        metrics.counter('consumer_recovered', 'Entregas tratadas com sucesso em uma nova tentativa',
+                        function=consumers('_recovered'))
+        metrics.counter('consumer_dead_lettered', 'Entregas enviadas para a fila morta',
+                        function=consumers('_dead_lettered'))
+        metrics.counter('rpc_requests', 'Requisições RPC (com reply_to) respondidas pelo Servidor',
+                        function=consumers('_calls'))
+        metrics.gauge('consumer_in_flight', 'Entregas em processamento', function=consumers('_in_flight'))
+
+        metrics.counter('messages_published', 'Mensagens publicadas',
+                        function=lambda: publisher.stats['published'])
+        metrics.counter('publish_acks', 'Publicações confirmadas com Basic.Ack', function=lambda: publisher.stats['acked'])
+        metrics.counter('publish_nacks', 'Publicações recusadas com Basic.Nack', function=lambda: publisher.stats['nacked'])
+        metrics.gauge('publish_outstanding', 'Publicações aguardando confirmação',
+                      function=lambda: publisher.confirm_stats['outstanding'])
+        metrics.gauge('publish_oldest_unconfirmed_seconds', 'Idade da publicação pendente mais antiga',
+                      function=lambda: publisher.confirm_stats['oldest_age'])
+        metrics.gauge('publish_outage_buffered_bytes', 'Bytes guardados no buffer da queda',
+                      function=lambda: (publisher.stats.get('outage') or {}).get('buffered_bytes', 0))
+
+        metrics.gauge('flow_paused', 'Consumo pausado pelo controle de fluxo (1) ou não (0)',
+                      function=lambda: int(self.flow.paused))
+        metrics.counter('flow_pauses', 'Pausas do consumo pelo controle de fluxo',
+                        function=lambda: self.flow.stats['pauses'])
+        metrics.gauge('publish_write_buffer_bytes', 'Bytes nos buffers de saída das conexões de publicação',
+                      function=lambda: publisher.write_buffer_size)
+
+        metrics.counter('connection_outages', 'Quedas da conexão com o RabbitMQ', function=lambda: self._outages)
+        metrics.gauge('connection_down_seconds', 'Duração da queda atual (0 com a conexão aberta)',
+                      function=lambda: self.connection_stats['down_for'])
 
     @property
     def connection(self):
         return self._connection 
 
+    @classmethod
+    def args(cls):
+        from argparse import ArgumentParser
+
+        from app.logconfig import add_arguments
+
+        parser = ArgumentParser()
+
+        parser.add_argument("-d", "--debug", action='store_true',
+                            help="Imprime no terminal cada mensagem recebida")
+
+        parser.add_argument("-w", "--workers", type=int, default=1,
+                            help="Quantidade de processos do Servidor, cada um com sua conexão")
+
+        parser.add_argument("--dedup", default=None,
+                            help="Descarta as mensagens com _id já processado: [lru | bloom]")
+
+        parser.add_argument("--window", type=float, default=None,
+                            help="Agrega as leituras em janelas desse tamanho, em segundos")
+
+        parser.add_argument("--step", type=float, default=None,
+                            help="Intervalo entre as emissões dos agregados (padrão: a janela, tumbling)")
+
+        parser.add_argument("--metrics-port", type=int, default=None,
+                            help="Porta do endpoint HTTP /metrics, no formato do Prometheus")
+
+        parser.add_argument("--shards", type=int, default=None,
+                            help="Filas por tipo de sensor (sensor.<tipo>.<shard>); o mesmo valor dos Clients")
+
+        parser.add_argument("--lazy", action='store_true',
+                            help="Decodifica o corpo das mensagens só quando um handler lê os campos")
+
+        parser.add_argument("--retry-delays", type=float, nargs='+', default=None,
+                            help="Atrasos, em segundos, das novas tentativas das entregas que falham "
+                                 "(filas de atraso com TTL); sem eles a entrega volta para a fila na hora")
+
+        parser.add_argument("--max-attempts", type=int, default=None,
+                            help="Tentativas antes da fila morta (padrão: um atraso a mais)")
+
+        add_arguments(parser)
+
+        return parser.parse_args()
+
     # - 1    
     def _connect(self):
         """Esse metodo retorna uma instância com a Conexão com o RabbitMq, utilizando o Tornado.
@@ -59,8 +240,8 @@ class Server(object):
         """
         LOGGER.info('Abrindo Conexão no Servidor com a URL %s', self._url)
         
-        return adapters.tornado_connection.TornadoConnection(pika.URLParameters(self._url),
-                                                                self._on_connection_open) 
+        return self._connection_class(pika.URLParameters(self._url), self._on_connection_open,
+                                      on_open_error_callback=self._on_connection_open_error)
 
     ## - 2
     def _on_connection_open(self, unused_connection):
@@ -72,9 +253,31 @@ class Server(object):
 
         """
         LOGGER.info('Conexão criada entre o RabbitMq e o Servidor.')
+
+        self._backoff.reset()
+
+        if self._down_since is not None:
+            self._last_outage = time.monotonic() - self._down_since
+            self._outage_time += self._last_outage
+            self._longest_outage = max(self._longest_outage, self._last_outage)
+            self._down_since = None
+
+            LOGGER.warning('Conexão com o RabbitMQ restabelecida depois de %.3f s', self._last_outage)
+
         self._add_on_connection_close_callback()
         self._open_channels()
     
+    def _on_connection_open_error(self, unused_connection, error):
+        """Chamado pelo pika quando a conexão não pôde ser aberta; tenta de novo depois do
+        próximo atraso do backoff.
+
+        :param pika.connection.Connection unused_connection: The failed connection obj
+        :param Exception error: why the connection could not be opened
+
+        """
+        if not self._closing:
+            self._schedule_reconnect(error)
+
     ### - 2.1
     def _add_on_connection_close_callback(self):
         """Esse método adiciona uma função que será chamado quando a conexão com o RabbitMq é fechada
@@ -85,25 +288,42 @@ class Server(object):
         self._connection.add_on_close_callback(self._on_connection_closed)
 
     #### - 2.1.1
-    def _on_connection_closed(self, connection, reply_code, reply_text):
+    def _on_connection_closed(self, connection, reason):
         """Esse método é chamado pelo pika quando a conexão com o RabbitMq é encerrada 
         de forma repentina. Se for de fato repentina, nos reconectaremos.
         
         :param pika.connection.Connection connection: The closed connection obj
-        :param int reply_code: The server provided reply_code if given
-        :param str reply_text: The server provided reply_text if given
+        :param Exception reason: exception representing reason for loss of connection
 
         """
-        self._consumer._channel = None
-        self._publisher._channel = None
+        for consumer in self._consumers:
+            consumer._channel = None
         
         
         if self._closing:
+            if self._close_timeout is not None:
+                self._connection.ioloop.remove_timeout(self._close_timeout)
+                self._close_timeout = None
+
             self._connection.ioloop.stop()
         else:
-            LOGGER.warning('Conexão Fechada com o RabbitMQ; reabrindo em 5 segundos: (%s) %s',
-                           reply_code, reply_text)
-            self._connection.add_timeout(5, self._reconnect)
+            self._schedule_reconnect(reason)
+
+    def _schedule_reconnect(self, reason):
+        """Agenda a próxima tentativa de conexão com backoff exponencial e jitter, a partir
+        de dezenas de milissegundos.
+
+        """
+        if self._down_since is None:
+            self._down_since = time.monotonic()
+            self._outages += 1
+
+        delay = self._backoff.next_delay()
+
+        LOGGER.warning('Sem Conexão com o RabbitMQ; tentativa %i em %.3f s: %s',
+                       self._backoff.attempts, delay, reason)
+
+        self._connection.ioloop.call_later(delay, self._reconnect)
     
     ##### - 2.1.2
     def _reconnect(self):
@@ -121,10 +341,12 @@ class Server(object):
        
 
         """
-        LOGGER.info('Criando Dois novos Canais')
+        LOGGER.info('Criando os Canais do Consumer e do Publisher')
         
-        self._connection.channel(on_open_callback=self._consumer.on_channel_open)
-        self._connection.channel(on_open_callback=self._publisher.on_channel_open)
+        for consumer in self._consumers:
+            self._connection.channel(on_open_callback=consumer.on_channel_open)
+
+        self._publisher.open(self._connection)
 
     """
     FUNÇÕES DE CONTROLE
@@ -135,7 +357,20 @@ class Server(object):
         """
 
         self._connection = self._connect()
+
+        if self._aggregator is not None:
+            self._aggregator.start(self._connection.ioloop)
+
+        self._connection.ioloop.add_callback(self._start_metrics)
         self._connection.ioloop.start()
+
+    def _start_metrics(self):
+        """Dentro do IOLoop: o monitor de atraso e, se pedido, o servidor HTTP das métricas."""
+        self._loop_lag.start(self._connection.ioloop)
+
+        if self.metrics_port is not None and self._metrics_server is None:
+            LOGGER.info('Métricas em http://0.0.0.0:%i/metrics', self.metrics_port)
+            self._metrics_server = metrics_application(self.metrics).listen(self.metrics_port)
     
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
@@ -151,10 +386,33 @@ class Server(object):
         LOGGER.info('Stopping Tornado')
         self._closing = True
 
+        if self._aggregator is not None:
+            self._aggregator.stop()
+
+        self._loop_lag.stop()
+        self.flow.stop()
+
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+            self._metrics_server = None
+
         self._stop_consuming()
-        
-        self._connection.ioloop.stop()
-        self._connection.close()
+
+        ioloop = self._connection.ioloop
+        running = ioloop.asyncio_loop.is_running()
+
+        if self._connection.is_open:
+            # O Basic.Cancel, os acks retidos e o Connection.Close só são escritos com o IOLoop
+            # rodando: ele para no `_on_connection_closed`, ou no prazo se o RabbitMQ não responder.
+            self._close_timeout = ioloop.call_later(self.CLOSE_TIMEOUT, ioloop.stop)
+            self._connection.close()
+
+            if not running:
+                # Chamado depois do KeyboardInterrupt, que parou o IOLoop:
+                ioloop.start()
+        elif running:
+            # Sem conexão (p.e. esperando a reconexão) não há o que escrever:
+            ioloop.stop()
 
         LOGGER.info('Servidor foi Parado')
 
@@ -164,22 +422,131 @@ class Server(object):
 
         """
         
-        if self._consumer.channel:
-            LOGGER.info("Canal do Consumidor Ativo. Fechando...")
-            self._consumer.close_channel()
+        for consumer in self._consumers:
+            if consumer.channel:
+                LOGGER.info("Canal do Consumidor (%s) Ativo. Fechando...", consumer.queue)
+                consumer.close_channel()
+
+
+        # Mesmo sem canal aberto o pool descarta o buffer da queda:
+        LOGGER.info("Fechando os Canais do Publisher...")
+        self._publisher.close_channel()
+
+
+    @property
+    def handlers(self):
+        """Registro de handlers do Consumer, p.e.:
+
+            @server.handlers.handler('temperatura')
+            def on_temperatura(message):
+                ...
+
+        """
+        return self._handlers
+
+    def stats(self):
+        """Contadores do Consumer, do Publisher e das quedas da conexão (e da agregação, se
+        ligada) deste Servidor.
+
+        """
+        stats = dict(consumer=self._consumer_stats(), publisher=self._publisher.stats,
+                     connection=self.connection_stats, flow=self.flow.stats)
+
+        if self._aggregator is not None:
+            stats['aggregation'] = self._aggregator.stats
+
+        return stats
 
+    def _consumer_stats(self):
+        """Contadores do Consumer; com shards, a soma dos Consumers e os de cada fila em `queues`."""
+        if len(self._consumers) == 1:
+            return self._consumers[0].stats
 
-        if self._publisher.channel:
-            LOGGER.info("Canal do Publisher Ativo. Fechando...")
-            self._publisher.close_channel()
+        queues = dict((consumer.queue, consumer.stats) for consumer in self._consumers)
 
+        stats = dict((key, sum(queue[key] for queue in queues.values()))
+                     for key in ('consumed', 'envelopes', 'records', 'acked', 'rejected', 'retried', 'recovered',
+                                 'dead_lettered', 'calls', 'in_flight'))
+        stats['queues'] = queues
+
+        return stats
+
+    def assign_shards(self, index, count):
+        """Com `count` processos (p.e. os workers do Supervisor), este consome só a sua parte
+        das filas dos shards: a fila i fica com o worker i % count. Com mais workers que filas,
+        os excedentes disputam as filas com os primeiros. Sem shards não faz nada. Deve ser
+        chamado antes do `run`.
+
+        """
+        if self._routing is None or count <= 1:
+            return
+
+        if count <= len(self._consumers):
+            self._consumers = self._consumers[index::count]
+        else:
+            self._consumers = [self._consumers[index % len(self._consumers)]]
+
+    @property
+    def connection_stats(self):
+        """Quedas da conexão: quantidade, duração da última, da maior e total (s), e há
+        quanto tempo a queda atual dura (`down_for`, 0 com a conexão aberta).
+
+        """
+        return dict(
+            outages=self._outages,
+            last_outage=self._last_outage,
+            longest_outage=self._longest_outage,
+            outage_time=self._outage_time,
+            down_for=time.monotonic() - self._down_since if self._down_since is not None else 0.0,
+            reconnect_attempts=self._backoff.attempts,
+        )
 
     def publish_message(self, message):
         """Função chamada pelo Consumer com o intuito de enviar uma mensagem para o Publisher. Para que
         ele, então, façã a entrega à Fila adequada.
+
+        Retorna a future da confirmação de entrega da mensagem. Se a publicação saturar
+        (confirmações pendentes, buffer de saída ou Connection.Blocked), o consumo é pausado
+        até ela esvaziar; ver `app.flow.FlowControl`.
         
         """
 
-        self._publisher.start_publishing(message)
+        future = self._publisher.start_publishing(message)
+        self.flow.check()
+
+        return future
+
+    def reply(self, reply_to, correlation_id, payload):
+        """Chamado pelo Consumer com a resposta de uma requisição RPC, publicada pelo pool na
+        fila `reply_to` de quem chamou. Passa pelo mesmo controle de fluxo do `publish_message`.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        future = self._publisher.reply(reply_to, correlation_id, payload)
+        self.flow.check()
+
+        return future
+
+    def republish(self, queue, body, properties):
+        """Chamado pelo Consumer para mandar uma entrega que falhou para a fila de atraso ou
+        para a fila morta (`app.retry.RetryPolicy`), pelo pool de publicação, com confirmação.
+        Passa pelo mesmo controle de fluxo do `publish_message`.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        future = self._publisher.republish(queue, body, properties)
+        self.flow.check()
+
+        return future
+
+    def _pause_consuming(self):
+        for consumer in self._consumers:
+            consumer.pause()
+
+    def _resume_consuming(self):
+        for consumer in self._consumers:
+            consumer.resume()
 
 
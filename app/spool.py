@@ -0,0 +1,428 @@
+import logging
+import os
+import mmap
+import zlib
+import struct
+import threading
+
+from collections import deque
+
+from app.backoff import Backoff
+
+LOGGER = logging.getLogger(__name__)
+
+# Cabeçalho do segmento: assinatura, versão e até onde os registros já foram confirmados.
+_SEGMENT = struct.Struct('>4sIQ')
+_MAGIC = b'SPL1'
+
+# Cabeçalho do registro: tamanho e crc32 do corpo, e as flags. As flags são escritas por
+# último: um registro só existe depois que elas são gravadas, e um segmento recém-criado
+# (zerado) termina no primeiro registro com flags 0.
+_RECORD = struct.Struct('>IIB')
+_PRESENT = 0x01
+_COMPRESSED = 0x02
+# Com _KEYED o corpo do registro começa pela chave (p.e. a routing key), precedida do tamanho
+# dela em 1 byte; o tamanho e o crc32 do cabeçalho cobrem a chave e o corpo.
+_KEYED = 0x04
+MAX_KEY_SIZE = 255
+
+
+class Segment(object):
+    """Arquivo de tamanho fixo mapeado em memória, com os registros gravados em sequência."""
+    __slots__ = ('sequence', 'path', 'size', 'write_at', '_acked', '_file', '_buffer')
+
+    def __init__(self, directory, sequence, size=None):
+        """Abre o segmento `sequence` do diretório; com `size` ele é criado (zerado) com esse tamanho."""
+        self.sequence = sequence
+        self.path = os.path.join(directory, '%020i.seg' % (sequence,))
+
+        if size is not None:
+            self._file = open(self.path, 'w+b')
+            self._file.truncate(size)
+        else:
+            self._file = open(self.path, 'r+b')
+
+        self._buffer = mmap.mmap(self._file.fileno(), 0)
+        self.size = len(self._buffer)
+
+        if size is not None:
+            _SEGMENT.pack_into(self._buffer, 0, _MAGIC, 1, _SEGMENT.size)
+        elif _SEGMENT.unpack_from(self._buffer, 0)[0] != _MAGIC:
+            raise ValueError('Segmento do spool inválido: %s' % (self.path,))
+
+        self._acked = _SEGMENT.unpack_from(self._buffer, 0)[2]
+        self.write_at = _SEGMENT.size if size is not None else self._recover()
+
+    def _recover(self):
+        """Posição depois do último registro íntegro."""
+        offset = _SEGMENT.size
+
+        while True:
+            extent = self._extent(offset)
+
+            if extent is None:
+                return offset
+
+            start, end, _ = extent
+
+            if zlib.crc32(self._buffer[start:end]) != _RECORD.unpack_from(self._buffer, offset)[1]:
+                return offset
+
+            offset = end
+
+    @property
+    def acked(self):
+        return self._acked
+
+    @acked.setter
+    def acked(self, offset):
+        _SEGMENT.pack_into(self._buffer, 0, _MAGIC, 1, offset)
+        self._acked = offset
+
+    def fits(self, size):
+        return self.write_at + _RECORD.size + size <= self.size
+
+    def write(self, body, compressed, key=None):
+        buffer = self._buffer
+        offset = self.write_at
+        start = end = offset + _RECORD.size
+        flags = _PRESENT | (_COMPRESSED if compressed else 0)
+        crc = 0
+
+        if key:
+            buffer[end] = len(key)
+            buffer[end + 1:end + 1 + len(key)] = key
+            end += 1 + len(key)
+            crc = zlib.crc32(buffer[start:end])
+            flags |= _KEYED
+
+        buffer[end:end + len(body)] = body
+        end += len(body)
+
+        _RECORD.pack_into(buffer, offset, end - start, zlib.crc32(body, crc), 0)
+        buffer[offset + _RECORD.size - 1] = flags
+
+        self.write_at = end
+
+    def _extent(self, offset):
+        """(início, fim, flags) do registro em `offset`, ou None no fim."""
+        if offset + _RECORD.size > self.size:
+            return None
+
+        size, _, flags = _RECORD.unpack_from(self._buffer, offset)
+        start = offset + _RECORD.size
+
+        if not flags & _PRESENT or start + size > self.size:
+            return None
+
+        return start, start + size, flags
+
+    def read(self, offset):
+        """O registro em `offset`: (corpo, comprimido, chave, posição do próximo), ou None no
+        fim. A chave é None nos registros gravados sem ela.
+
+        """
+        extent = self._extent(offset)
+
+        if extent is None:
+            return None
+
+        start, end, flags = extent
+        key = None
+
+        if flags & _KEYED:
+            size = self._buffer[start]
+            key = self._buffer[start + 1:start + 1 + size].decode('utf-8')
+            start += 1 + size
+
+        return self._buffer[start:end], bool(flags & _COMPRESSED), key, end
+
+    def sync(self):
+        self._buffer.flush()
+
+    def close(self, remove=False):
+        self._buffer.close()
+        self._file.close()
+
+        if remove:
+            os.remove(self.path)
+
+
+class Spool(object):
+    """Spool em disco (write-ahead) das mensagens do Client: os corpos são gravados em
+    segmentos de tamanho fixo mapeados em memória e lidos, na ordem, pelo `SpoolDrain`, que
+    os publica com confirmação. Cada segmento guarda no cabeçalho até onde já foi
+    confirmado; o arquivo só é apagado quando todos os seus registros foram confirmados.
+
+    Ao abrir um diretório com segmentos, a leitura recomeça da última confirmação gravada,
+    então as mensagens que estavam em voo quando o processo caiu são publicadas de novo (pelo
+    menos uma vez; o `_id` permite descartá-las no Servidor com `--dedup`).
+
+    O mmap sobrevive à queda do processo; para sobreviver à queda da máquina, `sync=True`
+    grava cada registro no disco antes de retornar, a um custo bem maior.
+
+    """
+
+    def __init__(self, directory, segment_size=16 * 2 ** 20, max_segments=64, sync=False):
+        """
+        :param str directory: Diretório dos segmentos, criado se não existir
+        :param int segment_size: Tamanho, em bytes, de cada segmento
+        :param int max_segments: Máximo de segmentos; com todos cheios `append` recusa a mensagem
+        :param bool sync: msync a cada registro
+
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_segments = max_segments
+        self._sync = sync
+
+        self._lock = threading.Lock()
+        self._readable = threading.Condition(self._lock)
+
+        sequences = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.seg'))
+        self._segments = deque(Segment(directory, sequence) for sequence in sequences)
+
+        if not self._segments:
+            self._segments.append(Segment(directory, 0, segment_size))
+
+        # Cursor de leitura: segmento (índice em _segments) e posição nele.
+        self._read_index = 0
+        self._read_at = self._segments[0].acked
+
+        self._appended = 0
+        self._acked = 0
+        self._dropped = 0
+
+    def __len__(self):
+        """Bytes gravados e ainda não confirmados (registros e cabeçalhos)."""
+        with self._lock:
+            return self._pending_bytes()
+
+    def _pending_bytes(self):
+        return sum(segment.write_at - segment.acked for segment in self._segments)
+
+    def append(self, body, compressed=False, key=None):
+        """Grava o corpo no fim do spool. Retorna False se o spool está cheio.
+
+        :param str key: Gravada junto com o corpo e devolvida pelo `read`, p.e. a routing key
+            da mensagem, para que ela seja publicada igual a cada reenvio
+        :raises ValueError: o corpo não cabe em um segmento, ou a chave passa de 255 bytes
+
+        """
+        if key:
+            key = key.encode('utf-8')
+
+            if len(key) > MAX_KEY_SIZE:
+                raise ValueError('Chave de %i bytes maior que o limite do spool' % (len(key),))
+
+        size = len(body) + (1 + len(key) if key else 0)
+
+        if _SEGMENT.size + _RECORD.size + size > self._segment_size:
+            raise ValueError('Mensagem de %i bytes maior que o segmento do spool' % (len(body),))
+
+        with self._lock:
+            segment = self._segments[-1]
+
+            if not segment.fits(size):
+                if len(self._segments) >= self._max_segments:
+                    self._dropped += 1
+                    return False
+
+                segment = Segment(self._directory, segment.sequence + 1, self._segment_size)
+                self._segments.append(segment)
+
+            segment.write(body, compressed, key)
+            self._appended += 1
+
+            if self._sync:
+                segment.sync()
+
+            self._readable.notify()
+
+        return True
+
+    def read(self, limit=500, timeout=None):
+        """Até `limit` registros ainda não lidos, esperando até `timeout` segundos se não
+        houver nenhum. Retorna uma lista de (posição, corpo, comprimido, chave); a posição é o
+        que se passa para `ack`.
+
+        """
+        with self._lock:
+            records = self._read(limit)
+
+            if not records and timeout:
+                self._readable.wait(timeout)
+                records = self._read(limit)
+
+            return records
+
+    def _read(self, limit):
+        records = []
+        segments = self._segments
+
+        while len(records) < limit:
+            segment = segments[self._read_index]
+            record = segment.read(self._read_at) if self._read_at < segment.write_at else None
+
+            if record is None:
+                if self._read_index + 1 == len(segments):
+                    break
+
+                self._read_index += 1
+                self._read_at = _SEGMENT.size
+                continue
+
+            body, compressed, key, self._read_at = record
+            records.append(((segment.sequence, self._read_at), body, compressed, key))
+
+        return records
+
+    def ack(self, position, count=1):
+        """Confirma todos os registros até `position` (inclusive) e apaga os segmentos
+        inteiramente confirmados, menos o atual.
+
+        :param int count: Quantos registros a confirmação cobre (para as estatísticas)
+
+        """
+        sequence, offset = position
+
+        with self._lock:
+            segments = self._segments
+
+            while segments[0].sequence < sequence:
+                self._remove_first()
+
+            segments[0].acked = offset
+            self._acked += count
+
+            if len(segments) > 1 and offset == segments[0].write_at:
+                self._remove_first()
+
+    def _remove_first(self):
+        self._segments.popleft().close(remove=True)
+
+        if self._read_index:
+            self._read_index -= 1
+        else:
+            self._read_at = _SEGMENT.size
+
+    def rewind(self):
+        """Volta a leitura para a última confirmação, p.e. depois de uma falha ao publicar."""
+        with self._lock:
+            self._read_index = 0
+            self._read_at = self._segments[0].acked
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(appended=self._appended, acked=self._acked, dropped=self._dropped,
+                        pending_bytes=self._pending_bytes(), segments=len(self._segments))
+
+
+class SpoolDrain(threading.Thread):
+    """Thread que publica, com confirmação, os registros do `Spool`, em uma conexão própria.
+    Uma falha ao conectar ou publicar fecha a conexão e a leitura volta para a última
+    confirmação; a reconexão segue o `Backoff`, para que muitos clientes derrubados juntos
+    não reconectem todos ao mesmo tempo.
+
+    """
+
+    def __init__(self, spool, connect, publish, batch_size=500, backoff=None):
+        """
+        :param Spool spool: Spool lido
+        :param callable connect: Abre a conexão e retorna o canal, já com confirmação
+        :param callable publish: publish(channel, body, compressed, key); retorna depois da
+            confirmação e levanta exceção se a mensagem não foi confirmada
+        :param int batch_size: Registros lidos do spool por vez
+
+        """
+        super(SpoolDrain, self).__init__(name='spool-drain', daemon=True)
+
+        self._spool = spool
+        self._connect = connect
+        self._publish = publish
+        self._batch_size = batch_size
+        self._backoff = backoff or Backoff()
+
+        self._channel = None
+        self._stopping = threading.Event()
+        self._abort = threading.Event()
+
+        self.published = 0
+        self.failures = 0
+        self.connections = 0
+
+    def run(self):
+        spool = self._spool
+
+        while not self._abort.is_set():
+            if self._stopping.is_set() and not len(spool):
+                break
+
+            if self._channel is None and not self._open():
+                continue
+
+            records = spool.read(self._batch_size, timeout=0.1)
+            published = 0
+
+            try:
+                for _, body, compressed, key in records:
+                    self._publish(self._channel, body, compressed, key)
+                    published += 1
+            except Exception as error:
+                self.failures += 1
+                LOGGER.warning('Falha ao publicar do spool; reconectando: %r', error)
+                self._close()
+
+            if published:
+                spool.ack(records[published - 1][0], published)
+                self.published += published
+
+            if self._channel is None:
+                spool.rewind()
+
+        self._close()
+
+    def _open(self):
+        try:
+            self._channel = self._connect()
+        except Exception as error:
+            delay = self._backoff.next_delay()
+            LOGGER.warning('Spool sem Conexão com o RabbitMQ; tentando em %.3f s: %r', delay, error)
+            self._abort.wait(delay)
+            return False
+
+        self._backoff.reset()
+        self.connections += 1
+        return True
+
+    def _close(self):
+        channel, self._channel = self._channel, None
+
+        if channel is not None:
+            try:
+                channel.connection.close()
+            except Exception:
+                pass
+
+    def stop(self, timeout=None):
+        """Para a thread depois de publicar o que está no spool, esperando até `timeout`
+        segundos; o que não foi publicado fica no spool para a próxima execução.
+
+        """
+        self._stopping.set()
+        self.join(timeout)
+
+        self._abort.set()
+        self.join(1.0)
+
+    @property
+    def stats(self):
+        return dict(published=self.published, failures=self.failures, connections=self.connections)
@@ -0,0 +1,218 @@
+import logging
+import os
+import time
+import queue
+import signal
+import multiprocessing
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from app.logconfig import shutdown_logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _run_worker(index, workers, server_factory, stats_queue, stats_interval):
+    """Processo worker: roda um Servidor, com a sua própria conexão, até receber SIGTERM."""
+    # O Ctrl-C chega a todo o grupo de processos; quem decide o desligamento é o Supervisor.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    server = server_factory()
+    ioloop = IOLoop.current()
+
+    # Cada worker serve as suas métricas na porta seguinte à do anterior:
+    if server.metrics_port is not None:
+        server.metrics_port += index
+
+    # Com shards, cada worker consome a sua parte das filas:
+    server.assign_shards(index, workers)
+
+    def on_sigterm(signum, frame):
+        ioloop.add_callback_from_signal(server.stop)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    def report():
+        try:
+            stats_queue.put_nowait((index, os.getpid(), time.monotonic(), server.stats()))
+        except queue.Full:
+            pass
+
+    PeriodicCallback(report, stats_interval * 1000).start()
+
+    server.run()
+    report()
+
+    # O worker sai com os._exit, sem os atexit: o que ainda está na fila de log é escrito aqui.
+    shutdown_logging()
+
+
+class WorkerSlot(object):
+    """Um processo worker do Supervisor e o controle de reinícios dele."""
+    __slots__ = ('index', 'process', 'started_at', 'restart_delay', 'restart_at', 'restarts', 'last_stats')
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = 0.0
+        self.restarts = 0
+        self.last_stats = None
+
+
+class Supervisor(object):
+    """Sobe N processos do Servidor, cada um com a sua conexão ao RabbitMQ, consumindo da
+    mesma fila (com shards, cada worker consome a sua parte das filas; ver
+    `Server.assign_shards`). Reinicia os workers que caírem, repassa o SIGTERM para que cada
+    worker desligue pelo `Server.stop` e agrega a vazão reportada por cada um.
+
+        Supervisor(workers=8).run()
+
+    """
+    MIN_RESTART_DELAY = 1.0
+    MAX_RESTART_DELAY = 30.0
+    STABLE_UPTIME = 10.0
+
+    def __init__(self, workers, server_factory=None, stats_interval=5):
+        """
+        :param int workers: Quantidade de processos do Servidor
+        :param callable server_factory: Cria o Servidor dentro do worker (padrão: `Server()`)
+        :param int stats_interval: Intervalo, em segundos, dos relatórios de vazão
+
+        """
+        if server_factory is None:
+            from app.server import Server
+            server_factory = Server
+
+        self._server_factory = server_factory
+        self._stats_interval = stats_interval
+        self._stats_queue = multiprocessing.Queue(maxsize=workers * 100)
+        self._slots = [WorkerSlot(index) for index in range(workers)]
+        self._stopping = False
+        self._throughput = {}
+
+    def _spawn(self, slot):
+        slot.process = multiprocessing.Process(
+            target=_run_worker,
+            args=(slot.index, len(self._slots), self._server_factory, self._stats_queue, self._stats_interval),
+            name='server-worker-%i' % slot.index)
+        slot.process.start()
+        slot.started_at = time.monotonic()
+
+        LOGGER.info('Worker %i iniciado (pid %i)', slot.index, slot.process.pid)
+
+    def _on_signal(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        for slot in self._slots:
+            self._spawn(slot)
+
+        next_report = time.monotonic() + self._stats_interval
+
+        while not self._stopping:
+            self._check_workers()
+            self._collect_stats(timeout=0.5)
+
+            if time.monotonic() >= next_report:
+                next_report += self._stats_interval
+                self._report()
+
+        self.stop()
+
+    def _check_workers(self):
+        """Reinicia os workers que terminaram, com atraso crescente se caírem logo após subir."""
+        now = time.monotonic()
+
+        for slot in self._slots:
+            if slot.process is not None and slot.process.is_alive():
+                continue
+
+            if slot.process is not None:
+                LOGGER.warning('Worker %i (pid %i) terminou com código %s',
+                               slot.index, slot.process.pid, slot.process.exitcode)
+
+                if now - slot.started_at >= self.STABLE_UPTIME:
+                    slot.restart_delay = 0.0
+                else:
+                    slot.restart_delay = min(self.MAX_RESTART_DELAY,
+                                             max(self.MIN_RESTART_DELAY, slot.restart_delay * 2))
+
+                slot.process = None
+                slot.restart_at = now + slot.restart_delay
+
+            if now >= slot.restart_at:
+                slot.restarts += 1
+                self._spawn(slot)
+
+    def _collect_stats(self, timeout):
+        try:
+            index, pid, at, stats = self._stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+        while True:
+            slot = self._slots[index]
+            previous = slot.last_stats
+
+            # A vazão é a diferença entre dois relatórios do mesmo processo:
+            if previous is not None and previous[0] == pid and at > previous[1]:
+                consumed = stats['consumer']['consumed'] - previous[2]['consumer']['consumed']
+                published = stats['publisher']['published'] - previous[2]['publisher']['published']
+                self._throughput[index] = (consumed / (at - previous[1]), published / (at - previous[1]))
+
+            slot.last_stats = (pid, at, stats)
+
+            try:
+                index, pid, at, stats = self._stats_queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def stats(self):
+        """Vazão (mensagens/s consumidas e publicadas) por worker e total."""
+        workers = dict((index, dict(consumed_per_sec=consumed, published_per_sec=published))
+                       for index, (consumed, published) in self._throughput.items())
+
+        return dict(
+            workers=workers,
+            consumed_per_sec=sum(consumed for consumed, _ in self._throughput.values()),
+            published_per_sec=sum(published for _, published in self._throughput.values()),
+            restarts=sum(slot.restarts for slot in self._slots),
+        )
+
+    def _report(self):
+        stats = self.stats()
+
+        LOGGER.info('Vazão: %.0f msg/s consumidas, %.0f msg/s publicadas (%s)',
+                    stats['consumed_per_sec'], stats['published_per_sec'],
+                    ', '.join('w%i=%.0f' % (index, worker['consumed_per_sec'])
+                              for index, worker in sorted(stats['workers'].items())))
+
+    def stop(self, timeout=10):
+        """Repassa o SIGTERM para os workers e espera que desliguem."""
+        self._stopping = True
+
+        LOGGER.info('Parando %i workers', len(self._slots))
+
+        for slot in self._slots:
+            if slot.process is not None and slot.process.is_alive():
+                slot.process.terminate()
+
+        deadline = time.monotonic() + timeout
+
+        for slot in self._slots:
+            if slot.process is None:
+                continue
+
+            slot.process.join(max(0.0, deadline - time.monotonic()))
+
+            if slot.process.is_alive():
+                LOGGER.warning('Worker %i não parou a tempo, matando', slot.index)
+                slot.process.kill()
+                slot.process.join()
+
+        self._collect_stats(timeout=0)
@@ -1,4 +1,5 @@
 import pika
+import random
 import logging
 import json
 import pprint
@@ -10,7 +11,6 @@ from uuid import uuid4
 
 LOG_FORMAT = "\n(%(levelname)s): (%(asctime)s) (%(filename)s:%(lineno)s)\n\t%(message)s\n"
 
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt="%d-%m-%Y %H:%M:%S")
 LOGGER = logging.getLogger(__name__)
 
 QUEUE_FROM_FRONT = 'task_queue_sender_to_core'  
@@ -19,4 +19,15 @@ EXCHANGE_CORE_TO_SENDER = 'EXCHANGE_CORE_TO_SENDER'
 EXCHANGE_SENDER_TO_CORE = 'EXCHANGE_SENDER_TO_CORE'
 EXCHANGE_TYPE = 'direct'
 ROUTING_KEY = 'example.text'
+# Roteamento por tipo e shard (app.routing): exchange topic com routing keys sensor.<tipo>.<shard>
+EXCHANGE_SENSORS = 'EXCHANGE_SENSORS'
+EXCHANGE_TOPIC_TYPE = 'topic'
 URL = getenv('URL_AMQP')
+
+# Tipos de Agente: (intervalo entre leituras em segundos, geração da leitura)
+SENSOR_TYPES = {
+    'temperatura': (10, lambda: random.randint(32,35)),
+    'humidade': (20, lambda: random.randint(11,15)),
+    'luminosidade': (5, lambda: random.randint(0, 10)),
+    'dioxido': (30, lambda: random.randrange(0, 1)),
+}
@@ -0,0 +1,22 @@
+"""Benchmarks do projeto. Rodam contra o `app.fakebroker`, sem precisar do RabbitMQ:
+
+    python -m benchmarks.bench_publisher
+
+"""
+import logging
+
+
+def percentile(values, p):
+    """Percentil `p` (0-100) de uma lista de valores, pelo método nearest-rank."""
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+
+    return values[index]
+
+
+def quiet(level=logging.WARNING):
+    """Silencia os logs de INFO do projeto, para que o benchmark meça o código e não o terminal."""
+    logging.getLogger().setLevel(level)
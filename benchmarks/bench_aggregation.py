@@ -0,0 +1,98 @@
+"""Agregação em janelas: atualizações/s no caminho do consumo, memória residente com
+muitos sensores distintos e tempo de uma emissão completa.
+
+    python -m benchmarks.bench_aggregation --sensors 1000000 --updates 2000000
+
+"""
+import gc
+import time
+import random
+
+from argparse import ArgumentParser
+
+from app.utils import uuid4
+from app.utils import SENSOR_TYPES
+from app.aggregation import WindowAggregator
+from benchmarks import quiet
+
+
+def rss():
+    """Memória residente do processo, em bytes (Linux)."""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * 4096
+
+
+class ImmediateLoop(object):
+    """Roda as partes da emissão na hora, para medir a varredura completa."""
+
+    def add_callback(self, callback, *args):
+        callback(*args)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--sensors', type=int, default=1000000)
+    parser.add_argument('--updates', type=int, default=2000000)
+    parser.add_argument('--window', type=float, default=60)
+    parser.add_argument('--step', type=float, default=10)
+    parser.add_argument('--samples', type=int, default=8, help='Leituras por sensor para os percentis')
+    args = parser.parse_args()
+
+    quiet()
+
+    types = sorted(SENSOR_TYPES)
+    # Chaves no formato dos sensor_id dos Clients, criadas antes da medição:
+    keys = ['%s-%012x' % (types[i % len(types)], random.getrandbits(48)) for i in range(args.sensors)]
+    messages = [{'_id': str(uuid4()), 'type': types[i % len(types)], 'sensor_id': keys[i % args.sensors],
+                 'message': random.randint(0, 40)}
+                for i in range(min(args.updates, 200000))]
+
+    gc.collect()
+    baseline = rss()
+
+    published = []
+    aggregator = WindowAggregator(published.append, window=args.window, step=args.step,
+                                  sensor_samples=args.samples)
+    aggregator._ioloop = ImmediateLoop()
+
+    # Cada sensor recebe ao menos uma leitura, para ocupar a sua linha:
+    started = time.perf_counter()
+
+    for key in keys:
+        aggregator({'_id': str(uuid4()), 'type': 'temperatura', 'sensor_id': key, 'message': 33})
+
+    fill = time.perf_counter() - started
+
+    gc.collect()
+    state = rss() - baseline
+
+    started = time.perf_counter()
+    remaining = args.updates
+
+    while remaining > 0:
+        for message in messages[:remaining]:
+            aggregator(message)
+
+        remaining -= len(messages)
+
+    elapsed = time.perf_counter() - started
+
+    # Emite a janela como se o intervalo atual tivesse terminado:
+    aggregator._origin -= args.step
+    started = time.perf_counter()
+    aggregator.emit()
+    aggregator.flush()
+    emit = time.perf_counter() - started
+
+    stats = aggregator.stats
+
+    print('sensores:            %i' % stats['sensors'])
+    print('atualizações/s:      %.0f (%.2f us/atualização)' % (args.updates / elapsed, elapsed / args.updates * 1e6))
+    print('novos sensores/s:    %.0f' % (args.sensors / fill))
+    print('memória residente:   %.1f MB (%.0f bytes/sensor)' % (state / 2.0 ** 20, state / float(args.sensors)))
+    print('  colunas (arrays):  %.1f MB' % (stats['state_bytes'] / 2.0 ** 20))
+    print('emissão completa:    %.2f s, %i agregados em %i mensagens' % (emit, stats['emitted'], len(published)))
+
+
+if __name__ == '__main__':
+    main()
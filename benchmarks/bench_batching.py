@@ -0,0 +1,41 @@
+"""Micro-batching no sensor: mensagens/s que chegam ao broker e latência por leitura
+(p50/p99, do sensor ao handler) para cada tamanho de envelope, a uma taxa fixa de leituras.
+
+    python -m benchmarks.bench_batching --rate 5000 --duration 3 --batch-sizes 1 10 100 1000
+
+"""
+from argparse import ArgumentParser
+
+from app.bench import run_benchmark
+from benchmarks import quiet
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rate', type=float, default=5000)
+    parser.add_argument('--duration', type=float, default=3)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--batch-age', type=float, default=None,
+                        help='Tempo máximo, em segundos, de uma leitura no envelope')
+    args = parser.parse_args()
+
+    quiet()
+
+    print('%8s %12s %12s %12s %10s %10s' % ('lote', 'leituras/s', 'broker msg/s', 'recebidas',
+                                            'p50 ms', 'p99 ms'))
+
+    for batch_size in args.batch_sizes:
+        result = run_benchmark(rate=args.rate, duration=args.duration,
+                               client_options=dict(batch_size=batch_size, batch_age=args.batch_age))
+
+        latency = result['latency_ms']
+        # O broker recebe um basic_publish por envelope:
+        broker_rate = result['broker']['published'] / args.duration
+
+        print('%8i %12.0f %12.0f %12i %10.2f %10.2f' % (
+            batch_size, result['publish_msgs_per_sec'], broker_rate, result['received'],
+            latency['p50'], latency['p99']))
+
+
+if __name__ == '__main__':
+    main()
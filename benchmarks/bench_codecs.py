@@ -0,0 +1,58 @@
+"""Tamanho (bytes/msg) e custo de codificação e decodificação (ns/msg) de cada codec,
+com leituras de sensores dos quatro tipos.
+
+    python -m benchmarks.bench_codecs --messages 100000
+
+"""
+import time
+
+from argparse import ArgumentParser
+
+from app.utils import uuid4
+from app.utils import SENSOR_TYPES
+from app.codec import get_codec, available_codecs, decode
+
+
+def readings(count):
+    types = sorted(SENSOR_TYPES)
+
+    return [{'_id': str(uuid4()), 'type': types[i % len(types)], 'message': SENSOR_TYPES[types[i % len(types)]][1]()}
+            for i in range(count)]
+
+
+def run(name, messages):
+    codec = get_codec(name)
+    encode = codec.encode
+    clock = time.perf_counter
+
+    started = clock()
+    bodies = [encode(message) for message in messages]
+    encode_ns = (clock() - started) / len(messages) * 1e9
+
+    # A decodificação passa pela detecção do content_type, como no Consumer:
+    content_type = codec.content_type
+    started = clock()
+    decoded = [decode(body, content_type) for body in bodies]
+    decode_ns = (clock() - started) / len(messages) * 1e9
+
+    assert decoded == messages
+
+    return dict(codec=name, bytes_per_msg=sum(map(len, bodies)) / len(bodies),
+                encode_ns=encode_ns, decode_ns=decode_ns)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    messages = readings(args.messages)
+
+    print('%10s %12s %12s %12s' % ('codec', 'bytes/msg', 'encode ns', 'decode ns'))
+
+    for name in available_codecs():
+        print('%(codec)10s %(bytes_per_msg)12.1f %(encode_ns)12.0f %(decode_ns)12.0f' % run(name, messages))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Deduplicação por `_id`: custo de consulta e inserção (us) e memória por milhão de
+`_id`s, para o LRU e para o filtro de Bloom rotativo em algumas taxas de erro.
+
+    python -m benchmarks.bench_dedup --ids 1000000 --error-rates 0.01 0.001 0.0001
+
+"""
+import sys
+import time
+import tracemalloc
+
+from argparse import ArgumentParser
+
+from app.utils import uuid4
+from app.dedup import LRUDeduplicator, BloomDeduplicator
+
+
+def memory(factory, ids):
+    """Bytes alocados pelo deduplicador com todos os `_id`s, contando as strings que ele
+    mantém vivas.
+
+    """
+    tracemalloc.start()
+    dedup = factory()
+
+    for _id in ids:
+        dedup.add(_id)
+
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    if isinstance(dedup, LRUDeduplicator):
+        allocated += sum(sys.getsizeof(_id) for _id in ids)
+
+    return allocated
+
+
+def run(name, factory, ids, fresh):
+    clock = time.perf_counter
+    dedup = factory()
+
+    started = clock()
+
+    for _id in ids:
+        if _id not in dedup:
+            dedup.add(_id)
+
+    insert = clock() - started
+
+    started = clock()
+    hits = sum(1 for _id in ids if _id in dedup)
+    lookup = clock() - started
+
+    # _ids nunca vistos: todo acerto aqui é um falso positivo.
+    false_positives = sum(1 for _id in fresh if _id in dedup)
+
+    return dict(name=name, insert_us=insert / len(ids) * 1e6, lookup_us=lookup / len(ids) * 1e6,
+                mb_per_million=memory(factory, ids) / 2.0 ** 20 * 1e6 / len(ids),
+                remembered=hits / float(len(ids)), false_positives=false_positives / float(len(fresh)))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--ids', type=int, default=1000000)
+    parser.add_argument('--error-rates', type=float, nargs='+', default=[0.01, 0.001, 0.0001])
+    args = parser.parse_args()
+
+    ids = [str(uuid4()) for _ in range(args.ids)]
+    fresh = [str(uuid4()) for _ in range(min(args.ids, 200000))]
+
+    print('%-16s %12s %10s %12s %10s %12s' % ('deduplicador', 'check+add us', 'lookup us', 'MB/milhão',
+                                              'lembrados', 'falsos +'))
+
+    candidates = [('lru', lambda: LRUDeduplicator(capacity=args.ids, ttl=None))]
+    candidates += [('bloom %g' % rate, lambda rate=rate: BloomDeduplicator(capacity=args.ids, error_rate=rate))
+                   for rate in args.error_rates]
+
+    for name, factory in candidates:
+        result = run(name, factory, ids, fresh)
+        print('%(name)-16s %(insert_us)12.2f %(lookup_us)10.2f %(mb_per_million)12.1f '
+              '%(remembered)10.3f %(false_positives)12.5f' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Custo do logging por mensagem: uma chamada de log no caminho quente (ns), formatada na
+hora (como era antes) ou preguiçosa, com o processo em INFO e em WARNING; e a vazão do
+Publisher com os logs em cada nível, escritos pelo QueueListener (texto ou JSON) em
+/dev/null.
+
+    python -m benchmarks.bench_logging --iterations 200000 --messages 50000
+
+"""
+import os
+import time
+import logging
+
+from argparse import ArgumentParser
+
+from app.logconfig import configure_logging, shutdown_logging
+from benchmarks.bench_publisher import run
+
+LOGGER = logging.getLogger('app.publisher')
+
+
+def measure(function, iterations):
+    """ns por chamada de `function`."""
+    message = {'data': {'type': 'temperatura', 'message': 33}, '_id': '4b0c52c8-5e4e-4b3a-9a5c'}
+    clock = time.perf_counter
+
+    started = clock()
+    for _ in range(iterations):
+        function(message)
+
+    return (clock() - started) / iterations * 1e9
+
+
+CALLS = [
+    ('info + str.format (antes)', lambda message: LOGGER.info("Publicando: {}".format(message))),
+    ('info + % na hora', lambda message: LOGGER.info("Publicando: %s" % (message,))),
+    ('info preguiçoso', lambda message: LOGGER.info('Publicando: %s', message)),
+    ('debug preguiçoso (agora)', lambda message: LOGGER.debug('Publicando: %s', message)),
+]
+
+
+def stream_handler():
+    """O handler síncrono do antigo basicConfig, escrevendo em /dev/null."""
+    root = logging.getLogger()
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    root.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--messages', type=int, default=50000, help='mensagens publicadas por nível')
+    args = parser.parse_args()
+
+    print('%-28s %14s %14s %14s' % ('chamada (ns)', 'INFO síncrono', 'INFO fila', 'WARNING'))
+
+    for name, function in CALLS:
+        results = []
+
+        stream_handler()
+        logging.getLogger().setLevel(logging.INFO)
+        results.append(measure(function, args.iterations))
+
+        for level in ('INFO', 'WARNING'):
+            configure_logging(level, '', False, os.devnull)
+            results.append(measure(function, args.iterations))
+            shutdown_logging()
+
+        print('%-28s %14.0f %14.0f %14.0f' % ((name,) + tuple(results)))
+
+    print()
+    print('%-22s %12s %10s %10s' % ('publicação', 'msgs/s', 'p50 ms', 'p99 ms'))
+
+    for level, json_lines in (('DEBUG', False), ('DEBUG', True), ('INFO', False), ('INFO', True),
+                              ('WARNING', False)):
+        configure_logging(level, 'pika=WARNING', json_lines, os.devnull)
+        result = run(args.messages, 1, 10, 200)
+        shutdown_logging()
+
+        print('%-22s %12.0f %10.2f %10.2f' % (level + (' json' if json_lines else ''),
+                                             result['msgs_per_sec'], result['p50_ms'], result['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Custo das métricas no caminho quente (ns por medida), o acréscimo no despacho dos
+handlers com o histograma de latência, e o tempo de uma coleta do /metrics.
+
+    python -m benchmarks.bench_metrics --iterations 1000000
+
+"""
+import time
+
+from argparse import ArgumentParser
+
+from app.metrics import Registry
+from app.handlers import HandlerRegistry
+
+
+def measure(function, iterations):
+    """ns por chamada de `function`, descontado o custo do laço."""
+    clock = time.perf_counter
+    values = [0.0003 * (i % 7) for i in range(1000)]
+
+    started = clock()
+    for i in range(iterations):
+        values[i % 1000]
+    baseline = clock() - started
+
+    started = clock()
+    for i in range(iterations):
+        function(values[i % 1000])
+    elapsed = clock() - started
+
+    return max(0.0, elapsed - baseline) / iterations * 1e9
+
+
+def dispatch(registry, iterations):
+    message = {'type': 'temperatura', 'message': 33}
+    clock = time.perf_counter
+
+    started = clock()
+    for _ in range(iterations):
+        registry.dispatch(message)
+
+    return (clock() - started) / iterations * 1e9
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=1000000)
+    parser.add_argument('--handlers', type=int, default=50, help='handlers rotulados na coleta')
+    args = parser.parse_args()
+
+    registry = Registry()
+    counter = registry.counter('bench_counter', 'contador')
+    gauge = registry.gauge('bench_gauge', 'gauge')
+    histogram = registry.histogram('bench_histogram', 'histograma')
+    labelled = registry.histogram('bench_labelled', 'histograma rotulado', labelnames=('handler',))
+    child = labelled.labels('temperatura')
+
+    print('%-36s %10s' % ('medida', 'ns'))
+
+    for name, function in [
+            ('Counter.inc', lambda value: counter.inc()),
+            ('Gauge.set', gauge.set),
+            ('Histogram.observe', histogram.observe),
+            ('Histogram.labels(...).observe', lambda value: labelled.labels('temperatura').observe(value)),
+            ('filho guardado .observe', child.observe)]:
+        print('%-36s %10.0f' % (name, measure(function, args.iterations)))
+
+    plain = HandlerRegistry()
+    plain.register('temperatura', lambda message: None)
+
+    instrumented = HandlerRegistry()
+    instrumented.register('temperatura', lambda message: None)
+    instrumented.instrument(registry.histogram('handler_latency_seconds', 'handlers', labelnames=('handler',)))
+
+    without = dispatch(plain, args.iterations)
+    with_histogram = dispatch(instrumented, args.iterations)
+
+    print()
+    print('%-36s %10.0f' % ('dispatch sem histograma', without))
+    print('%-36s %10.0f' % ('dispatch com histograma', with_histogram))
+    print('%-36s %10.0f' % ('acréscimo por mensagem', with_histogram - without))
+
+    for i in range(args.handlers):
+        labelled.labels('handler-%i' % (i,)).observe(0.001)
+
+    clock = time.perf_counter
+    started = clock()
+
+    for _ in range(100):
+        text = registry.render()
+
+    print()
+    print('coleta: %.2f ms para %i linhas' % ((clock() - started) / 100 * 1000, text.count('\n')))
+
+
+if __name__ == '__main__':
+    main()
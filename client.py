@@ -1,7 +1,54 @@
 
 if __name__ == '__main__':
+    from app.utils import SENSOR_TYPES
     from app.client import Client
+    from app.logconfig import configure_logging
 
     args = Client.args()
 
-    Client(agent_type=args.type).run()
+    configure_logging(args.log_level, args.log_levels, args.log_json)
+
+    agent_types = list(SENSOR_TYPES) if args.type.lower() == 'todos' else [args.type]
+
+    if args.bench:
+        import sys
+        import json
+        import logging
+
+        from app.bench import run_benchmark
+
+        # Os logs de INFO mediriam o terminal, não o sistema:
+        if args.log_level is None:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        result = run_benchmark(agent_types[0], rate=args.rate, duration=args.duration, size=args.size,
+                               client_options=dict(codec=args.codec, compression=args.compression,
+                                                   batch_size=args.batch_size, batch_age=args.batch_age,
+                                                   spool=args.spool))
+
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(result, output, indent=2)
+        else:
+            json.dump(result, sys.stdout, indent=2)
+            print()
+
+    elif args.sensors > 1 or len(agent_types) > 1:
+        import asyncio
+
+        from app.aioclient import AsyncClient
+
+        client = AsyncClient(channels=args.channels, codec=args.codec, client_id=args.sensor_id,
+                             shards=args.shards)
+
+        for agent_type in agent_types:
+            client.add_sensors(agent_type, args.sensors)
+
+        try:
+            asyncio.run(client.run())
+        except KeyboardInterrupt:
+            pass
+    else:
+        Client(agent_type=args.type, codec=args.codec, compression=args.compression,
+               batch_size=args.batch_size, batch_age=args.batch_age, spool=args.spool,
+               shards=args.shards, sensor_id=args.sensor_id).run()
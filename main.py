@@ -1,10 +1,39 @@
 
 if __name__ == '__main__':
+    import functools
+
     from app.server import Server
+    from app.handlers import pprint_sink
+    from app.logconfig import configure_logging
+
+    args = Server.args()
+
+    configure_logging(args.log_level, args.log_levels, args.log_json)
+
+    aggregation_options = dict(window=args.window, step=args.step) if args.window else None
+
+    retry_options = dict(delays=args.retry_delays, max_attempts=args.max_attempts) if args.retry_delays else None
+
+    consumer_options = dict(debug_sink=pprint_sink if args.debug else None, lazy=args.lazy)
+
+    if args.dedup:
+        from app.dedup import get_deduplicator
+
+        consumer_options['dedup'] = get_deduplicator(args.dedup)
+
+    server_factory = functools.partial(Server, consumer_options=consumer_options,
+                                       aggregation_options=aggregation_options,
+                                       metrics_port=args.metrics_port, shards=args.shards,
+                                       retry_options=retry_options)
+
+    if args.workers > 1:
+        from app.supervisor import Supervisor
 
-    server = Server()
-    
-    try:
-        server.run()
-    except KeyboardInterrupt:
-        server.stop()
+        Supervisor(args.workers, server_factory).run()
+    else:
+        server = server_factory()
+        
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            server.stop()
@@ -0,0 +1,61 @@
+"""Registro de handlers: curinga, observadores e a agregação em janelas."""
+import pytest
+
+from app.handlers import HandlerRegistry
+from app.aggregation import WindowAggregator
+
+
+def test_aggregator_does_not_hide_wildcard():
+    handlers = HandlerRegistry()
+    seen = []
+    handlers.register(HandlerRegistry.WILDCARD, seen.append)
+
+    aggregator = WindowAggregator(lambda message: None)
+    aggregator.attach(handlers)
+
+    message = {'_id': '1', 'type': 'temperatura', 'sensor_id': 'temperatura-1', 'message': 21}
+
+    handlers.notify(message)
+    handlers.dispatch(message)
+
+    assert seen == [message]
+    assert aggregator.updates == 1
+    assert handlers.unhandled == 0
+
+
+def test_type_lookup_ignores_case():
+    handlers = HandlerRegistry()
+    seen = []
+    handlers.register('temperatura', seen.append)
+
+    handlers.dispatch({'_id': '1', 'type': 'TEMPERATURA', 'message': 21})
+
+    assert len(seen) == 1
+    assert handlers.unhandled == 0
+
+
+def test_type_comparisons_ignore_case():
+    handlers = HandlerRegistry()
+    handlers.register('temperatura', lambda message: None)
+
+    assert 'TEMPERATURA' in handlers
+
+    aggregator = WindowAggregator(lambda message: None)
+    aggregator({'_id': '1', 'type': 'Temperatura', 'message': 21})
+    aggregator({'_id': '2', 'type': 'temperatura', 'message': 22})
+
+    assert aggregator.stats['types'] == 1
+
+
+def test_batch_collector_ignores_type_case():
+    pytest.importorskip('numpy')
+
+    from app.columnar import BatchCollector
+
+    batches = BatchCollector(size=2)
+
+    assert batches.add(1, [{'_id': '1', 'type': 'TEMPERATURA', 'message': 21}])
+    assert batches.add(2, [{'_id': '2', 'type': 'temperatura', 'message': 22}])
+    batch, delivery_tags = batches.take()
+
+    assert batch.mask('Temperatura').sum() == 2
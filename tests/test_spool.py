@@ -0,0 +1,161 @@
+"""Spool em disco: registros com crc32, recuperação depois de uma queda no meio da escrita,
+confirmações persistidas e a thread que publica o spool.
+
+"""
+import os
+import threading
+
+from app.spool import Spool, SpoolDrain, _SEGMENT, _RECORD
+from app.backoff import Backoff
+
+
+def segment_path(directory, sequence=0):
+    return os.path.join(str(directory), '%020i.seg' % (sequence,))
+
+
+def bodies(records):
+    return [bytes(body) for _, body, _, _ in records]
+
+
+def patch(directory, offset, data, sequence=0):
+    """Sobrescreve bytes do segmento, como uma escrita interrompida ou um disco corrompido."""
+    with open(segment_path(directory, sequence), 'r+b') as segment:
+        segment.seek(offset)
+        segment.write(data)
+
+
+def test_records_round_trip(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+
+    assert spool.append(b'one')
+    assert spool.append(b'two', compressed=True, key='sensor.temperatura.1')
+
+    records = spool.read()
+
+    assert bodies(records) == [b'one', b'two']
+    assert [(compressed, key) for _, _, compressed, key in records] == [(False, None),
+                                                                      (True, 'sensor.temperatura.1')]
+    assert spool.read() == []
+    spool.close()
+
+
+def test_corrupted_record_ends_the_segment_on_recovery(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+
+    for body in (b'first', b'second', b'third'):
+        spool.append(body)
+
+    first_end = spool.read(1)[0][0][1]
+    spool.close()
+
+    # Um byte trocado no corpo do segundo registro não confere com o crc32:
+    patch(tmp_path, first_end + _RECORD.size, b'X')
+
+    spool = Spool(str(tmp_path), segment_size=4096)
+    assert bodies(spool.read()) == [b'first']
+
+    # A escrita recomeça depois do último registro íntegro:
+    spool.append(b'again')
+    spool.rewind()
+    assert bodies(spool.read()) == [b'first', b'again']
+    spool.close()
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    spool.append(b'kept')
+    tail = spool.read()[0][0][1]
+    spool.close()
+
+    # Cabeçalho e corpo gravados, mas a queda veio antes das flags:
+    patch(tmp_path, tail, _RECORD.pack(4, 0, 0) + b'torn')
+
+    spool = Spool(str(tmp_path), segment_size=4096)
+    assert bodies(spool.read()) == [b'kept']
+    spool.close()
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    spool.append(b'kept')
+    tail = spool.read()[0][0][1]
+    spool.close()
+
+    # Um tamanho que passa do fim do segmento:
+    patch(tmp_path, tail, _RECORD.pack(10 ** 6, 0, 1))
+
+    spool = Spool(str(tmp_path), segment_size=4096)
+    assert bodies(spool.read()) == [b'kept']
+    spool.close()
+
+
+def test_reading_resumes_from_the_last_ack(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+
+    for body in (b'a', b'b', b'c'):
+        spool.append(body)
+
+    records = spool.read()
+    spool.ack(records[1][0], 2)
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=4096)
+    assert bodies(spool.read()) == [b'c']
+    spool.close()
+
+
+def test_acked_segments_are_removed(tmp_path):
+    size = _SEGMENT.size + 2 * (_RECORD.size + 10)
+    spool = Spool(str(tmp_path), segment_size=size, max_segments=3)
+
+    for i in range(6):
+        assert spool.append(b'%010i' % (i,))
+
+    # Os três segmentos cheios:
+    assert not spool.append(b'x' * 10)
+    assert spool.stats['segments'] == 3
+
+    records = spool.read()
+    assert len(records) == 6
+
+    spool.ack(records[-1][0], 6)
+
+    assert spool.stats['segments'] == 1
+    assert len(spool) == 0
+    assert sorted(os.listdir(str(tmp_path))) == [os.path.basename(segment_path(tmp_path, 2))]
+    spool.close()
+
+
+class Channel(object):
+    def __init__(self):
+        self.connection = self
+
+    def close(self):
+        pass
+
+
+def test_drain_republishes_after_a_failure(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    published = []
+    failed = threading.Event()
+
+    def publish(channel, body, compressed, key):
+        # A segunda mensagem falha uma vez: a leitura volta para a última confirmação.
+        if bytes(body) == b'1' and not failed.is_set():
+            failed.set()
+            raise IOError('sem confirmação')
+
+        published.append(bytes(body))
+
+    drain = SpoolDrain(spool, Channel, publish, batch_size=2, backoff=Backoff(initial=0.001))
+    drain.start()
+
+    for i in range(5):
+        spool.append(b'%i' % (i,))
+
+    drain.stop(timeout=5)
+
+    assert published == [b'0', b'1', b'2', b'3', b'4']
+    assert drain.stats == dict(published=5, failures=1, connections=2)
+    assert len(spool) == 0
+    spool.close()